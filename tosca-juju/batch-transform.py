@@ -0,0 +1,236 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import yaml, sys, os, glob, json, time, argparse, traceback, multiprocessing
+
+from csarfile import CsarFile, CsarError
+from modeltrans import ModelTransformer
+from tplcache import TemplateCache
+from charmgen import CharmGenerator, CharmGenerationError
+from cmdgen import CommandGenerator
+from charmmodel import Model
+from executor import CommandExecutor, printReport
+
+#
+# batch-transform.py 'csars/*.zip'
+# batch-transform.py --deploy test csars/sugarcrm.zip
+#
+
+charmSeries = 'precise' # for now this has to be a valid name for a Ubuntu series
+
+# Options of the batch, set in every worker process by initBatchWorker
+batchOptions = None
+
+# Service templates loaded by this worker process, shared by all its CSARs
+templateCache = None
+
+def initBatchWorker(options):
+  global batchOptions, templateCache
+  batchOptions = options
+  templateCache = TemplateCache(options['templateCacheDir'])
+
+# Returns the CSAR files given as paths or glob patterns, in a stable order
+# and without duplicates
+def findCsarFiles(patterns):
+  csarFiles = []
+
+  for pattern in patterns:
+    matches = sorted(glob.glob(pattern))
+    if len(matches) == 0: matches = [pattern]
+
+    for path in matches:
+      if not path in csarFiles: csarFiles.append(path)
+
+  return csarFiles
+
+# Returns a distinct working directory name for every CSAR file
+def getWorkDirNames(csarFiles):
+  names = []
+
+  for csarFile in csarFiles:
+    baseName = os.path.splitext(os.path.basename(csarFile))[0]
+    name = baseName
+    i = 1
+
+    while name in names:
+      i += 1
+      name = baseName + '-' + str(i)
+
+    names.append(name)
+
+  return names
+
+# Transforms a single CSAR in its own working directory and builds its charms.
+# The output of the transformation goes to transform.log in that directory.
+def transformCsar(csarFile, workDir):
+  options = batchOptions
+  result = {'csar': csarFile, 'workDir': workDir, 'status': 'failed', 'charms': 0, 'duration': 0.0, 'error': None}
+
+  start = time.time()
+
+  if not os.path.isdir(workDir):
+    os.makedirs(workDir)
+
+  stdout = sys.stdout
+  log = open(workDir + '/transform.log', 'w')
+  sys.stdout = log
+
+  try:
+    try:
+      csar = CsarFile(csarFile)
+
+      try:
+        transformer = ModelTransformer(csar, options['serviceTpl'], options['loader'], templateCache)
+        model = transformer.transform()
+
+        if options['dedupe']:
+          model.deduplicate()
+
+        modelYaml = yaml.safe_dump(model.toDict(), default_flow_style=False)
+        print modelYaml
+
+        modelFile = open(workDir + '/model.yaml', 'w')
+        modelFile.write(modelYaml)
+        modelFile.close()
+
+        # Pool workers cannot start pools of their own, so charms are built serially here
+        charmGen = CharmGenerator(csar, model, workDir + '/charms', charmSeries, 1, options['cacheDir'], options['cacheSize'], options['incremental'])
+        charmGen.generate()
+      finally:
+        csar.close()
+
+      result['status'] = 'ok'
+      result['charms'] = len(model.charms)
+    except (CsarError, CharmGenerationError), e:
+      result['error'] = str(e)
+    except SystemExit:
+      # The transformer exits on invalid input after printing the reason
+      log.flush()
+      lines = open(workDir + '/transform.log', 'r').read().strip().split('\n')
+      result['error'] = lines[-1]
+    except Exception:
+      result['error'] = traceback.format_exc()
+  finally:
+    sys.stdout = stdout
+    log.close()
+
+  if result['error'] != None:
+    open(workDir + '/transform.log', 'a').write(result['error'] + '\n')
+
+  result['duration'] = time.time() - start
+  return result
+
+def transformCsarWorker(task):
+  return transformCsar(*task)
+
+# Prints the outcome of every CSAR of the batch
+def printSummary(results):
+  print '------------------------------------'
+  print '%-8s %6s %10s  %s' % ('status', 'charms', 'time [s]', 'CSAR')
+
+  for result in results:
+    print '%-8s %6d %10.2f  %s' % (result['status'], result['charms'], result['duration'], result['csar'])
+
+    if result['error'] != None:
+      print '         ' + result['error'].strip().split('\n')[-1]
+
+  failed = len([result for result in results if result['status'] != 'ok'])
+  print '------------------------------------'
+  print str(len(results)) + ' CSARs, ' + str(len(results) - failed) + ' transformed, ' + str(failed) + ' failed'
+
+parser = argparse.ArgumentParser(description='Transform many TOSCA CSARs into Juju charms in one run.')
+parser.add_argument('csarFiles', nargs='*', metavar='csarFile', help='TOSCA Cloud Service Archives (CSARs) or glob patterns')
+parser.add_argument('-t', '--service-template', help='path of the service template inside the CSARs (default: as named by their manifests)')
+parser.add_argument('--list', metavar='FILE', help='read further CSAR paths from FILE, one per line')
+parser.add_argument('--work-dir', default='batch', help='directory that holds a working directory per CSAR (default: batch)')
+parser.add_argument('--loader', choices=['dom', 'stream'], default='dom', help='service template loader (default: dom)')
+parser.add_argument('--workers', type=int, default=None, help='number of CSARs transformed at the same time (default: number of CPUs)')
+parser.add_argument('--cache-dir', default='cache', help='directory for cached cookbook and role bundles, shared by all CSARs (default: cache)')
+parser.add_argument('--cache-size', type=int, default=512, help='maximum size of the bundle cache in MB (default: 512)')
+parser.add_argument('--no-cache', action='store_true', help='do not use the bundle cache')
+parser.add_argument('--template-cache', metavar='DIR', help='keep parsed service templates in DIR for later runs')
+parser.add_argument('--dedupe', action='store_true', help='deploy VMs that host the same stack as units of one charm instead of generating a charm per VM')
+parser.add_argument('--rebuild', action='store_true', help='regenerate all charms, even if their inputs did not change')
+parser.add_argument('--report', metavar='FILE', help='write the summary as JSON to FILE')
+parser.add_argument('--deploy', metavar='JUJU_ENV', help='deploy the transformed CSAR to the given Juju environment; only for a single CSAR, as the services of several would collide')
+parser.add_argument('--concurrency', type=int, default=4, help='maximum number of juju commands run at the same time (default: 4)')
+parser.add_argument('--attempts', type=int, default=5, help='maximum number of attempts per juju command (default: 5)')
+args = parser.parse_args()
+
+patterns = list(args.csarFiles)
+
+if args.list != None:
+  patterns.extend(line.strip() for line in open(args.list, 'r') if line.strip() != '')
+
+csarFiles = findCsarFiles(patterns)
+
+if len(csarFiles) == 0:
+  print 'No CSAR files given.'
+  sys.exit(1)
+
+# The charms of different CSARs are deployed under the same service names
+if args.deploy != None and len(csarFiles) > 1:
+  print 'Only a single CSAR can be deployed, ' + str(len(csarFiles)) + ' given.'
+  sys.exit(1)
+
+options = {
+  'serviceTpl': args.service_template,
+  'loader': args.loader,
+  'cacheDir': None if args.no_cache else os.path.abspath(args.cache_dir),
+  'cacheSize': args.cache_size * 1024 * 1024,
+  'templateCacheDir': os.path.abspath(args.template_cache) if args.template_cache != None else None,
+  'incremental': not args.rebuild,
+  'dedupe': args.dedupe
+}
+
+tasks = zip(csarFiles, [args.work_dir + '/' + name for name in getWorkDirNames(csarFiles)])
+workers = min(args.workers or multiprocessing.cpu_count(), len(tasks))
+
+# Transform all CSARs
+if workers > 1:
+  pool = multiprocessing.Pool(workers, initBatchWorker, (options,))
+
+  try:
+    results = pool.map(transformCsarWorker, tasks, 1)
+  finally:
+    pool.terminate()
+    pool.join()
+else:
+  initBatchWorker(options)
+  results = [transformCsarWorker(task) for task in tasks]
+
+printSummary(results)
+
+if args.report != None:
+  reportFile = open(args.report, 'w')
+  reportFile.write(json.dumps(results, indent=2, sort_keys=True))
+  reportFile.close()
+
+# Deploy, if asked to
+if args.deploy != None:
+  executor = CommandExecutor(args.concurrency, args.attempts)
+
+  for result in results:
+    if result['status'] != 'ok': continue
+
+    model = Model.fromDict(yaml.safe_load(open(result['workDir'] + '/model.yaml', 'r')))
+    cmdGen = CommandGenerator(model, result['workDir'] + '/charms', charmSeries, args.deploy)
+    deployResults = executor.runPlan(cmdGen.generatePlan())
+
+    printReport(deployResults)
+
+    if len([deployResult for deployResult in deployResults if deployResult.status != 'ok']) > 0:
+      result['status'] = 'deploy-failed'
+
+if len([result for result in results if result['status'] != 'ok']) > 0:
+  sys.exit(1)
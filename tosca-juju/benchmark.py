@@ -0,0 +1,181 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, sys, json, time, shutil, hashlib, argparse, itertools, subprocess
+
+from topogen import TopologyOptions, writeCsar
+from csarfile import CsarFile
+from modeltrans import ModelTransformer
+from charmgen import CharmGenerator
+from cmdgen import CommandGenerator
+
+#
+# benchmark.py --vms 10,100,500 --depth 3 --repeat 5
+#
+# Times the pipeline stages against synthetic CSARs (see topogen) and appends
+# the results to a JSON lines file, together with the commit they were
+# measured at. Every run is compared with the last recorded run of the same
+# configuration, so regressions between commits stand out.
+#
+
+charmSeries = 'precise'
+
+stageNames = ['load', 'transform', 'charms', 'commands']
+
+# Returns a list of ints from a comma separated argument
+def intList(value):
+  return [int(item) for item in value.split(',')]
+
+# Returns the commit of the working tree, marked if there are local changes
+def getCommit():
+  try:
+    process = subprocess.Popen(['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+    output = process.communicate()[0].strip()
+    if process.returncode == 0: return output
+  except OSError:
+    pass
+
+  return None
+
+# Returns a key that identifies a benchmark configuration
+def getConfigKey(*config):
+  return hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()[:12]
+
+# Runs the stages once and returns their wall times and the model
+def runOnce(csarPath, charmsDir, loader, workers):
+  timings = {}
+
+  # The pipeline prints progress, which is part of its cost but not of interest here
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+
+  try:
+    start = time.time()
+    csar = CsarFile(csarPath)
+    transformer = ModelTransformer(csar, None, loader)
+    timings['load'] = time.time() - start
+
+    start = time.time()
+    model = transformer.transform(workers=workers)
+    timings['transform'] = time.time() - start
+
+    start = time.time()
+    CharmGenerator(csar, model, charmsDir, charmSeries, workers).generate()
+    timings['charms'] = time.time() - start
+
+    start = time.time()
+    CommandGenerator(model, charmsDir, charmSeries, 'benchmark').generate()
+    timings['commands'] = time.time() - start
+
+    csar.close()
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+
+  return timings, model
+
+# Returns the last recorded result for the given configuration key
+def findPrevious(resultsPath, key):
+  previous = None
+
+  if os.path.isfile(resultsPath):
+    for line in open(resultsPath, 'r'):
+      if line.strip() == '': continue
+
+      result = json.loads(line)
+      if result.get('key') == key: previous = result
+
+  return previous
+
+def formatChange(current, previous):
+  if previous == None or previous <= 0:
+    return ''
+
+  return '%+.0f%%' % ((current - previous) / previous * 100)
+
+parser = argparse.ArgumentParser(description='Benchmark the transformation pipeline against synthetic TOSCA topologies.')
+parser.add_argument('--vms', type=intList, default=[10, 100], help='comma separated numbers of virtual machines (default: 10,100)')
+parser.add_argument('--depth', type=intList, default=[3], help='comma separated hosted-on stack depths (default: 3)')
+parser.add_argument('--depends-on', type=intList, default=[2], help='comma separated depends-on fan-outs (default: 2)')
+parser.add_argument('--connects-to', type=intList, default=[1], help='comma separated connects-to fan-outs (default: 1)')
+parser.add_argument('--cookbooks', type=intList, default=[10], help='comma separated numbers of cookbooks (default: 10)')
+parser.add_argument('--cookbook-size', type=intList, default=[64], help='comma separated cookbook sizes in KB (default: 64)')
+parser.add_argument('--loader', choices=['dom', 'stream'], default='dom', help='service template loader (default: dom)')
+parser.add_argument('--workers', type=int, default=1, help='number of processes used to transform large topologies and to generate charms (default: 1)')
+parser.add_argument('--repeat', type=int, default=3, help='number of runs per configuration; the fastest one counts (default: 3)')
+parser.add_argument('--work-dir', default='benchmark', help='directory for the generated CSARs and charms (default: benchmark)')
+parser.add_argument('--results', default='benchmark-results.jsonl', help='file the results are appended to (default: benchmark-results.jsonl)')
+parser.add_argument('--no-record', action='store_true', help='only print the results')
+args = parser.parse_args()
+
+commit = getCommit()
+
+if not os.path.isdir(args.work_dir):
+  os.makedirs(args.work_dir)
+
+print '%-40s %8s %8s' % ('configuration', 'charms', 'relations') + ''.join(' %13s %6s' % (name + ' [s]', '') for name in stageNames)
+
+configs = itertools.product(args.vms, args.depth, args.depends_on, args.connects_to, args.cookbooks, args.cookbook_size)
+
+for vms, depth, dependsOn, connectsTo, cookbooks, cookbookSize in configs:
+  options = TopologyOptions(vms, depth, dependsOn, connectsTo, cookbooks, cookbookSize * 1024)
+  key = getConfigKey(options.toDict(), args.loader, args.workers)
+
+  # Generated CSARs are kept, they only depend on the options
+  csarPath = args.work_dir + '/' + getConfigKey(options.toDict()) + '.zip'
+  if not os.path.isfile(csarPath):
+    writeCsar(csarPath + '.tmp', options)
+    os.rename(csarPath + '.tmp', csarPath)
+
+  runs = []
+  charmsDir = args.work_dir + '/charms-' + key
+
+  for i in range(max(1, args.repeat)):
+    timings, model = runOnce(csarPath, charmsDir, args.loader, args.workers)
+    runs.append(timings)
+
+  shutil.rmtree(charmsDir, True)
+
+  best = dict((name, min(run[name] for run in runs)) for name in stageNames)
+  previous = findPrevious(args.results, key)
+
+  result = {
+    'key': key,
+    'commit': commit,
+    'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': sys.version.split()[0],
+    'options': options.toDict(),
+    'loader': args.loader,
+    'workers': args.workers,
+    'repeat': len(runs),
+    'charms': len(model.charms),
+    'relations': len(model.topology.relations),
+    'timings': best,
+    'runs': runs
+  }
+
+  label = 'vms=%d depth=%d dep=%d con=%d cb=%dx%dK' % (vms, depth, dependsOn, connectsTo, cookbooks, cookbookSize)
+  line = '%-40s %8d %8d' % (label, result['charms'], result['relations'])
+
+  for name in stageNames:
+    line += ' %13.3f %6s' % (best[name], formatChange(best[name], previous['timings'].get(name) if previous != None else None))
+
+  print line
+
+  if not args.no_record:
+    resultsFile = open(args.results, 'a')
+    resultsFile.write(json.dumps(result, sort_keys=True) + '\n')
+    resultsFile.close()
+
+if not args.no_record:
+  print 'Results appended to ' + args.results + (' (commit ' + commit + ')' if commit != None else '') + '.'
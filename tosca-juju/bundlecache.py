@@ -0,0 +1,144 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, errno, hashlib, shutil, tempfile
+
+# Version of the bundle layout; bump it whenever bundles are built differently
+bundleFormat = '3'
+
+# Digests of input files by (path, size, mtime), so that cookbooks shared by
+# several charms are only hashed once per process
+fileDigests = {}
+
+# Returns the SHA-1 digest of the content of the given file
+def getFileDigest(path):
+  stat = os.stat(path)
+  statKey = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+  if not statKey in fileDigests:
+    digest = hashlib.sha1()
+    file = open(path, 'rb')
+
+    try:
+      for block in iter(lambda: file.read(1 << 16), ''):
+        digest.update(block)
+    finally:
+      file.close()
+
+    fileDigests[statKey] = digest.hexdigest()
+
+  return fileDigests[statKey]
+
+# Returns the cache key of a bundle of the given kind ("cookbooks", "roles")
+# that is built from the given entries, a list of (name in bundle, SHA-1
+# digest of the input). The order of the entries does not matter.
+def getBundleKey(kind, entries):
+  digest = hashlib.sha1()
+  digest.update(bundleFormat + '\0' + kind + '\0')
+
+  for name, digestOfInput in sorted(entries):
+    digest.update(name.encode('utf-8') + '\0' + digestOfInput + '\0')
+
+  return digest.hexdigest()
+
+# Content-addressed store for finished bundles. Bundles are placed into charm
+# directories as hard links (or copies if linking is not possible). The total
+# size of the cache is bounded; the least recently used bundles are evicted
+# first, using the modification time of the cached files as last use time.
+class BundleCache:
+  def __init__(self, cacheDir, maxSize):
+    self.cacheDir = cacheDir
+    self.maxSize = maxSize
+
+    if not os.path.isdir(self.cacheDir):
+      try:
+        os.makedirs(self.cacheDir)
+      except OSError, e:
+        if e.errno != errno.EEXIST: raise
+
+  # Returns the path of the cache entry for the given key
+  def getPath(self, key):
+    return self.cacheDir + '/' + key + '.zip'
+
+  # Places the bundle with the given key at the destination path. Returns
+  # False if the bundle is not in the cache.
+  def fetch(self, key, destPath):
+    path = self.getPath(key)
+
+    try:
+      os.utime(path, None)
+    except OSError:
+      return False
+
+    try:
+      linkOrCopy(path, destPath)
+    except (OSError, IOError):
+      # Evicted by another process in the meantime
+      return False
+
+    return True
+
+  # Adds the bundle at the given path to the cache
+  def store(self, key, srcPath):
+    path = self.getPath(key)
+
+    # Write to a temporary file first, so concurrent readers never see partial bundles
+    fd, tmpPath = tempfile.mkstemp('.tmp', key, self.cacheDir)
+    os.close(fd)
+
+    try:
+      linkOrCopy(srcPath, tmpPath)
+      os.rename(tmpPath, path)
+    except:
+      if os.path.exists(tmpPath): os.remove(tmpPath)
+      raise
+
+    self.evict()
+
+  # Removes the least recently used bundles until the cache fits its maximum size
+  def evict(self):
+    entries = []
+    totalSize = 0
+
+    for name in os.listdir(self.cacheDir):
+      if not name.endswith('.zip'): continue
+
+      try:
+        stat = os.stat(self.cacheDir + '/' + name)
+      except OSError:
+        continue
+
+      entries.append((stat.st_mtime, stat.st_size, name))
+      totalSize += stat.st_size
+
+    for mtime, size, name in sorted(entries):
+      if totalSize <= self.maxSize: break
+
+      try:
+        os.remove(self.cacheDir + '/' + name)
+      except OSError:
+        pass
+
+      totalSize -= size
+
+# Hard links the source file to the destination path, or copies it with its
+# permissions if the file system does not support hard links (or both are on
+# different devices)
+def linkOrCopy(srcPath, destPath):
+  if os.path.exists(destPath):
+    os.remove(destPath)
+
+  try:
+    os.link(srcPath, destPath)
+  except (OSError, AttributeError):
+    shutil.copy(srcPath, destPath)
@@ -0,0 +1,169 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, struct, zipfile
+import instrument
+
+# Size of the blocks in which member data is copied
+blockSize = 1 << 16
+
+# Attributes of directory entries (drwxr-xr-x plus the MS-DOS directory flag)
+dirAttributes = (040755 << 16) | 0x10
+
+# Attributes of file entries (-rw-r--r--)
+fileAttributes = 0100644 << 16
+
+# Returns the given member name without absolute or relative path components,
+# the same way zipfile.extractall sanitizes names
+def normalizeName(name):
+  return '/'.join(part for part in name.split('/') if part not in ('', '.', '..'))
+
+# Writes a zip archive at destPath that contains the members of all given
+# source archives, each one below its own directory. The archives are given
+# as a list of (directory name, seekable file object with the source archive).
+# Deflated members are copied without being decompressed and compressed
+# again, all other members are deflated. Nothing is extracted to the file
+# system.
+def bundleArchives(destPath, archives):
+  out = zipfile.ZipFile(destPath, 'w', zipfile.ZIP_DEFLATED, True)
+
+  try:
+    writer = BundleWriter(out)
+
+    for prefix, srcFile in archives:
+      src = zipfile.ZipFile(srcFile)
+
+      try:
+        writer.addDirectory(prefix + '/', None)
+
+        for info in src.infolist():
+          name = normalizeName(info.filename)
+          if name == '': continue
+
+          if info.filename.endswith('/'):
+            writer.addDirectory(prefix + '/' + name + '/', info)
+          elif info.compress_type == zipfile.ZIP_DEFLATED:
+            writer.copyMember(prefix + '/' + name, info, srcFile)
+          else:
+            writer.recompressMember(prefix + '/' + name, info, src)
+      finally:
+        src.close()
+  finally:
+    out.close()
+
+# Writes a zip archive at destPath that contains the given files, a list of
+# (name in the archive, date_time tuple, content). Later files replace earlier
+# ones with the same name.
+def bundleFiles(destPath, files):
+  contents = {}
+  names = []
+
+  for name, dateTime, data in files:
+    if not name in contents: names.append(name)
+    contents[name] = (dateTime, data)
+
+  out = zipfile.ZipFile(destPath, 'w', zipfile.ZIP_DEFLATED, True)
+
+  try:
+    for name in names:
+      dateTime, data = contents[name]
+
+      info = zipfile.ZipInfo(name, dateTime)
+      info.compress_type = zipfile.ZIP_DEFLATED
+      info.external_attr = fileAttributes
+
+      out.writestr(info, data)
+      instrument.count('bundles.bytesDeflated', len(data))
+  finally:
+    out.close()
+
+# Appends members to an open zip file, creating the parent directory entries
+# of every member once
+class BundleWriter:
+  def __init__(self, out):
+    self.out = out
+    self.directories = set()
+
+  # Adds the parent directories of the given name that were not added yet
+  def addParents(self, name):
+    parts = name.rstrip('/').split('/')[:-1]
+
+    for i in range(1, len(parts) + 1):
+      self.addDirectory('/'.join(parts[:i]) + '/', None)
+
+  # Adds a directory entry, using the attributes of the source entry if given
+  def addDirectory(self, name, srcInfo):
+    if name in self.directories: return
+
+    self.addParents(name)
+    self.directories.add(name)
+
+    if srcInfo != None:
+      info = zipfile.ZipInfo(name, srcInfo.date_time)
+      info.external_attr = srcInfo.external_attr | 0x10
+    else:
+      info = zipfile.ZipInfo(name)
+      info.external_attr = dirAttributes
+
+    self.out.writestr(info, '')
+
+  # Copies the compressed data of a member as is
+  def copyMember(self, name, srcInfo, srcFile):
+    self.addParents(name)
+
+    # Find the member data behind the local file header of the source
+    srcFile.seek(srcInfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, srcFile.read(zipfile.sizeFileHeader))
+    srcFile.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    info = zipfile.ZipInfo(name, srcInfo.date_time)
+    info.compress_type = srcInfo.compress_type
+    info.external_attr = srcInfo.external_attr
+    info.CRC = srcInfo.CRC
+    info.compress_size = srcInfo.compress_size
+    info.file_size = srcInfo.file_size
+
+    # The sizes are known, so no data descriptor is written after the data
+    info.flag_bits = srcInfo.flag_bits & ~0x08
+
+    fp = self.out.fp
+    info.header_offset = fp.tell()
+    fp.write(info.FileHeader())
+
+    remaining = srcInfo.compress_size
+    while remaining > 0:
+      block = srcFile.read(min(blockSize, remaining))
+      if len(block) == 0:
+        raise zipfile.BadZipfile('Truncated member "' + srcInfo.filename + '"')
+
+      fp.write(block)
+      remaining -= len(block)
+
+    instrument.count('bundles.bytesCopied', srcInfo.compress_size)
+
+    self.out.filelist.append(info)
+    self.out.NameToInfo[info.filename] = info
+    self.out._didModify = True
+
+  # Decompresses a member and adds it deflated
+  def recompressMember(self, name, srcInfo, src):
+    self.addParents(name)
+
+    info = zipfile.ZipInfo(name, srcInfo.date_time)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = srcInfo.external_attr
+
+    data = src.read(srcInfo)
+    self.out.writestr(info, data)
+
+    instrument.count('bundles.bytesDeflated', len(data))
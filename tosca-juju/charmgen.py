@@ -11,223 +11,287 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
-import os, zipfile, yaml, shutil
+import os, json, hashlib, shutil, multiprocessing, traceback
 
-class CharmGenerator:
-  def __init__(self, absCsarDir, model, charmsDir, charmSeries):
-    self.csarDir = absCsarDir
-	
-    self.charms = model['charms']
-  	
-    self.charmSeries = charmSeries
-  
-    self.charmsDir = charmsDir
-    self.helpersDir = 'helpers'
-  
-    self.scriptHead = '#!/bin/sh\n'
+from bundlecache import BundleCache, getBundleKey, getFileDigest, linkOrCopy
+from bundler import bundleArchives, bundleFiles
+from csarfile import CsarError
+from charmtpl import renderCharm
+import instrument
 
-    if os.path.isdir(self.charmsDir):
-      shutil.rmtree(self.charmsDir)
+# Raised if one or more charms could not be generated
+class CharmGenerationError(Exception):
+  def __init__(self, errors):
+    self.errors = errors # list of (charmName, formatted traceback)
 
-  # ...
-  def generate(self):
-    for charmName in self.charms.keys():
-      charm = self.charms[charmName]
-      charmDir = self.charmsDir + '/' + self.charmSeries + '/' + charmName
-    
-      os.makedirs(charmDir + '/hooks')
-      os.makedirs(charmDir + '/chef/roles')
-      
-      # Bundle cookbooks and role definitions
-      for cookbook in charm['cookbooks'].keys():
-        path = self.csarDir + '/' + charm['cookbooks'][cookbook]
-    
-        cbFile = zipfile.ZipFile(path)
-        cbFile.extractall(charmDir + '/chef/cookbooks/' + cookbook)
-        cbFile.close()
-    	
-        shutil.make_archive(charmDir + '/hooks/cookbooks', 'zip', charmDir + '/chef/cookbooks/')
-    
-      for rolePath in charm['roles'].values():
-        path = self.csarDir + '/' + rolePath
-    	
-        shutil.copy(path, charmDir + '/chef/roles/')
-        shutil.make_archive(charmDir + '/hooks/roles', 'zip', charmDir + '/chef/roles/')
-    
-      shutil.rmtree(charmDir + '/chef')
-    
-      # Build the manifest.yaml
-      charmManifest = {'name': charmName, 'summary': charm['summary'], 'maintainer': charm['maintainer'], 'description': charm['description']}
-      
-      if len(charm['requires']) > 0:
-        charmManifest['requires'] = {}
-        for req in charm['requires'].keys():
-          charmManifest['requires'][req] = {'interface': req}
-    
-      if len(charm['provides']) > 0:
-        charmManifest['provides'] = {}
-        for prov in charm['provides'].keys():
-          charmManifest['provides'][prov] = {'interface': prov}
-    	  
-      manifest = open(charmDir + '/metadata.yaml', 'w')
-      yaml.safe_dump(charmManifest, manifest, default_flow_style=False)
-      manifest.close()
-    
-      # Build the config.yaml
-      charmConfig = {'options': {}}
-      
-      for key in charm['properties'].keys():
-        value = charm['properties'][key]
-        charmConfig['options'][key] = {'type': 'string', 'default': value, 'description': key}
-      
-      config = open(charmDir + '/config.yaml', 'w')
-      yaml.safe_dump(charmConfig, config, default_flow_style=False)
-      config.close()
-      
-      # Place hook helpers
-      attrs = open(charmDir + '/hooks/attributes.json', 'w')
-      attrs.write('{ "run_list": [] }')
-      attrs.close()
-      
-      shutil.copy(self.helpersDir + '/run_chef_client.sh', charmDir + '/hooks/run_chef_client.sh')
-      os.chmod(charmDir + '/hooks/run_chef_client.sh', 0777)
-      
-      shutil.copy(self.helpersDir + '/update_attributes_json.rb', charmDir + '/hooks/update_attributes_json.rb')
-      os.chmod(charmDir + '/hooks/update_attributes_json.rb', 0777)
-      
-      shutil.copy(self.helpersDir + '/state_update_handler.rb', charmDir + '/hooks/state_update_handler.rb')
-      os.chmod(charmDir + '/hooks/state_update_handler.rb', 0777)
-      
-      # Properties and mappings to be included into the hooks
-      properties = '# Get properties\n'
-      for prop in charm['properties'].keys():
-        properties += prop + '="$(config-get ' + prop + ')"\n'
-    
-      mappings = ''
-      for mapping in charm['mappings'].keys():
-        mappings += '"' + charm['mappings'][mapping] + '=$' + mapping + '" '
+    message = str(len(errors)) + ' charm(s) could not be generated:'
+    for charmName, error in errors:
+      message += '\n\nCharm "' + charmName + '":\n' + error
 
-        if not mapping in charm['properties'].keys():
-          properties += mapping + '="undefined"\n'
-      
-      # Build the "install" hook
-      runListIncludes = '"run_list_include='
-      separator = ''
-      for entry in charm['runLists']['install']:
-        runListIncludes += separator + entry
-        separator = ','
-      runListIncludes += '"'
-      
-      install = open(charmDir + '/hooks/install', 'w')
-      install.write("""#!/bin/sh
+    Exception.__init__(self, message)
 
-set -eux
+# Generator used by the worker processes of the pool, set by initCharmWorker
+workerGenerator = None
 
-SCRIPT_DIR="$(dirname $0)"
+def initCharmWorker(generator):
+  global workerGenerator
+  workerGenerator = generator
 
-""" + properties + """
+  # Forget the counts inherited from the parent process
+  instrument.takeCounters()
 
-# Make dirs
-mkdir -p /var/chef/cookbooks
-mkdir -p /var/chef/roles
-mkdir -p /var/log/chef/resources-state
+# Returns (charmName, error, counters); the parent adds up the counters
+def generateCharmWorker(charmName):
+  return workerGenerator.tryGenerateCharm(charmName) + (instrument.takeCounters(),)
 
-# Place state handler and state file
-cp $SCRIPT_DIR/state_update_handler.rb /var/chef/
-echo 'success' > /var/chef/chef-client.state
+# Version of the generated charms; bump it whenever the charm content changes,
+# so that incremental runs do not keep charms generated by an older version
+charmFormat = '3'
 
-# Bootstrap Chef client
-curl -L http://www.opscode.com/chef/install.sh | sudo bash
+class CharmGenerator:
+  # csar is the CsarFile that holds the cookbooks and role definitions
+  def __init__(self, csar, model, charmsDir, charmSeries, workers=None, cacheDir=None, cacheSize=512 * 1024 * 1024, incremental=False):
+    self.csar = csar
+	
+    self.charms = model.charms
+  	
+    self.charmSeries = charmSeries
+  
+    self.charmsDir = charmsDir
+    self.helpersDir = os.path.dirname(os.path.abspath(__file__)) + '/helpers' # independent of the working directory
+    self.helperScripts = ['run_chef_client.sh', 'update_attributes_json.rb', 'state_update_handler.rb']
+    self.stagedHelpersDir = self.charmsDir + '/.charmgen-helpers'
 
-### TODO: Make this platform-independent, e.g., by including a corresponding Chef recipe
-apt-get -y install unzip
+    # Number of worker processes, defaults to the number of CPUs
+    if workers == None:
+      workers = multiprocessing.cpu_count()
 
-# Place cookbooks
-unzip -qq -o $SCRIPT_DIR/cookbooks.zip -d /var/chef/cookbooks
+    self.workers = max(1, workers)
 
-# Place roles
-unzip -qq -o $SCRIPT_DIR/roles.zip -d /var/chef/roles
+    # Cache for cookbook and role bundles; disabled if no directory is given
+    self.cache = None
+    if cacheDir != None:
+      self.cache = BundleCache(cacheDir, cacheSize)
 
-# Update attributes.json
-$SCRIPT_DIR/update_attributes_json.rb $SCRIPT_DIR/attributes.json """ + mappings + runListIncludes + """
+    # In incremental mode, charms whose inputs did not change since the last
+    # run are kept (see generate), otherwise all charms are built from scratch
+    self.incremental = incremental
+    self.manifestPath = self.charmsDir + '/.charmgen-manifest.json'
 
-# Run Chef client
-$SCRIPT_DIR/run_chef_client.sh
+    if not self.incremental and os.path.isdir(self.charmsDir):
+      shutil.rmtree(self.charmsDir)
 
-      """)
-      install.close()
+  # Returns the fingerprint of all inputs of the given charm: the charm model,
+  # the cookbook and role archives and the helper scripts
+  def getFingerprint(self, charmName):
+    charm = self.charms[charmName]
+    digest = hashlib.sha1()
+    
+    digest.update(charmFormat + '\0' + self.charmSeries + '\0' + charmName + '\0')
+    digest.update(json.dumps(charm.toDict(), sort_keys=True) + '\0')
+    
+    for path in sorted(charm.cookbooks.values()) + sorted(charm.roles.values()):
+      try:
+        memberDigest = self.csar.getDigest(path)
+      except CsarError:
+        # Reported when the charm is generated
+        memberDigest = 'missing'
       
-      solo = open(charmDir + '/hooks/solo.rb', 'w')
-      solo.write('file_cache_path "/var/chef"\n')
-      solo.write('cookbook_path "/var/chef/cookbooks"\n')
-      solo.write('role_path "/var/chef/roles"\n')
-      solo.write('require "/var/chef/state_update_handler.rb"\n')
-      solo.write('report_handlers << StateHandler::StateUpdate.new\n')
-      solo.write('exception_handlers << StateHandler::StateUpdate.new\n')
-      solo.close()
+      digest.update(path + '\0' + memberDigest + '\0')
+    
+    for script in self.helperScripts:
+      digest.update(script + '\0' + getFileDigest(self.helpersDir + '/' + script) + '\0')
+    
+    return digest.hexdigest()
+  
+  # Returns the fingerprints recorded by the last run, by charm name
+  def readManifest(self):
+    if not os.path.isfile(self.manifestPath):
+      return {}
+    
+    try:
+      manifestFile = open(self.manifestPath, 'r')
+      try:
+        manifest = json.load(manifestFile)
+      finally:
+        manifestFile.close()
+    except ValueError:
+      return {}
+    
+    if manifest.get('series') != self.charmSeries:
+      return {}
+    
+    return manifest.get('charms', {})
+  
+  # Records the fingerprints of the charms that are up to date
+  def writeManifest(self, fingerprints):
+    manifestFile = open(self.manifestPath + '.tmp', 'w')
+    try:
+      json.dump({'series': self.charmSeries, 'charms': fingerprints}, manifestFile, indent=2, sort_keys=True)
+    finally:
+      manifestFile.close()
+    
+    os.rename(self.manifestPath + '.tmp', self.manifestPath)
+  
+  # Generates all charms, using a pool of worker processes if more than one
+  # worker is configured. Charms that cannot be generated are reported
+  # together after all other charms have been generated. In incremental mode,
+  # only charms whose fingerprint changed are generated and only stale charm
+  # directories are removed.
+  def generate(self):
+    charmNames = sorted(self.charms.keys())
+    
+    # Create the common parent directory up front, so the workers do not race on it
+    seriesDir = self.charmsDir + '/' + self.charmSeries
+    if not os.path.isdir(seriesDir):
+      os.makedirs(seriesDir)
+    
+    self.stageHelpers()
+    
+    fingerprints = {}
+    
+    if self.incremental:
+      oldFingerprints = self.readManifest()
+      
+      for charmName in charmNames:
+        fingerprints[charmName] = self.getFingerprint(charmName)
+      
+      upToDate = [charmName for charmName in charmNames if oldFingerprints.get(charmName) == fingerprints[charmName] and os.path.isdir(seriesDir + '/' + charmName)]
       
-      # Build dummy hooks for "start" and "stop"
-      start = open(charmDir + '/hooks/start', 'w')
-      start.write(self.scriptHead)
-      start.close()
+      for dirName in os.listdir(seriesDir):
+        if not dirName in upToDate and os.path.isdir(seriesDir + '/' + dirName):
+          shutil.rmtree(seriesDir + '/' + dirName)
       
-      stop = open(charmDir + '/hooks/stop', 'w')
-      stop.write(self.scriptHead)
-      stop.close()
+      charmNames = [charmName for charmName in charmNames if not charmName in upToDate]
+      instrument.count('charms.upToDate', len(upToDate))
       
-      # Make hooks executable
-      os.chmod(charmDir + '/hooks/install', 0777)
-      os.chmod(charmDir + '/hooks/start', 0777)
-      os.chmod(charmDir + '/hooks/stop', 0777)
+      # Forget all fingerprints until the charms have been regenerated
+      self.writeManifest(dict((charmName, fingerprints[charmName]) for charmName in upToDate))
     
-      # Build the "relation-joined" hooks
-      def generateRelationJoinedHook(runList):
-        relationJoined = open(charmDir + '/hooks/' + relation + '-relation-joined', 'w')
-    	
-        if len(runList) > 0:
-          runListIncludes = '"run_list_include='
-          separator = ''
-          for entry in runList:
-            runListIncludes += separator + entry
-            separator = ','
-          runListIncludes += '"'
-    	  
-          relationJoined.write("""#!/bin/sh
+    workers = min(self.workers, len(charmNames))
     
-set -eux
+    if workers > 1:
+      pool = multiprocessing.Pool(workers, initCharmWorker, (self,))
+      try:
+        workerResults = pool.map(generateCharmWorker, charmNames, 1)
+        pool.close()
+      except:
+        pool.terminate()
+        raise
+      finally:
+        pool.join()
+      
+      results = []
+      for charmName, error, counters in workerResults:
+        instrument.addCounters(counters)
+        results.append((charmName, error))
+    else:
+      results = [self.tryGenerateCharm(charmName) for charmName in charmNames]
     
-SCRIPT_DIR="$(dirname $0)"
+    errors = [(charmName, error) for charmName, error in results if error != None]
     
-""" + properties + """
-PROVIDER="$(relation-get provider-address)"
+    if self.incremental:
+      failed = set(charmName for charmName, error in errors)
+      self.writeManifest(dict((charmName, fingerprint) for charmName, fingerprint in fingerprints.items() if not charmName in failed))
     
-### TODO: WORKAROUND FOR GETTING THE DB HOST ###
-VmMySql=$PROVIDER
+    if len(errors) > 0:
+      raise CharmGenerationError(errors)
+  
+  # Generates the charm with the given name. Returns (charmName, None) on
+  # success and (charmName, traceback) on failure, in which case the partially
+  # written charm directory is removed.
+  def tryGenerateCharm(self, charmName):
+    try:
+      self.generateCharm(charmName)
+      return (charmName, None)
+    except Exception:
+      error = traceback.format_exc()
+      
+      charmDir = self.charmsDir + '/' + self.charmSeries + '/' + charmName
+      if os.path.isdir(charmDir):
+        shutil.rmtree(charmDir, True)
+      
+      return (charmName, error)
+  
+  # Returns the cache key of the bundle built from the given entries, a list of
+  # (name in bundle, path in the CSAR), or None if caching is disabled
+  def getBundleKey(self, kind, entries):
+    if self.cache == None:
+      return None
     
-# Update attributes.json
-$SCRIPT_DIR/update_attributes_json.rb $SCRIPT_DIR/attributes.json """ + mappings + runListIncludes + """
+    return getBundleKey(kind, [(name, self.csar.getDigest(path)) for name, path in entries])
+  
+  # Places the cached bundle with the given key at the destination path; returns False on a cache miss
+  def fetchBundle(self, key, destPath):
+    if key != None and self.cache.fetch(key, destPath):
+      instrument.count('bundles.cached')
+      return True
     
-# Run Chef client
-$SCRIPT_DIR/run_chef_client.sh
-
-### TODO: WORKAROUND FOR OPENING THE PORT ###
-open-port 80/tcp
+    return False
+  
+  # Adds a freshly built bundle to the cache
+  def storeBundle(self, key, path):
+    if key != None and os.path.isfile(path):
+      self.cache.store(key, path)
+  
+  # Generates the charm with the given name
+  def generateCharm(self, charmName):
+    charm = self.charms[charmName]
+    charmDir = self.charmsDir + '/' + self.charmSeries + '/' + charmName
+  
+    os.makedirs(charmDir + '/hooks')
     
-exit 0
+    # Bundle cookbooks and role definitions, reusing bundles from the cache
+    cookbookEntries = [(cookbook, charm.cookbooks[cookbook]) for cookbook in charm.cookbooks.keys()]
+    roleEntries = [(os.path.basename(rolePath), rolePath) for rolePath in charm.roles.values()]
     
-          """)
-        else:
-          relationJoined.write(self.scriptHead)
-          relationJoined.write('relation-set provider-address="$(unit-get private-address)"\n')
+    cookbooksKey = self.getBundleKey('cookbooks', cookbookEntries)
+    rolesKey = self.getBundleKey('roles', roleEntries)
     
-        relationJoined.close()
+    if len(cookbookEntries) > 0 and not self.fetchBundle(cookbooksKey, charmDir + '/hooks/cookbooks.zip'):
+      # The cookbook archives are read from the CSAR one at a time
+      cookbookArchives = ((cookbook, self.csar.openInMemory(path)) for cookbook, path in sorted(cookbookEntries))
+      bundleArchives(charmDir + '/hooks/cookbooks.zip', cookbookArchives)
+      instrument.count('bundles.built')
+      instrument.count('bundles.bytesZipped', os.path.getsize(charmDir + '/hooks/cookbooks.zip'))
+      self.storeBundle(cookbooksKey, charmDir + '/hooks/cookbooks.zip')
     
-        os.chmod(charmDir + '/hooks/' + relation + '-relation-joined', 0777)
+    if len(roleEntries) > 0 and not self.fetchBundle(rolesKey, charmDir + '/hooks/roles.zip'):
+      roleFiles = [(name, self.csar.getInfo(path).date_time, self.csar.read(path)) for name, path in roleEntries]
+      bundleFiles(charmDir + '/hooks/roles.zip', roleFiles)
+      instrument.count('bundles.built')
+      instrument.count('bundles.bytesZipped', os.path.getsize(charmDir + '/hooks/roles.zip'))
+      self.storeBundle(rolesKey, charmDir + '/hooks/roles.zip')
+  
+    # Place hook helpers, hard linked to the copies staged by generate()
+    for script in self.helperScripts:
+      linkOrCopy(self.stagedHelpersDir + '/' + script, charmDir + '/hooks/' + script)
     
-      for relation in charm['requires'].keys():
-        runList = charm['requires'][relation]['runLists']['relationJoined']
-        generateRelationJoinedHook(runList)
+    # Write all other files, rendered in memory
+    self.writeFiles(charmDir, renderCharm(charmName, charm))
+  
+  # Writes the given files, a list of (path in the charm directory, content,
+  # executable), to the charm directory
+  def writeFiles(self, charmDir, files):
+    for name, data, executable in files:
+      fd = os.open(charmDir + '/' + name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0777 if executable else 0666)
+      charmFile = os.fdopen(fd, 'wb')
+      
+      try:
+        # Hooks must be executable regardless of the umask
+        if executable: os.fchmod(fd, 0777)
+        charmFile.write(data)
+      finally:
+        charmFile.close()
+  
+  # Copies the helper scripts into the charms directory once per run; the
+  # charms get hard links to these copies
+  def stageHelpers(self):
+    if not os.path.isdir(self.stagedHelpersDir):
+      os.makedirs(self.stagedHelpersDir)
     
-      for relation in charm['provides'].keys():
-        runList = charm['provides'][relation]['runLists']['relationJoined']
-        generateRelationJoinedHook(runList)
+    for script in self.helperScripts:
+      # Replace earlier copies instead of changing them, they may be linked from charms
+      shutil.copy(self.helpersDir + '/' + script, self.stagedHelpersDir + '/' + script + '.tmp')
+      os.chmod(self.stagedHelpersDir + '/' + script + '.tmp', 0777)
+      os.rename(self.stagedHelpersDir + '/' + script + '.tmp', self.stagedHelpersDir + '/' + script)
@@ -0,0 +1,205 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json, hashlib
+
+#
+# Charm-based model built by the model transformer. toDict() returns the
+# nested dicts the model has always been printed and stored as.
+#
+
+# Run list that keeps its entries in the order they were first added and
+# ignores entries it already has
+class RunList(object):
+  __slots__ = ('entries', 'included')
+
+  def __init__(self, entries=()):
+    self.entries = []
+    self.included = set()
+    self.extend(entries)
+
+  def extend(self, entries):
+    for entry in entries:
+      if not entry in self.included:
+        self.included.add(entry)
+        self.entries.append(entry)
+
+  def __iter__(self):
+    return iter(self.entries)
+
+  def __len__(self):
+    return len(self.entries)
+
+# Charm for all components hosted on one virtual machine
+class Charm(object):
+  __slots__ = ('vm', 'name', 'summary', 'maintainer', 'description', 'installRunList', 'deployedComponents', 'provides', 'requires', 'properties', 'cookbooks', 'roles', 'mappings')
+
+  def __init__(self, vm, name, summary):
+    # Only used during the transformation
+    self.vm = vm
+    self.name = name
+
+    self.summary = summary
+    self.maintainer = None
+    self.description = None
+
+    self.installRunList = RunList() # run list of the "install" hook
+    self.deployedComponents = [] # list of {'id', 'name', 'type'}
+    self.provides = {} # relation name -> run list of the "relation-joined" hook
+    self.requires = {} # relation name -> run list of the "relation-joined" hook
+    self.properties = {} # property name -> default value
+    self.cookbooks = {} # cookbook name -> location in the CSAR
+    self.roles = {} # role name -> location in the CSAR
+    self.mappings = {} # property name -> cookbook attribute
+
+  def toDict(self):
+    return {
+      'summary': self.summary,
+      'maintainer': self.maintainer,
+      'description': self.description,
+      'runLists': {'install': list(self.installRunList)},
+      'deployedComponents': [dict(component) for component in self.deployedComponents],
+      'provides': dict((name, {'runLists': {'relationJoined': list(runList)}}) for name, runList in self.provides.items()),
+      'requires': dict((name, {'runLists': {'relationJoined': list(runList)}}) for name, runList in self.requires.items()),
+      'properties': dict(self.properties),
+      'cookbooks': dict(self.cookbooks),
+      'roles': dict(self.roles),
+      'mappings': dict(self.mappings)
+    }
+
+  @staticmethod
+  def fromDict(name, charmDict):
+    charm = Charm(None, name, charmDict['summary'])
+    charm.maintainer = charmDict['maintainer']
+    charm.description = charmDict['description']
+    charm.installRunList = RunList(charmDict['runLists']['install'])
+    charm.deployedComponents = [dict(component) for component in charmDict['deployedComponents']]
+    charm.provides = dict((relName, RunList(endpoint['runLists']['relationJoined'])) for relName, endpoint in charmDict['provides'].items())
+    charm.requires = dict((relName, RunList(endpoint['runLists']['relationJoined'])) for relName, endpoint in charmDict['requires'].items())
+    charm.properties = dict(charmDict['properties'])
+    charm.cookbooks = dict(charmDict['cookbooks'])
+    charm.roles = dict(charmDict['roles'])
+    charm.mappings = dict(charmDict['mappings'])
+
+    return charm
+
+  # Returns a hash of the content of the generated charm, leaving out what
+  # only tells the VMs apart: the summary, the description and the ids and
+  # names of the deployed components. Charms with the same key host the same
+  # stack.
+  def getContentKey(self):
+    content = {
+      'maintainer': self.maintainer,
+      'runLists': {'install': list(self.installRunList)},
+      'componentTypes': [component['type'] for component in self.deployedComponents],
+      'provides': dict((name, list(runList)) for name, runList in self.provides.items()),
+      'requires': dict((name, list(runList)) for name, runList in self.requires.items()),
+      'properties': self.properties,
+      'cookbooks': self.cookbooks,
+      'roles': self.roles,
+      'mappings': self.mappings
+    }
+
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+# Deployment topology: the charm of every virtual machine and the relations
+# between charm endpoints ("charm:relation")
+class Topology(object):
+  __slots__ = ('nodes', 'relations')
+
+  def __init__(self):
+    self.nodes = {} # VM id -> charm name; a charm gets a unit per VM
+    self.relations = {} # source endpoint -> target endpoint
+
+  # Returns the number of units of every charm by charm name
+  def getUnits(self):
+    units = {}
+
+    for charmName in self.nodes.values():
+      units[charmName] = units.get(charmName, 0) + 1
+
+    return units
+
+  def toDict(self):
+    return {'nodes': dict((vmId, {'charm': charmName}) for vmId, charmName in self.nodes.items()), 'relations': dict(self.relations)}
+
+  @staticmethod
+  def fromDict(topologyDict):
+    topology = Topology()
+    topology.nodes = dict((vmId, node['charm']) for vmId, node in topologyDict['nodes'].items())
+    topology.relations = dict(topologyDict['relations'])
+
+    return topology
+
+class Model(object):
+  __slots__ = ('charms', 'topology')
+
+  def __init__(self):
+    self.charms = {} # charm name -> Charm
+    self.topology = Topology()
+
+  def toDict(self):
+    return {'charms': dict((charmName, charm.toDict()) for charmName, charm in self.charms.items()), 'topology': self.topology.toDict()}
+
+  # Merges charms that host the same stack (see Charm.getContentKey) and
+  # require the same relations into one charm, which gets a unit for each VM
+  # of the merged charms; the first name in sorted order is kept. Charms that
+  # provide a relation are never merged: every unit of a requiring charm
+  # would be related to all of their units. Returns the name of the charm
+  # that every merged charm went into.
+  def deduplicate(self):
+    providers = set(target.split(':')[0] for target in self.topology.relations.values())
+
+    required = {} # charm name -> list of (relation name, target endpoint)
+    for source, target in self.topology.relations.items():
+      charmName, separator, relName = source.partition(':')
+      required.setdefault(charmName, []).append((relName, target))
+
+    groups = {}
+    for charmName in sorted(self.charms.keys()):
+      if charmName in providers:
+        continue
+
+      key = (self.charms[charmName].getContentKey(), tuple(sorted(required.get(charmName, []))))
+      groups.setdefault(key, []).append(charmName)
+
+    merged = {}
+    for charmNames in groups.values():
+      for charmName in charmNames[1:]:
+        merged[charmName] = charmNames[0]
+        del self.charms[charmName]
+
+    if len(merged) == 0:
+      return merged
+
+    # Rewire the topology; the relations of merged charms coincide
+    for vmId, charmName in self.topology.nodes.items():
+      self.topology.nodes[vmId] = merged.get(charmName, charmName)
+
+    relations = {}
+    for source, target in self.topology.relations.items():
+      charmName, separator, relName = source.partition(':')
+      relations[merged.get(charmName, charmName) + ':' + relName] = target
+
+    self.topology.relations = relations
+
+    return merged
+
+  # Returns the model stored as dicts, e.g. loaded from the YAML output
+  @staticmethod
+  def fromDict(modelDict):
+    model = Model()
+    model.charms = dict((charmName, Charm.fromDict(charmName, charmDict)) for charmName, charmDict in modelDict['charms'].items())
+    model.topology = Topology.fromDict(modelDict['topology'])
+
+    return model
@@ -0,0 +1,266 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import yaml
+
+#
+# Content of the generated charms. Every file of a charm is rendered in
+# memory by renderCharm(); the hook scripts are filled in from the templates
+# below, with the fragments that depend on the charm (properties, mappings)
+# rendered once per charm. Bump charmgen.charmFormat whenever the content
+# changes.
+#
+
+scriptHead = '#!/bin/sh\n'
+
+installTemplate = """#!/bin/sh
+
+set -eux
+
+SCRIPT_DIR="$(dirname $0)"
+
+%(properties)s
+
+# Make dirs
+mkdir -p /var/chef/cookbooks
+mkdir -p /var/chef/roles
+mkdir -p /var/log/chef/resources-state
+
+# Place state handler and state file
+cp $SCRIPT_DIR/state_update_handler.rb /var/chef/
+echo 'success' > /var/chef/chef-client.state
+
+# Bootstrap Chef client
+curl -L http://www.opscode.com/chef/install.sh | sudo bash
+
+### TODO: Make this platform-independent, e.g., by including a corresponding Chef recipe
+apt-get -y install unzip
+
+# Place cookbooks
+unzip -qq -o $SCRIPT_DIR/cookbooks.zip -d /var/chef/cookbooks
+
+# Place roles
+unzip -qq -o $SCRIPT_DIR/roles.zip -d /var/chef/roles
+
+# Update attributes.json
+$SCRIPT_DIR/update_attributes_json.rb $SCRIPT_DIR/attributes.json %(mappings)s%(runListIncludes)s
+
+# Run Chef client
+$SCRIPT_DIR/run_chef_client.sh
+
+      """
+
+# Applies the properties changed by juju set since the last run. The
+# attributes set by the relation hooks stay as they are; the first run right
+# after install only records the values the install hook applied.
+configChangedTemplate = """#!/bin/sh
+
+set -eux
+
+SCRIPT_DIR="$(dirname $0)"
+CONFIG_DIR=/var/chef/charm-config
+
+%(properties)s
+
+# Collect the mappings of the properties changed since the last run
+set --
+%(changes)s
+# The first run follows the install hook, which applied all of them
+if [ ! -d $CONFIG_DIR ]; then
+  mkdir -p $CONFIG_DIR
+  set --
+fi
+
+if [ $# -gt 0 ]; then
+  # Update attributes.json
+  $SCRIPT_DIR/update_attributes_json.rb $SCRIPT_DIR/attributes.json "$@"
+
+  # Run Chef client
+  $SCRIPT_DIR/run_chef_client.sh
+fi
+
+# Record the applied values
+%(record)s"""
+
+# Puts the cookbooks and roles of the new charm in place. The attributes of
+# the old charm, including those set by the relation hooks, are restored from
+# the copy run_chef_client.sh keeps, since the upgrade replaces attributes.json.
+upgradeCharmTemplate = """#!/bin/sh
+
+set -eux
+
+SCRIPT_DIR="$(dirname $0)"
+CONFIG_DIR=/var/chef/charm-config
+
+%(properties)s
+
+# Restore the attributes of the old charm
+if [ -f /var/chef/attributes.json ]; then
+  cp /var/chef/attributes.json $SCRIPT_DIR/attributes.json
+fi
+
+# Place state handler
+cp $SCRIPT_DIR/state_update_handler.rb /var/chef/
+
+# Place cookbooks
+unzip -qq -o $SCRIPT_DIR/cookbooks.zip -d /var/chef/cookbooks
+
+# Place roles
+unzip -qq -o $SCRIPT_DIR/roles.zip -d /var/chef/roles
+
+# Update attributes.json
+$SCRIPT_DIR/update_attributes_json.rb $SCRIPT_DIR/attributes.json %(mappings)s%(runListIncludes)s
+
+# Run Chef client
+$SCRIPT_DIR/run_chef_client.sh
+
+# Record the applied values
+mkdir -p $CONFIG_DIR
+%(record)s"""
+
+relationJoinedTemplate = """#!/bin/sh
+    
+set -eux
+    
+SCRIPT_DIR="$(dirname $0)"
+    
+%(properties)s
+PROVIDER="$(relation-get provider-address)"
+    
+### TODO: WORKAROUND FOR GETTING THE DB HOST ###
+VmMySql=$PROVIDER
+    
+# Update attributes.json
+$SCRIPT_DIR/update_attributes_json.rb $SCRIPT_DIR/attributes.json %(mappings)s%(runListIncludes)s
+    
+# Run Chef client
+$SCRIPT_DIR/run_chef_client.sh
+
+### TODO: WORKAROUND FOR OPENING THE PORT ###
+open-port 80/tcp
+    
+exit 0
+    
+          """
+
+providerRelationJoined = scriptHead + 'relation-set provider-address="$(unit-get private-address)"\n'
+
+soloRb = ''.join([
+  'file_cache_path "/var/chef"\n',
+  'cookbook_path "/var/chef/cookbooks"\n',
+  'role_path "/var/chef/roles"\n',
+  'require "/var/chef/state_update_handler.rb"\n',
+  'report_handlers << StateHandler::StateUpdate.new\n',
+  'exception_handlers << StateHandler::StateUpdate.new\n'
+])
+
+attributesJson = '{ "run_list": [] }'
+
+# Returns the shell assignments of the charm properties and the arguments of
+# update_attributes_json.rb that map them to cookbook attributes
+def renderPropertyFragments(charm):
+  properties = '# Get properties\n'
+  for prop in charm.properties.keys():
+    properties += prop + '="$(config-get ' + prop + ')"\n'
+
+  mappings = ''
+  for mapping in charm.mappings.keys():
+    mappings += '"' + charm.mappings[mapping] + '=$' + mapping + '" '
+
+    if not mapping in charm.properties:
+      properties += mapping + '="undefined"\n'
+
+  return properties, mappings
+
+# Returns the fragments of the config-changed and upgrade-charm hooks: the
+# shell assignments of the charm properties, the arguments of
+# update_attributes_json.rb for the mapped properties, the commands that
+# collect the mappings of the properties changed since they were recorded and
+# the commands that record them. Mappings without a property are left out;
+# the relation hooks fill them in.
+def renderConfigFragments(charm):
+  properties = '# Get properties\n'
+  for prop in charm.properties.keys():
+    properties += prop + '="$(config-get ' + prop + ')"\n'
+
+  mappings = ''
+  changes = ''
+  record = ''
+  for mapping in charm.mappings.keys():
+    if not mapping in charm.properties:
+      continue
+
+    argument = '"' + charm.mappings[mapping] + '=$' + mapping + '"'
+    mappings += argument + ' '
+    changes += 'if [ ! -f $CONFIG_DIR/' + mapping + ' ] || [ "$(cat $CONFIG_DIR/' + mapping + ')" != "$' + mapping + '" ]; then\n'
+    changes += '  set -- "$@" ' + argument + '\n'
+    changes += 'fi\n'
+    record += 'printf \'%s\' "$' + mapping + '" > $CONFIG_DIR/' + mapping + '\n'
+
+  return properties, mappings, changes, record
+
+# Returns the argument of update_attributes_json.rb for the given run list
+def renderRunListIncludes(runList):
+  return '"run_list_include=' + ','.join(runList) + '"'
+
+# Returns all files of the given charm except the cookbook and role bundles
+# and the helper scripts, as list of (path in the charm directory, content,
+# executable)
+def renderCharm(charmName, charm):
+  files = []
+
+  # metadata.yaml
+  charmManifest = {'name': charmName, 'summary': charm.summary, 'maintainer': charm.maintainer, 'description': charm.description}
+
+  if len(charm.requires) > 0:
+    charmManifest['requires'] = dict((req, {'interface': req}) for req in charm.requires.keys())
+
+  if len(charm.provides) > 0:
+    charmManifest['provides'] = dict((prov, {'interface': prov}) for prov in charm.provides.keys())
+
+  files.append(('metadata.yaml', yaml.safe_dump(charmManifest, default_flow_style=False), False))
+
+  # config.yaml
+  charmConfig = {'options': {}}
+
+  for key in charm.properties.keys():
+    charmConfig['options'][key] = {'type': 'string', 'default': charm.properties[key], 'description': key}
+
+  files.append(('config.yaml', yaml.safe_dump(charmConfig, default_flow_style=False), False))
+
+  # Hooks
+  properties, mappings = renderPropertyFragments(charm)
+
+  install = installTemplate % {'properties': properties, 'mappings': mappings, 'runListIncludes': renderRunListIncludes(charm.installRunList)}
+
+  files.append(('hooks/attributes.json', attributesJson, False))
+  files.append(('hooks/install', install, True))
+  configProperties, configMappings, changes, record = renderConfigFragments(charm)
+  files.append(('hooks/config-changed', configChangedTemplate % {'properties': configProperties, 'changes': changes, 'record': record}, True))
+  files.append(('hooks/upgrade-charm', upgradeCharmTemplate % {'properties': configProperties, 'mappings': configMappings, 'runListIncludes': renderRunListIncludes(charm.installRunList), 'record': record}, True))
+  files.append(('hooks/solo.rb', soloRb, False))
+  files.append(('hooks/start', scriptHead, True))
+  files.append(('hooks/stop', scriptHead, True))
+
+  for relations in [charm.requires, charm.provides]:
+    for relation in relations.keys():
+      runList = relations[relation]
+
+      if len(runList) > 0:
+        hook = relationJoinedTemplate % {'properties': properties, 'mappings': mappings, 'runListIncludes': renderRunListIncludes(runList)}
+      else:
+        hook = providerRelationJoined
+
+      files.append(('hooks/' + relation + '-relation-joined', hook, True))
+
+  return files
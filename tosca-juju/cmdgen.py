@@ -11,27 +11,324 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import os, json
+
+from executor import getPositionalArgs, getDeployedService
+
+# Single step of a deployment plan: a juju command plus the ids of the steps
+# that must have completed before it can run
+class PlanStep(object):
+  __slots__ = ('id', 'kind', 'charm', 'command', 'dependsOn', 'redundant')
+
+  def __init__(self, id, kind, charm, command, dependsOn, redundant=False):
+    self.id = id
+    self.kind = kind # 'deploy', 'add-relation', 'expose' or, in delta plans, 'destroy-service', 'remove-relation', 'upgrade-charm', 'set' or 'add-unit'
+    self.charm = charm
+    self.command = command
+    self.dependsOn = dependsOn
+    self.redundant = redundant
+
+  def toDict(self):
+    return {'id': self.id, 'kind': self.kind, 'charm': self.charm, 'command': self.command, 'dependsOn': self.dependsOn, 'redundant': self.redundant}
+
+  @staticmethod
+  def fromDict(step):
+    return PlanStep(step['id'], step['kind'], step['charm'], step['command'], step['dependsOn'], step.get('redundant', False))
+
+# Deployment plan with explicit dependencies between its steps
+class CommandPlan(object):
+  def __init__(self, steps):
+    self.steps = steps
+    self.stepsById = dict((step.id, step) for step in steps)
+
+  # Returns the plan as JSON
+  def toJson(self):
+    return json.dumps({'steps': [step.toDict() for step in self.steps]}, indent=2, sort_keys=True)
+
+  # Returns the plan stored as JSON
+  @staticmethod
+  def fromJson(data):
+    return CommandPlan([PlanStep.fromDict(step) for step in json.loads(data)['steps']])
+
+  # Returns the steps grouped into waves: every step only depends on steps
+  # of earlier waves, so the steps of one wave can run concurrently
+  def getWaves(self):
+    waveOf = {}
+    waves = []
+
+    pending = dict((step.id, len(step.dependsOn)) for step in self.steps)
+    dependents = dict((step.id, []) for step in self.steps)
+
+    for step in self.steps:
+      for dep in step.dependsOn:
+        dependents[dep].append(step)
+
+    wave = [step for step in self.steps if pending[step.id] == 0]
+
+    while len(wave) > 0:
+      waves.append(wave)
+      nextWave = []
+
+      for step in wave:
+        for dependent in dependents[step.id]:
+          pending[dependent.id] -= 1
+          if pending[dependent.id] == 0: nextWave.append(dependent)
+
+      wave = nextWave
+
+    if sum(len(wave) for wave in waves) != len(self.steps):
+      raise ValueError('The plan contains a dependency cycle.')
+
+    return waves
+
+  # Returns the commands of all steps, optionally leaving out redundant ones
+  def getCommands(self, skipRedundant=False):
+    return [step.command for step in self.steps if not (skipRedundant and step.redundant)]
+
+# Returns the deployment described by juju commands: the charm and number of
+# units of every service, the relations as sorted endpoint pairs and the
+# exposed services
+def describeCommands(commands):
+  services = {}
+  relations = set()
+  exposed = set()
+
+  for cmd in commands:
+    args = getPositionalArgs(cmd)
+
+    if cmd[1] == 'deploy':
+      units = 1
+      for option in ('-n', '--num-units'):
+        if option in cmd: units = int(cmd[cmd.index(option) + 1])
+
+      services[getDeployedService(cmd)] = {'charm': args[0], 'units': units}
+    elif cmd[1] == 'add-relation':
+      relations.add(tuple(sorted(args)))
+    elif cmd[1] == 'expose':
+      exposed.add(args[0])
+
+  return {'services': services, 'relations': relations, 'exposed': exposed}
+
+# Returns the deployment described by a juju-deployer configuration, in the
+# form of describeCommands
+def describeBundle(bundle):
+  deployment = bundle.values()[0]
+  services = {}
+
+  for name, service in deployment['services'].items():
+    services[name] = {'charm': service['charm'], 'units': service.get('num_units', 1)}
+
+  return {
+    'services': services,
+    'relations': set(tuple(sorted(relation)) for relation in deployment.get('relations', [])),
+    'exposed': set(name for name, service in deployment['services'].items() if service.get('expose', False))
+  }
+
+# Returns the differences between the deployments described by a bundle and
+# by a list of commands, as list of messages; empty if they agree
+def compareBundle(bundle, commands):
+  fromBundle = describeBundle(bundle)
+  fromCommands = describeCommands(commands)
+  differences = []
+
+  for name in sorted(set(fromBundle['services'].keys()) | set(fromCommands['services'].keys())):
+    if fromBundle['services'].get(name) != fromCommands['services'].get(name):
+      differences.append('Service "' + name + '": ' + str(fromBundle['services'].get(name)) + ' in the bundle, ' + str(fromCommands['services'].get(name)) + ' in the commands.')
+
+  for relation in sorted(fromBundle['relations'] ^ fromCommands['relations']):
+    differences.append('Relation ' + ' - '.join(relation) + ' only ' + ('in the bundle.' if relation in fromBundle['relations'] else 'in the commands.'))
+
+  for name in sorted(fromBundle['exposed'] ^ fromCommands['exposed']):
+    differences.append('Service "' + name + '" only exposed ' + ('in the bundle.' if name in fromBundle['exposed'] else 'in the commands.'))
+
+  return differences
+
 class CommandGenerator:
   def __init__(self, model, charmsDir, charmSeries, jujuEnv):    
-    self.charms = model['charms']
-    self.topology = model['topology']
+    self.charms = model.charms
+    self.topology = model.topology
     
     self.charmsDir = charmsDir
     self.charmSeries = charmSeries
     self.jujuEnv = jujuEnv
 
+  # Returns the command that deploys the given charm with the given number
+  # of units
+  def getDeployCommand(self, charmName, units=1):
+    command = ['juju', 'deploy', '--repository', self.charmsDir, 'local:' + self.charmSeries + '/' + charmName, '-e', self.jujuEnv]
+
+    if units > 1:
+      command[2:2] = ['-n', str(units)]
+
+    return command
+
+  # Returns the names of the charms in the order of their first VM
+  def getCharmNames(self):
+    charmNames = []
+    seen = set()
+
+    for charmName in self.topology.nodes.values():
+      if not charmName in seen:
+        seen.add(charmName)
+        charmNames.append(charmName)
+
+    return charmNames
+
   # ...
   def generate(self):
     commands = []
+    units = self.topology.getUnits()
 
-    for node in self.topology['nodes'].values():
-      commands.append(['juju', 'deploy', '--repository', self.charmsDir, 'local:' + self.charmSeries + '/' + node['charm'], '-e', self.jujuEnv])
+    for charmName in self.getCharmNames():
+      commands.append(self.getDeployCommand(charmName, units[charmName]))
     
-    for relSource in self.topology['relations'].keys():
-      relTarget = self.topology['relations'][relSource]
+    for relSource in self.topology.relations.keys():
+      relTarget = self.topology.relations[relSource]
       commands.append(['juju', 'add-relation', relSource, relTarget, '-e', self.jujuEnv])
 
-    for node in self.topology['nodes'].values():
-      commands.append(['juju', 'expose', node['charm'], '-e', self.jujuEnv])
+    for charmName in self.getCharmNames():
+      commands.append(['juju', 'expose', charmName, '-e', self.jujuEnv])
+
+    return commands
+
+  # Returns the commands as a CommandPlan with explicit dependencies: relations
+  # depend on the deployment of both charms, exposing a charm depends on its
+  # deployment. Exposing a charm that provides no relations is flagged as
+  # redundant.
+  def generatePlan(self):
+    steps = []
+    charmNames = sorted(set(self.topology.nodes.values()))
+    units = self.topology.getUnits()
+
+    for charmName in charmNames:
+      command = self.getDeployCommand(charmName, units[charmName])
+      steps.append(PlanStep('deploy:' + charmName, 'deploy', charmName, command, []))
+
+    for relSource in sorted(self.topology.relations.keys()):
+      relTarget = self.topology.relations[relSource]
+      endpoints = [relSource.split(':')[0], relTarget.split(':')[0]]
+
+      command = ['juju', 'add-relation', relSource, relTarget, '-e', self.jujuEnv]
+      dependsOn = ['deploy:' + charmName for charmName in sorted(set(endpoints)) if charmName in charmNames]
+      steps.append(PlanStep('add-relation:' + relSource + ':' + relTarget, 'add-relation', None, command, dependsOn))
+
+    for charmName in charmNames:
+      command = ['juju', 'expose', charmName, '-e', self.jujuEnv]
+      redundant = len(self.charms[charmName].provides) == 0
+      steps.append(PlanStep('expose:' + charmName, 'expose', charmName, command, ['deploy:' + charmName], redundant))
+
+    return CommandPlan(steps)
+
+  # Returns the plan that turns the deployment of deployedModel, an earlier
+  # model deployed from the same charms directory, into the deployment of
+  # this model, with only the commands needed for the differences: charms
+  # that are gone are destroyed and new ones deployed, changed charms are
+  # upgraded, changed property defaults are set and relations are added or
+  # removed. Charms that lost units are deployed anew, as the units to remove
+  # cannot be told from the models; their deployment depends on destroying
+  # them, which the executor only finishes once the service is gone.
+  def generateDeltaPlan(self, deployedModel):
+    steps = []
+    stepIds = set()
+
+    def addStep(id, kind, charmName, command, dependsOn, redundant=False):
+      steps.append(PlanStep(id, kind, charmName, command, [dep for dep in dependsOn if dep in stepIds], redundant))
+      stepIds.add(id)
+
+    units = self.topology.getUnits()
+    deployedUnits = deployedModel.topology.getUnits()
+
+    relations = set(self.topology.relations.items())
+    deployedRelations = set(deployedModel.topology.relations.items())
+
+    # Charms that are deployed from scratch, and those of them that are deployed already
+    redeployed = set(charmName for charmName in units if charmName in deployedUnits and units[charmName] < deployedUnits[charmName])
+    added = set(charmName for charmName in units if not charmName in deployedUnits) | redeployed
+
+    def involves(relation, charmName):
+      return charmName in [endpoint.split(':')[0] for endpoint in relation]
+
+    for relSource, relTarget in sorted(deployedRelations - relations):
+      if len([charmName for charmName in added | (set(deployedUnits) - set(units)) if involves((relSource, relTarget), charmName)]) > 0:
+        continue # destroyed along with the service
+
+      command = ['juju', 'remove-relation', relSource, relTarget, '-e', self.jujuEnv]
+      addStep('remove-relation:' + relSource + ':' + relTarget, 'remove-relation', None, command, [])
+
+    for charmName in sorted(set(deployedUnits) - set(units)) + sorted(redeployed):
+      command = ['juju', 'destroy-service', charmName, '-e', self.jujuEnv]
+      addStep('destroy-service:' + charmName, 'destroy-service', charmName, command, [])
+
+    for charmName in sorted(added):
+      addStep('deploy:' + charmName, 'deploy', charmName, self.getDeployCommand(charmName, units[charmName]), ['destroy-service:' + charmName])
+
+    for charmName in sorted(set(units) - added):
+      charm = self.charms[charmName].toDict()
+      deployedCharm = deployedModel.charms[charmName].toDict()
+
+      # Property defaults alone are set, everything else needs the new charm
+      properties = charm.pop('properties')
+      deployedProperties = deployedCharm.pop('properties')
+      charm.pop('description')
+      deployedCharm.pop('description')
+
+      if charm != deployedCharm or sorted(properties.keys()) != sorted(deployedProperties.keys()):
+        command = ['juju', 'upgrade-charm', '--repository', self.charmsDir, charmName, '-e', self.jujuEnv]
+        dependsOn = [step.id for step in steps if step.kind == 'remove-relation' and involves(step.command[2:4], charmName)]
+        addStep('upgrade-charm:' + charmName, 'upgrade-charm', charmName, command, dependsOn)
+
+      # Only the properties the hooks map to attributes change the service
+      changed = [key for key in sorted(properties.keys()) if properties[key] != deployedProperties.get(key) and key in self.charms[charmName].mappings]
+      if len(changed) > 0:
+        command = ['juju', 'set', charmName] + [key + '=' + (properties[key] or '') for key in changed] + ['-e', self.jujuEnv]
+        addStep('set:' + charmName, 'set', charmName, command, ['upgrade-charm:' + charmName])
+
+      if units[charmName] > deployedUnits[charmName]:
+        command = ['juju', 'add-unit', '-n', str(units[charmName] - deployedUnits[charmName]), charmName, '-e', self.jujuEnv]
+        addStep('add-unit:' + charmName, 'add-unit', charmName, command, ['upgrade-charm:' + charmName])
+
+    for relSource, relTarget in sorted(relations):
+      if (relSource, relTarget) in deployedRelations and len([charmName for charmName in added if involves((relSource, relTarget), charmName)]) == 0:
+        continue
+
+      command = ['juju', 'add-relation', relSource, relTarget, '-e', self.jujuEnv]
+      endpoints = sorted(set([relSource.split(':')[0], relTarget.split(':')[0]]))
+      dependsOn = ['deploy:' + charmName for charmName in endpoints] + ['upgrade-charm:' + charmName for charmName in endpoints]
+      addStep('add-relation:' + relSource + ':' + relTarget, 'add-relation', None, command, dependsOn)
+
+    for charmName in sorted(added):
+      command = ['juju', 'expose', charmName, '-e', self.jujuEnv]
+      redundant = len(self.charms[charmName].provides) == 0
+      addStep('expose:' + charmName, 'expose', charmName, command, ['deploy:' + charmName], redundant)
+
+    return CommandPlan(steps)
+
+  # Returns the whole deployment as juju-deployer configuration with the
+  # given deployment name: a unit of every charm per VM, configured with the
+  # property defaults of the charm, the relations and the exposed charms.
+  # Like the plan, it can leave out exposing charms that provide no
+  # relations.
+  def generateBundle(self, name, skipRedundant=False):
+    services = {}
+    units = self.topology.getUnits()
+
+    for charmName in sorted(units.keys()):
+      charm = self.charms[charmName]
+      service = {'charm': 'local:' + self.charmSeries + '/' + charmName, 'num_units': units[charmName]}
+
+      if len(charm.properties) > 0:
+        service['options'] = dict(charm.properties)
+
+      if not (skipRedundant and len(charm.provides) == 0):
+        service['expose'] = True
+
+      services[charmName] = service
+
+    relations = [[relSource, self.topology.relations[relSource]] for relSource in sorted(self.topology.relations.keys())]
+
+    return {name: {'series': self.charmSeries, 'services': services, 'relations': relations}}
 
-    return commands
\ No newline at end of file
+  # Returns the command that applies the bundle written to the given path;
+  # juju-deployer finds the local charms through JUJU_REPOSITORY
+  def generateBundleCommand(self, bundlePath, name, deployer='juju-deployer'):
+    return ['env', 'JUJU_REPOSITORY=' + os.path.abspath(self.charmsDir), deployer, '-c', bundlePath, '-e', self.jujuEnv, name]
@@ -11,53 +11,210 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
-import yaml, subprocess, sys
+import os, yaml, sys, time, shlex, argparse, multiprocessing
 
+from csarfile import CsarFile, CsarError
 from modeltrans import ModelTransformer
-from charmgen import CharmGenerator
-from cmdgen import CommandGenerator
+from tplcache import TemplateCache
+from tplloader import TemplateOverrideError
+from charmmodel import Model
+from charmgen import CharmGenerator, CharmGenerationError
+from cmdgen import CommandGenerator, compareBundle
+from executor import CommandExecutor, printReport
+from monitor import DeploymentMonitor
+import instrument
 
 #
 # create-instance.py SugarCRM_ChefManaged.zip service-template/SugarCRM-ServiceTemplate.xml hpcloud
+# create-instance.py SugarCRM_ChefManaged.zip hpcloud
+# create-instance.py --set SugarCrmDb:DBName=crm2 SugarCRM_ChefManaged.zip hpcloud
+# create-instance.py --bundle sugarcrm.yaml SugarCRM_ChefManaged.zip hpcloud
+# create-instance.py --full SugarCRM_ChefManaged.zip hpcloud
+# create-instance.py --dedupe SugarCRM_ChefManaged.zip hpcloud
 #
 
-csarFile = sys.argv[1]
-serviceTpl = sys.argv[2]
-jujuEnv = sys.argv[3]
+# Returns the property overrides given as "node:property=value"
+def parseOverrides(settings):
+  overrides = {}
 
-csarDir = 'csar'
+  for setting in settings:
+    target, separator, value = setting.partition('=')
+    nodeId, colon, name = target.partition(':')
+
+    if separator == '' or colon == '' or nodeId == '' or name == '':
+      print 'Invalid property override "' + setting + '", expected "node:property=value".'
+      sys.exit(1)
+
+    overrides.setdefault(nodeId, {})[name] = value
+
+  return overrides
+
+parser = argparse.ArgumentParser(description='Transform a TOSCA CSAR into Juju charms and deploy them.')
+parser.add_argument('csarFile', help='TOSCA Cloud Service Archive (CSAR)')
+parser.add_argument('serviceTpl', nargs='?', help='path of the service template inside the CSAR (default: as named by its manifest)')
+parser.add_argument('jujuEnv', help='Juju environment to deploy to')
+parser.add_argument('--loader', choices=['dom', 'stream'], default='dom', help='service template loader (default: dom)')
+parser.add_argument('--set', action='append', default=[], metavar='NODE:PROPERTY=VALUE', help='override the default of a node template property; can be given more than once')
+parser.add_argument('--template-cache', metavar='DIR', help='keep parsed service templates in DIR for later runs')
+parser.add_argument('--dedupe', action='store_true', help='deploy VMs that host the same stack as units of one charm instead of generating a charm per VM')
+parser.add_argument('--workers', type=int, default=None, help='number of processes used to transform large topologies and to generate charms (default: number of CPUs)')
+parser.add_argument('--serial-transform', action='store_true', help='transform the topology in this process only, e.g. for debugging')
+parser.add_argument('--cache-dir', default='cache', help='directory for cached cookbook and role bundles (default: cache)')
+parser.add_argument('--cache-size', type=int, default=512, help='maximum size of the bundle cache in MB (default: 512)')
+parser.add_argument('--no-cache', action='store_true', help='do not use the bundle cache')
+parser.add_argument('--rebuild', action='store_true', help='regenerate all charms, even if their inputs did not change')
+parser.add_argument('--concurrency', type=int, default=4, help='maximum number of juju commands run at the same time (default: 4)')
+parser.add_argument('--attempts', type=int, default=5, help='maximum number of attempts per juju command (default: 5)')
+parser.add_argument('--command-timeout', type=float, default=None, help='seconds after which a juju command is killed and counts as failed (default: none)')
+parser.add_argument('--monitor', action='store_true', help='poll "juju status" and use a service only once all its units are ready')
+parser.add_argument('--poll-interval', type=float, default=5.0, help='seconds between two polls of "juju status" (default: 5)')
+parser.add_argument('--ready-timeout', type=float, default=900.0, help='seconds to wait for the units of a service to become ready, or for a destroyed service to be gone (default: 900)')
+parser.add_argument('--juju', default='juju', help='command used instead of "juju", e.g. a fake juju for tests (default: juju)')
+parser.add_argument('--deployed-model', metavar='FILE', help='model of the last successful deployment; only the differences to it are deployed, and it is replaced after every successful deployment (default: deployed-JUJU_ENV.yaml)')
+parser.add_argument('--full', action='store_true', help='deploy everything, even if the model of an earlier deployment exists')
+parser.add_argument('--save-plan', metavar='FILE', help='write the deployment plan as JSON to FILE')
+parser.add_argument('--bundle', metavar='FILE', help='write the deployment as juju-deployer configuration to FILE and deploy it with a single command instead of one juju command per step')
+parser.add_argument('--bundle-name', default='tosca', help='name of the deployment in the bundle (default: tosca)')
+parser.add_argument('--deployer', default='juju-deployer', help='command that applies the bundle (default: juju-deployer)')
+parser.add_argument('--skip-redundant', action='store_true', help='leave out steps of the plan flagged as redundant')
+parser.add_argument('--profile', action='store_true', help='print the time, memory and counters of every stage at the end')
+parser.add_argument('--profile-json', metavar='FILE', help='write the time, memory and counters of every stage as JSON to FILE')
+parser.add_argument('--profile-dump', metavar='FILE', help='write cProfile statistics of the main process to FILE')
+args = parser.parse_args()
+
+if args.profile or args.profile_json != None or args.profile_dump != None:
+  instrument.enable(args.profile_dump, args.profile_json, args.profile)
+
+csarFile = args.csarFile
+serviceTpl = args.serviceTpl
+jujuEnv = args.jujuEnv
 
 charmsDir = 'charms'
 charmSeries = 'precise' # for now this has to be a valid name for a Ubuntu series
 
+# Open the CSAR; its members are read in place, nothing is extracted
+try:
+  with instrument.stage('open-csar'):
+    csar = CsarFile(csarFile)
+except CsarError, e:
+  print str(e)
+  sys.exit(1)
+
 # Transform TOSCA service template into a charm-based model
-transformer = ModelTransformer(csarFile, csarDir, serviceTpl)
-model = transformer.transform()
+overrides = parseOverrides(args.set)
+templateCache = TemplateCache(args.template_cache) if args.template_cache != None else None
+
+with instrument.stage('load-template'):
+  transformer = ModelTransformer(csar, serviceTpl, args.loader, templateCache)
+
+try:
+  with instrument.stage('transform'):
+    model = transformer.transform(overrides, 1 if args.serial_transform else args.workers or multiprocessing.cpu_count())
+except TemplateOverrideError, e:
+  print str(e)
+  sys.exit(1)
+
+# Deploy identical stacks as units of one charm
+if args.dedupe:
+  with instrument.stage('deduplicate'):
+    merged = model.deduplicate()
+
+  for charmName in sorted(merged.keys()):
+    print 'Charm "' + charmName + '" merged into charm "' + merged[charmName] + '".'
 
 # Print model
 print ' '
 print '------------------------------------'
 print ' '
-print yaml.safe_dump(model, default_flow_style=False)
+modelYaml = yaml.safe_dump(model.toDict(), default_flow_style=False)
+print modelYaml
 
 # Build charms
-charmGen = CharmGenerator(csarDir, model, charmsDir, charmSeries)
-charmGen.generate()
+cacheDir = None if args.no_cache else args.cache_dir
+charmGen = CharmGenerator(csar, model, charmsDir, charmSeries, args.workers, cacheDir, args.cache_size * 1024 * 1024, not args.rebuild)
+
+try:
+  with instrument.stage('generate-charms'):
+    charmGen.generate()
+except CharmGenerationError, e:
+  print str(e)
+  sys.exit(1)
+
+# Generate deployment plan; if the model of an earlier deployment is known,
+# only for the differences to it
+deployedModelPath = args.deployed_model or 'deployed-' + jujuEnv + '.yaml'
+deployedModel = None
+
+if not args.full and args.bundle == None and os.path.isfile(deployedModelPath):
+  deployedModel = Model.fromDict(yaml.safe_load(open(deployedModelPath, 'r')))
 
-# Generate commands
-cmdGen = CommandGenerator(model, charmsDir, charmSeries, jujuEnv)
-commands = cmdGen.generate()
+with instrument.stage('generate-plan'):
+  cmdGen = CommandGenerator(model, charmsDir, charmSeries, jujuEnv)
+
+  if deployedModel != None:
+    plan = cmdGen.generateDeltaPlan(deployedModel)
+    print 'Deploying the differences to ' + deployedModelPath + ' (' + str(len(plan.steps)) + ' commands).'
+  else:
+    plan = cmdGen.generatePlan()
+
+if args.save_plan != None:
+  planFile = open(args.save_plan, 'w')
+  planFile.write(plan.toJson())
+  planFile.close()
+
+# Write the bundle and make sure it describes the same deployment as the plan
+if args.bundle != None:
+  with instrument.stage('generate-bundle'):
+    bundle = cmdGen.generateBundle(args.bundle_name, args.skip_redundant)
+    differences = compareBundle(bundle, plan.getCommands(args.skip_redundant))
+
+  if len(differences) > 0:
+    print 'The bundle does not match the deployment plan:'
+    for difference in differences: print '  ' + difference
+    sys.exit(1)
+
+  bundleFile = open(args.bundle, 'w')
+  bundleFile.write(yaml.safe_dump(bundle, default_flow_style=False))
+  bundleFile.close()
 
 print '------------------------------------'
 
-for cmd in commands:
-  # Print command
-  printCmd = '\n'
-  for arg in cmd:
-    printCmd += arg + ' '
-  print printCmd + '\n'
-
-  # Run command
-  returnCode = 1
-  while returnCode != 0:
-    returnCode = subprocess.call(cmd)
+# Run commands, independent ones concurrently
+jujuCommand = shlex.split(args.juju)
+monitor = None
+
+# Services destroyed by the plan are watched until they are gone, so they
+# can be deployed again under the same name
+destroys = args.bundle == None and len([step for step in plan.steps if step.kind == 'destroy-service']) > 0
+
+if args.monitor or destroys:
+  monitor = DeploymentMonitor(jujuCommand + ['status', '--format', 'yaml', '-e', jujuEnv], pollInterval=args.poll_interval, timeout=args.ready_timeout)
+
+executor = CommandExecutor(args.concurrency, args.attempts, commandTimeout=args.command_timeout, monitor=monitor, jujuCommand=jujuCommand, waitForReady=args.monitor)
+with instrument.stage('deploy'):
+  if args.bundle != None:
+    results = executor.run([cmdGen.generateBundleCommand(args.bundle, args.bundle_name, args.deployer)])
+
+    # The deployer returns once the services are created; wait for their units
+    if monitor != None and results[0].status == 'ok':
+      for charmName in sorted(bundle[args.bundle_name]['services'].keys()):
+        state = monitor.waitForService(charmName)
+        if state != 'ready':
+          print 'Service "' + charmName + '": ' + state
+          results[0].status = state
+
+      if results[0].status == 'ok':
+        results[0].readyAfter = time.time() - results[0].start
+  else:
+    results = executor.runPlan(plan, args.skip_redundant)
+
+printReport(results)
+
+if len([result for result in results if result.status != 'ok']) > 0:
+  sys.exit(1)
+
+# Remember what is deployed now, for the next run
+modelFile = open(deployedModelPath + '.tmp', 'w')
+modelFile.write(modelYaml)
+modelFile.close()
+os.rename(deployedModelPath + '.tmp', deployedModelPath)
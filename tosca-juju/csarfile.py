@@ -0,0 +1,125 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import hashlib, zipfile
+from cStringIO import StringIO
+
+from bundler import normalizeName
+
+# Manifest of the CSAR and the entry that names the service template
+manifestName = 'META-INF/MANIFEST.MF'
+serviceTemplateEntry = 'Service-Template'
+
+# TOSCA 1.0 metadata file and its entry for the main definitions, used if
+# the CSAR has no manifest
+toscaMetaName = 'TOSCA-Metadata/TOSCA.meta'
+entryDefinitionsEntry = 'Entry-Definitions'
+
+# Raised for CSARs that are not readable or lack a referenced member
+class CsarError(Exception):
+  pass
+
+# Parses a manifest in the JAR manifest format: "Name: value" lines, where
+# lines starting with a space continue the previous value. Returns the entries
+# of the main section as a dict.
+def parseManifest(data):
+  entries = {}
+  name = None
+
+  for line in data.splitlines():
+    if line.startswith(' ') and name != None:
+      entries[name] += line[1:]
+    elif line.strip() == '':
+      # The main section ends at the first empty line
+      if len(entries) > 0: break
+    elif ':' in line:
+      name, value = line.split(':', 1)
+      name = name.strip()
+      entries[name] = value.strip()
+
+  return entries
+
+# Read access to the members of a CSAR without extracting it. The central
+# directory is read once; members are only read when asked for, so artifacts
+# that are not referenced by the topology are never touched. Every member is
+# read through a file handle of its own, so forked worker processes can share
+# the object.
+class CsarFile:
+  def __init__(self, path):
+    self.path = path
+    self.digests = {}
+
+    try:
+      self.zip = zipfile.ZipFile(path)
+    except (IOError, zipfile.BadZipfile), e:
+      raise CsarError('Cannot open CSAR "' + path + '": ' + str(e))
+
+  def close(self):
+    self.zip.close()
+
+  # Returns the zip info of the member with the given path
+  def getInfo(self, name):
+    try:
+      return self.zip.getinfo(normalizeName(name))
+    except KeyError:
+      raise CsarError('CSAR "' + self.path + '" has no member "' + name + '".')
+
+  # Returns true iff the CSAR has a member with the given path
+  def hasMember(self, name):
+    return normalizeName(name) in self.zip.NameToInfo
+
+  # Returns a file-like object that decompresses the member while it is read
+  def open(self, name):
+    return self.zip.open(self.getInfo(name))
+
+  # Returns the content of the member
+  def read(self, name):
+    return self.zip.read(self.getInfo(name))
+
+  # Returns the content of the member as seekable in-memory file, e.g. for
+  # opening nested archives
+  def openInMemory(self, name):
+    return StringIO(self.read(name))
+
+  # Returns the SHA-1 digest of the content of the member
+  def getDigest(self, name):
+    name = normalizeName(name)
+
+    if not name in self.digests:
+      digest = hashlib.sha1()
+      member = self.open(name)
+
+      try:
+        for block in iter(lambda: member.read(1 << 16), ''):
+          digest.update(block)
+      finally:
+        member.close()
+
+      self.digests[name] = digest.hexdigest()
+
+    return self.digests[name]
+
+  # Returns the path of the service template, as named by the manifest (or
+  # the TOSCA metadata of CSARs without manifest)
+  def getServiceTemplatePath(self):
+    if self.hasMember(manifestName):
+      entries = parseManifest(self.read(manifestName))
+      if serviceTemplateEntry in entries:
+        return entries[serviceTemplateEntry]
+
+    if self.hasMember(toscaMetaName):
+      entries = parseManifest(self.read(toscaMetaName))
+      if entryDefinitionsEntry in entries:
+        return entries[entryDefinitionsEntry]
+
+    raise CsarError('CSAR "' + self.path + '" does not name its service template in ' + manifestName + '.')
@@ -0,0 +1,322 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import subprocess, threading, time, Queue
+import instrument
+
+# Options of juju commands that take a value
+valueOptions = set(['-e', '--environment', '--repository', '-n', '--num-units', '--config', '--to', '--constraints'])
+
+# Returns the positional arguments of a juju command, after the subcommand
+def getPositionalArgs(cmd):
+  args = []
+  skip = False
+
+  for arg in cmd[2:]:
+    if skip:
+      skip = False
+    elif arg in valueOptions:
+      skip = True
+    elif not arg.startswith('-'):
+      args.append(arg)
+
+  return args
+
+# Returns the name of the service created by a "juju deploy" command
+def getDeployedService(cmd):
+  args = getPositionalArgs(cmd)
+
+  if len(args) > 1:
+    return args[1]
+
+  return args[0].split(':')[-1].split('/')[-1]
+
+# Returns the services a juju command works on and whether it creates them,
+# or None if the command is unknown
+def getCommandServices(cmd):
+  if len(cmd) < 2:
+    return None
+
+  if cmd[1] == 'deploy':
+    if len(getPositionalArgs(cmd)) == 0: return None
+    return ([getDeployedService(cmd)], True)
+  elif cmd[1] in ('add-relation', 'remove-relation'):
+    return ([endpoint.split(':')[0] for endpoint in getPositionalArgs(cmd)], False)
+  elif cmd[1] in ('expose', 'unexpose', 'add-unit', 'set', 'upgrade-charm', 'destroy-service'):
+    return (getPositionalArgs(cmd)[:1], False)
+
+  return None
+
+# Returns the dependencies of every command, a list of sets of command
+# indices. A command that uses a service depends on the command that deploys
+# it; unknown commands act as barriers and depend on all earlier commands
+# (and all later commands depend on them).
+def buildDependencies(commands):
+  dependencies = []
+  deployedBy = {}
+  barrier = None
+
+  for i, cmd in enumerate(commands):
+    services = getCommandServices(cmd)
+    deps = set()
+
+    if services == None:
+      deps.update(range(i))
+      barrier = i
+    else:
+      names, creates = services
+
+      if barrier != None:
+        deps.add(barrier)
+
+      for name in names:
+        if creates:
+          deployedBy[name] = i
+        elif name in deployedBy:
+          deps.add(deployedBy[name])
+
+    dependencies.append(deps)
+
+  return dependencies
+
+# Runs a command and returns its exit code; the command is killed and -1
+# returned if it does not finish within the timeout (in seconds, None for no
+# timeout)
+def callCommand(cmd, timeout=None):
+  try:
+    process = subprocess.Popen(cmd)
+  except OSError:
+    return -1
+
+  if timeout == None:
+    return process.wait()
+
+  deadline = time.time() + timeout
+  delay = 0.01
+
+  while process.poll() == None:
+    if time.time() >= deadline:
+      process.kill()
+      process.wait()
+      instrument.count('commands.timedOut')
+      return -1
+
+    time.sleep(delay)
+    delay = min(delay * 2, 0.5)
+
+  return process.returncode
+
+# Outcome of a single command
+class CommandResult(object):
+  __slots__ = ('command', 'status', 'returnCode', 'attempts', 'start', 'duration', 'readyAfter')
+
+  def __init__(self, command):
+    self.command = command
+    self.status = 'pending' # 'ok', 'failed', 'error', 'timeout' or 'skipped' when done
+    self.returnCode = None
+    self.attempts = 0
+    self.start = None
+    self.duration = 0.0
+    self.readyAfter = None # for deployments: seconds until all units were ready
+
+# Runs juju commands concurrently, respecting the dependencies between them.
+# Failed commands are retried with exponential backoff; commands that depend
+# on a command that failed for good are skipped.
+#
+# With a DeploymentMonitor (see monitor), a deployment is only done once all
+# units of the service are ready, so commands that use the service wait for
+# it; waitForReady=False leaves that out. Destroying a service is only done
+# once the service has left the status, so it can be deployed again under
+# the same name. Waiting does not count against the concurrency, which
+# limits the juju commands in flight.
+class CommandExecutor:
+  def __init__(self, concurrency=4, maxAttempts=5, initialDelay=1.0, maxDelay=60.0, commandTimeout=None, monitor=None, jujuCommand=None, waitForReady=True):
+    self.concurrency = max(1, concurrency)
+    self.maxAttempts = max(1, maxAttempts)
+    self.initialDelay = initialDelay
+    self.maxDelay = maxDelay
+    self.commandTimeout = commandTimeout
+    self.monitor = monitor
+    self.waitForReady = waitForReady
+
+    # Command line that replaces "juju" in the commands, e.g. to run a fake juju
+    self.jujuCommand = jujuCommand
+
+    # Called with the command before every attempt; replaceable for quiet runs
+    self.onStart = printCommand
+
+  # Runs a command until it succeeds or the attempts are used up
+  def runCommand(self, result):
+    delay = self.initialDelay
+    result.start = time.time()
+
+    command = result.command
+    if self.jujuCommand != None and command[0] == 'juju':
+      command = self.jujuCommand + command[1:]
+
+    while True:
+      result.attempts += 1
+      self.onStart(result.command)
+
+      result.returnCode = callCommand(command, self.commandTimeout)
+
+      if result.returnCode == 0 or result.attempts >= self.maxAttempts:
+        break
+
+      instrument.count('commands.retries')
+      time.sleep(delay)
+      delay = min(delay * 2, self.maxDelay)
+
+    result.duration = time.time() - result.start
+    result.status = 'ok' if result.returnCode == 0 else 'failed'
+
+    instrument.count('commands.run')
+    if result.status == 'failed': instrument.count('commands.failed')
+
+  # Waits until the units of the service deployed by the command are ready,
+  # or until the service destroyed by the command is gone
+  def waitForServices(self, result):
+    services = getCommandServices(result.command)
+
+    if self.monitor == None or services == None:
+      return
+
+    if result.command[1] == 'destroy-service':
+      state = self.monitor.waitForRemoval(services[0][0])
+
+      if state != 'removed':
+        result.status = state
+        instrument.count('removals.' + state)
+      return
+
+    if not services[1] or not self.waitForReady:
+      return
+
+    state = self.monitor.waitForService(services[0][0])
+
+    if state == 'ready':
+      result.readyAfter = time.time() - result.start
+    else:
+      result.status = state
+      instrument.count('deployments.' + state)
+
+  # Runs all commands, guessing the dependencies between them, and returns
+  # their results in the order of the commands
+  def run(self, commands):
+    return self.execute(commands, buildDependencies(commands))
+
+  # Runs the steps of a CommandPlan (see cmdgen) along its explicit
+  # dependencies and returns their results in the order of the steps
+  def runPlan(self, plan, skipRedundant=False):
+    steps = [step for step in plan.steps if not (skipRedundant and step.redundant)]
+    indices = dict((step.id, i) for i, step in enumerate(steps))
+
+    dependencies = [set(indices[dep] for dep in step.dependsOn if dep in indices) for step in steps]
+
+    return self.execute([step.command for step in steps], dependencies)
+
+  # Runs the commands; dependencies holds the set of indices of the commands
+  # that every command depends on
+  def execute(self, commands, dependencies):
+    results = [CommandResult(cmd) for cmd in commands]
+
+    dependents = [[] for cmd in commands]
+    pending = [len(deps) for deps in dependencies]
+
+    for i, deps in enumerate(dependencies):
+      for dep in deps:
+        dependents[dep].append(i)
+
+    ready = [i for i in range(len(commands)) if pending[i] == 0]
+    finished = Queue.Queue()
+    running = 0 # commands in flight
+    active = 0 # commands in flight or waiting for their deployment
+
+    # Reports ('ran', i) once the command ran and ('done', i) once it is done
+    def worker(i):
+      try:
+        try:
+          self.runCommand(results[i])
+        finally:
+          finished.put(('ran', i))
+
+        if results[i].status == 'ok':
+          self.waitForServices(results[i])
+      finally:
+        finished.put(('done', i))
+
+    # Marks all commands that (transitively) depend on the given one as skipped
+    def skipDependents(i):
+      stack = list(dependents[i])
+
+      while len(stack) > 0:
+        j = stack.pop()
+        if results[j].status == 'skipped': continue
+
+        results[j].status = 'skipped'
+        stack.extend(dependents[j])
+
+    while len(ready) > 0 or active > 0:
+      while len(ready) > 0 and running < self.concurrency:
+        i = ready.pop(0)
+        if results[i].status == 'skipped': continue
+
+        thread = threading.Thread(target=worker, args=(i,))
+        thread.daemon = True
+        thread.start()
+        running += 1
+        active += 1
+
+      if active == 0:
+        break
+
+      # Wait with a timeout, so the main thread stays interruptible
+      while True:
+        try:
+          event, i = finished.get(True, 1.0)
+          break
+        except Queue.Empty:
+          pass
+
+      if event == 'ran':
+        running -= 1
+        continue
+
+      active -= 1
+
+      if results[i].status != 'ok':
+        skipDependents(i)
+
+      for j in dependents[i]:
+        pending[j] -= 1
+        if pending[j] == 0 and results[j].status != 'skipped':
+          ready.append(j)
+
+      ready.sort()
+
+    return results
+
+# Prints a command the way create-instance.py always did
+def printCommand(cmd):
+  print '\n' + ' '.join(cmd) + ' \n'
+
+# Prints the status, attempts and wall time of every command, and for
+# deployments watched by a DeploymentMonitor the time until the units were
+# ready
+def printReport(results):
+  print '------------------------------------'
+  print '%-8s %8s %10s %10s  %s' % ('status', 'attempts', 'time [s]', 'ready [s]', 'command')
+
+  for result in results:
+    readyAfter = '%10.2f' % result.readyAfter if result.readyAfter != None else '%10s' % '-'
+    print '%-8s %8d %10.2f %s  %s' % (result.status, result.attempts, result.duration, readyAfter, ' '.join(result.command))
@@ -0,0 +1,204 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, sys, json, time, fcntl, yaml
+
+#
+# fake-juju.py deploy --repository charms local:precise/sugar-crm-db -e test
+# fake-juju.py status --format yaml -e test
+#
+# Stand-in for the juju client to try deployments without a cloud, e.g.
+#
+#   create-instance.py --juju 'python fake-juju.py' --monitor SugarCRM_ChefManaged.zip test
+#
+# The environment is kept in the JSON file named by FAKE_JUJU_STATE (default:
+# fake-juju.json). Units of a deployed service become ready after
+# FAKE_JUJU_DELAY seconds (default: 2); the units of the services listed in
+# FAKE_JUJU_FAIL (comma separated) end in the "error" state instead. A
+# destroyed service stays in the status, dying, for FAKE_JUJU_REMOVE_DELAY
+# seconds (default: 0), like a real one while its units are torn down.
+#
+
+statePath = os.environ.get('FAKE_JUJU_STATE', 'fake-juju.json')
+readyDelay = float(os.environ.get('FAKE_JUJU_DELAY', '2'))
+removeDelay = float(os.environ.get('FAKE_JUJU_REMOVE_DELAY', '0'))
+failingServices = set(name for name in os.environ.get('FAKE_JUJU_FAIL', '').split(',') if name != '')
+
+# Options that take a value
+valueOptions = set(['-e', '--environment', '--repository', '-n', '--num-units', '--config', '--to', '--constraints', '--format'])
+
+def fail(message):
+  print >>sys.stderr, 'error: ' + message
+  sys.exit(1)
+
+# Returns the positional arguments and the options of the command line
+def parseArgs(argv):
+  args = []
+  options = {}
+  i = 0
+
+  while i < len(argv):
+    if argv[i] in valueOptions and i + 1 < len(argv):
+      options[argv[i]] = argv[i + 1]
+      i += 2
+    else:
+      if not argv[i].startswith('-'): args.append(argv[i])
+      i += 1
+
+  return args, options
+
+# Returns the service of the given endpoint ("service:relation")
+def getService(state, endpoint):
+  name = endpoint.split(':')[0]
+
+  if not name in state['services']:
+    fail('service "' + name + '" not found')
+
+  return state['services'][name]
+
+def getUnitState(service, now):
+  if 'destroyed' in service:
+    return 'stopped'
+
+  if service['name'] in failingServices and now - service['deployed'] >= readyDelay:
+    return 'error'
+
+  return 'started' if now - service['deployed'] >= readyDelay else 'pending'
+
+def printStatus(state, outputFormat):
+  now = time.time()
+  services = {}
+
+  for name, service in state['services'].items():
+    units = {}
+    for i in range(service['units']):
+      units[name + '/' + str(i)] = {'agent-state': getUnitState(service, now), 'machine': str(service['machines'][i])}
+
+    relations = {}
+    for source, target in state['relations']:
+      for local, remote in [(source, target), (target, source)]:
+        if local.split(':')[0] == name:
+          relations.setdefault(local.split(':')[-1], []).append(remote.split(':')[0])
+
+    services[name] = {'charm': service['charm'], 'exposed': service['exposed'], 'units': units}
+    if 'destroyed' in service: services[name]['life'] = 'dying'
+    if len(relations) > 0: services[name]['relations'] = relations
+
+  status = {'environment': state['environment'], 'machines': dict((str(i), {'agent-state': 'started'}) for i in range(state['machines'] + 1)), 'services': services}
+
+  if outputFormat == 'json':
+    print json.dumps(status, indent=2, sort_keys=True)
+  else:
+    print yaml.safe_dump(status, default_flow_style=False)
+
+# Removes the destroyed services whose removal delay is over and returns
+# whether there were any
+def removeDestroyed(state):
+  now = time.time()
+  removed = [name for name, service in state['services'].items() if 'destroyed' in service and now - service['destroyed'] >= removeDelay]
+
+  for name in removed:
+    del state['services'][name]
+
+  return len(removed) > 0
+
+# Runs the command against the state and returns whether the state changed
+def runCommand(state, command, args, options):
+  removed = removeDestroyed(state)
+
+  if command == 'status':
+    printStatus(state, options.get('--format', 'yaml'))
+    return removed
+
+  if command == 'deploy':
+    if len(args) == 0: fail('no charm specified')
+
+    charm = args[0]
+    name = args[1] if len(args) > 1 else charm.split(':')[-1].split('/')[-1]
+    if name in state['services']: fail('service "' + name + '" already exists')
+
+    units = int(options.get('-n', options.get('--num-units', '1')))
+    machines = range(state['machines'] + 1, state['machines'] + 1 + units)
+    state['machines'] += units
+
+    state['services'][name] = {'name': name, 'charm': charm, 'units': units, 'machines': machines, 'exposed': False, 'deployed': time.time(), 'config': {}}
+  elif command in ('add-relation', 'remove-relation'):
+    if len(args) != 2: fail('a relation must involve two services')
+
+    for endpoint in args: getService(state, endpoint)
+    relation = sorted(args)
+
+    if command == 'add-relation':
+      if relation in state['relations']: fail('relation already exists')
+      state['relations'].append(relation)
+    else:
+      if not relation in state['relations']: fail('relation not found')
+      state['relations'].remove(relation)
+  elif command in ('expose', 'unexpose'):
+    if len(args) != 1: fail('no service specified')
+    getService(state, args[0])['exposed'] = command == 'expose'
+  elif command == 'set':
+    if len(args) < 1: fail('no service specified')
+
+    service = getService(state, args[0])
+    for setting in args[1:]:
+      key, separator, value = setting.partition('=')
+      service['config'][key] = value
+  elif command == 'upgrade-charm':
+    if len(args) != 1: fail('no service specified')
+    getService(state, args[0])['deployed'] = time.time()
+  elif command == 'add-unit':
+    if len(args) != 1: fail('no service specified')
+
+    service = getService(state, args[0])
+    units = int(options.get('-n', options.get('--num-units', '1')))
+    service['machines'].extend(range(state['machines'] + 1, state['machines'] + 1 + units))
+    service['units'] += units
+    state['machines'] += units
+  elif command == 'destroy-service':
+    if len(args) != 1: fail('no service specified')
+
+    service = getService(state, args[0])
+    if 'destroyed' in service: fail('service "' + args[0] + '" is being destroyed')
+
+    service['destroyed'] = time.time()
+    removeDestroyed(state)
+    state['relations'] = [relation for relation in state['relations'] if not args[0] in [endpoint.split(':')[0] for endpoint in relation]]
+  else:
+    fail('unknown command "' + command + '"')
+
+  return True
+
+if len(sys.argv) < 2:
+  fail('no command specified')
+
+args, options = parseArgs(sys.argv[2:])
+
+# Commands of concurrent processes are applied one after another
+lockFile = open(statePath + '.lock', 'a')
+fcntl.flock(lockFile, fcntl.LOCK_EX)
+
+try:
+  if os.path.isfile(statePath):
+    state = json.load(open(statePath, 'r'))
+  else:
+    state = {'environment': options.get('-e', options.get('--environment', 'fake')), 'machines': 0, 'services': {}, 'relations': []}
+
+  if runCommand(state, sys.argv[1], args, options):
+    stateFile = open(statePath + '.tmp', 'w')
+    json.dump(state, stateFile, indent=2, sort_keys=True)
+    stateFile.close()
+    os.rename(statePath + '.tmp', statePath)
+finally:
+  fcntl.flock(lockFile, fcntl.LOCK_UN)
+  lockFile.close()
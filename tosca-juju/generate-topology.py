@@ -0,0 +1,42 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import argparse
+
+from topogen import TopologyOptions, buildServiceTemplate, writeCsar
+
+#
+# generate-topology.py --vms 200 --depth 4 --depends-on 3 --connects-to 2 synthetic.zip
+#
+
+parser = argparse.ArgumentParser(description='Generate a synthetic TOSCA CSAR (or service template) for benchmarks.')
+parser.add_argument('output', help='path of the CSAR to write')
+parser.add_argument('--vms', type=int, default=10, help='number of virtual machines (default: 10)')
+parser.add_argument('--depth', type=int, default=3, help='number of nodes stacked on the operating system of every VM (default: 3)')
+parser.add_argument('--depends-on', type=int, default=2, help='number of modules the top node of every VM depends on (default: 2)')
+parser.add_argument('--connects-to', type=int, default=1, help='number of other VMs the top node of every VM connects to (default: 1)')
+parser.add_argument('--cookbooks', type=int, default=10, help='number of cookbooks (default: 10)')
+parser.add_argument('--cookbook-size', type=int, default=64, help='uncompressed size of every cookbook in KB (default: 64)')
+parser.add_argument('--unused-size', type=int, default=0, help='size of an artifact that no node refers to in KB (default: 0)')
+parser.add_argument('--seed', type=int, default=0, help='seed for the cookbook content (default: 0)')
+parser.add_argument('--template-only', action='store_true', help='write only the service template instead of a CSAR')
+args = parser.parse_args()
+
+options = TopologyOptions(args.vms, args.depth, args.depends_on, args.connects_to, args.cookbooks, args.cookbook_size * 1024, args.unused_size * 1024, args.seed)
+
+if args.template_only:
+  tplFile = open(args.output, 'w')
+  tplFile.write(buildServiceTemplate(options))
+  tplFile.close()
+else:
+  writeCsar(args.output, options)
@@ -34,6 +34,9 @@ run_chef_client () {
 
 wait_while_running
 
+# Keep the attributes for the upgrade-charm hook, which gets a fresh attributes.json
+cp $SCRIPT_DIR/attributes.json /var/chef/attributes.json
+
 run_chef_client
 
 exit 0
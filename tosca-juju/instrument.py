@@ -0,0 +1,217 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, sys, time, json, atexit, resource, threading, cProfile
+
+#
+# Opt-in instrumentation of the pipeline: wall and CPU time plus the growth of
+# the peak memory per stage, and counters. Nothing is recorded unless enable() was called;
+# until then stage() does almost nothing and count() is an empty function.
+#
+#   with instrument.stage('transform'):
+#     model = transformer.transform()
+#
+#   instrument.count('relationships.visited', len(relationships))
+#
+
+# The enabled Instrumentation, or None
+active = None
+
+# Returns the peak resident set size of this process and of its waited-for
+# children in bytes
+def getPeakMemory():
+  # ru_maxrss is in kilobytes on Linux, but in bytes on Mac OS X
+  unit = 1 if sys.platform == 'darwin' else 1024
+
+  return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+# Returns the CPU time used by this process and its waited-for children
+def getCpuTime():
+  times = os.times()
+  return times[0] + times[1] + times[2] + times[3]
+
+# Measurements of a single stage. The peak memory is only known for the whole
+# process, so a stage records by how much it raised the peak; a stage that
+# stays below the peak of an earlier one records 0.
+class StageRecord(object):
+  __slots__ = ('name', 'wall', 'cpu', 'peakGrowth', 'childPeakGrowth')
+
+  def __init__(self, name):
+    self.name = name
+    self.wall = 0.0
+    self.cpu = 0.0
+    self.peakGrowth = 0
+    self.childPeakGrowth = 0
+
+  def toDict(self):
+    return {'name': self.name, 'wall': self.wall, 'cpu': self.cpu, 'peakGrowth': self.peakGrowth, 'childPeakGrowth': self.childPeakGrowth}
+
+# Context manager that measures a stage and records it when the stage ends
+class StageTimer(object):
+  def __init__(self, instrumentation, name):
+    self.instrumentation = instrumentation
+    self.record = StageRecord(name)
+
+  def __enter__(self):
+    self.wallStart = time.time()
+    self.cpuStart = getCpuTime()
+    self.peakStart, self.childPeakStart = getPeakMemory()
+    return self.record
+
+  def __exit__(self, excType, excValue, tb):
+    self.record.wall = time.time() - self.wallStart
+    self.record.cpu = getCpuTime() - self.cpuStart
+    peakMemory, childPeakMemory = getPeakMemory()
+    self.record.peakGrowth = peakMemory - self.peakStart
+    self.record.childPeakGrowth = childPeakMemory - self.childPeakStart
+
+    self.instrumentation.stages.append(self.record)
+    return False
+
+# Context manager used while the instrumentation is disabled
+class NoStage(object):
+  def __enter__(self):
+    return None
+
+  def __exit__(self, excType, excValue, tb):
+    return False
+
+noStage = NoStage()
+
+class Instrumentation:
+  def __init__(self, profilePath=None):
+    self.stages = []
+    self.counters = {}
+
+    # Counters are also updated by the threads of the command executor
+    self.lock = threading.Lock()
+
+    # cProfile only sees the main thread of this process
+    self.profilePath = profilePath
+    self.profiler = None
+
+    if profilePath != None:
+      self.profiler = cProfile.Profile()
+      self.profiler.enable()
+
+  def stage(self, name):
+    return StageTimer(self, name)
+
+  def count(self, name, amount=1):
+    self.lock.acquire()
+    try:
+      self.counters[name] = self.counters.get(name, 0) + amount
+    finally:
+      self.lock.release()
+
+  # Returns the counters and starts counting from zero; used by worker
+  # processes to hand their counts to the parent
+  def takeCounters(self):
+    self.lock.acquire()
+    try:
+      counters = self.counters
+      self.counters = {}
+    finally:
+      self.lock.release()
+
+    return counters
+
+  # Adds counts taken from a worker process
+  def addCounters(self, counters):
+    for name, amount in counters.items():
+      self.count(name, amount)
+
+  # Stops the profiler and writes its statistics
+  def stopProfiler(self):
+    if self.profiler != None:
+      self.profiler.disable()
+      self.profiler.dump_stats(self.profilePath)
+      self.profiler = None
+
+  def toDict(self):
+    peakMemory, childPeakMemory = getPeakMemory()
+
+    return {
+      'stages': [record.toDict() for record in self.stages],
+      'counters': dict(self.counters),
+      'peakMemory': peakMemory,
+      'childPeakMemory': childPeakMemory
+    }
+
+  def toJson(self):
+    return json.dumps(self.toDict(), indent=2, sort_keys=True)
+
+  # Prints the stages, the peak memory and the counters as table
+  def printSummary(self):
+    print '------------------------------------'
+    print '%-16s %10s %10s %12s %16s' % ('stage', 'wall [s]', 'cpu [s]', 'peak +[MB]', 'children +[MB]')
+
+    for record in self.stages:
+      print '%-16s %10.3f %10.3f %12.1f %16.1f' % (record.name, record.wall, record.cpu, record.peakGrowth / 1048576.0, record.childPeakGrowth / 1048576.0)
+
+    peakMemory, childPeakMemory = getPeakMemory()
+    print '%-38s %12.1f %16.1f' % ('peak of the process [MB]', peakMemory / 1048576.0, childPeakMemory / 1048576.0)
+
+    if len(self.counters) > 0:
+      print '------------------------------------'
+      print '%-32s %12s' % ('counter', 'value')
+
+      for name in sorted(self.counters.keys()):
+        print '%-32s %12d' % (name, self.counters[name])
+
+# Enables the instrumentation. When the process exits, the cProfile
+# statistics are written to profilePath, the measurements are written as
+# JSON to jsonPath and the summary is printed, as far as requested.
+def enable(profilePath=None, jsonPath=None, summary=False):
+  global active, count
+  active = Instrumentation(profilePath)
+  count = active.count
+
+  def report(instrumentation):
+    instrumentation.stopProfiler()
+
+    if jsonPath != None:
+      jsonFile = open(jsonPath, 'w')
+      jsonFile.write(instrumentation.toJson())
+      jsonFile.close()
+
+    if summary:
+      instrumentation.printSummary()
+
+  atexit.register(report, active)
+  return active
+
+# Returns a context manager that measures the stage with the given name
+def stage(name):
+  if active == None:
+    return noStage
+
+  return active.stage(name)
+
+# Adds the given amount to a counter. Counters are bumped in the innermost
+# loops, so this does nothing at all until enable() replaces it with
+# Instrumentation.count.
+def count(name, amount=1):
+  pass
+
+# See Instrumentation.takeCounters; returns an empty dict if disabled
+def takeCounters():
+  if active == None:
+    return {}
+
+  return active.takeCounters()
+
+# See Instrumentation.addCounters
+def addCounters(counters):
+  if active != None:
+    active.addCounters(counters)
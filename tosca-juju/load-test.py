@@ -0,0 +1,116 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import sys, json, time, threading, urllib2, argparse
+
+from transformsvc import requestTransform
+
+#
+# load-test.py --requests 200 --concurrency 8 SugarCRM_ChefManaged.zip
+# load-test.py --vary SugarCrmDb:DBName=db%d --requests 50 SugarCRM_ChefManaged.zip
+#
+# Sends transformation requests to a running transform-server.py from
+# several threads, cycling through the given CSARs, and prints the
+# throughput and the latencies.
+#
+
+# Returns the value at the given fraction of the sorted values
+def getPercentile(values, fraction):
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+parser = argparse.ArgumentParser(description='Load test a running transform-server.py.')
+parser.add_argument('csarFiles', nargs='+', metavar='csarFile', help='TOSCA Cloud Service Archives (CSARs) to send, one after another')
+parser.add_argument('--server', default='http://127.0.0.1:8642', help='URL of the server (default: http://127.0.0.1:8642)')
+parser.add_argument('--requests', type=int, default=100, help='total number of requests (default: 100)')
+parser.add_argument('--concurrency', type=int, default=4, help='number of requests sent at the same time (default: 4)')
+parser.add_argument('--no-upload', action='store_true', help='let the server read the CSARs from their paths instead of sending them; they have to be below the --csar-root of the server')
+parser.add_argument('--vary', metavar='NODE:PROPERTY=FORMAT', help='override a property with FORMAT %% request number, so that requests are not answered from the result cache')
+parser.add_argument('--report', metavar='FILE', help='write the results as JSON to FILE')
+args = parser.parse_args()
+
+lock = threading.Lock()
+nextRequest = [0]
+latencies = []
+failures = []
+cached = [0]
+
+def sendRequests():
+  while True:
+    lock.acquire()
+    try:
+      i = nextRequest[0]
+      nextRequest[0] += 1
+    finally:
+      lock.release()
+
+    if i >= args.requests:
+      return
+
+    params = []
+    if args.vary != None:
+      params.append(('set', args.vary % i if '%' in args.vary else args.vary))
+
+    start = time.time()
+
+    try:
+      status, result = requestTransform(args.server, args.csarFiles[i % len(args.csarFiles)], params, not args.no_upload)
+      error = result.get('error') if status != 200 else None
+    except (urllib2.URLError, IOError, ValueError), e:
+      status, result, error = None, {}, str(e)
+
+    duration = time.time() - start
+
+    lock.acquire()
+    try:
+      if error == None:
+        latencies.append(duration)
+        if result['cached']: cached[0] += 1
+      else:
+        failures.append((i, status, error))
+    finally:
+      lock.release()
+
+start = time.time()
+threads = [threading.Thread(target=sendRequests) for i in range(max(1, args.concurrency))]
+
+for thread in threads:
+  thread.daemon = True
+  thread.start()
+
+for thread in threads:
+  while thread.is_alive():
+    thread.join(1.0)
+
+duration = time.time() - start
+latencies.sort()
+
+report = {'requests': args.requests, 'concurrency': args.concurrency, 'ok': len(latencies), 'failed': len(failures), 'cached': cached[0], 'duration': duration, 'throughput': len(latencies) / duration if duration > 0 else 0.0}
+
+if len(latencies) > 0:
+  report['latency'] = dict((name, getPercentile(latencies, fraction)) for name, fraction in [('min', 0.0), ('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)])
+
+print str(report['ok']) + ' ok, ' + str(report['failed']) + ' failed, ' + str(report['cached']) + ' cached in ' + '%.2f' % duration + ' s (' + '%.1f' % report['throughput'] + ' requests/s)'
+
+if 'latency' in report:
+  print 'latency [s]: ' + ', '.join(name + ' ' + '%.3f' % report['latency'][name] for name in ['min', 'p50', 'p90', 'p99', 'max'])
+
+for i, status, error in failures[:5]:
+  print 'Request ' + str(i) + ' failed (' + str(status) + '): ' + error.strip().split('\n')[-1]
+
+if args.report != None:
+  reportFile = open(args.report, 'w')
+  reportFile.write(json.dumps(report, indent=2, sort_keys=True))
+  reportFile.close()
+
+if len(failures) > 0:
+  sys.exit(1)
@@ -11,8 +11,15 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
-import os, sys, zipfile, json, yaml, shutil, re
-from xml.dom.minidom import parse, Node
+import sys, json, yaml, re, multiprocessing
+from cStringIO import StringIO
+from csarfile import CsarError
+from tplloader import loadDom, loadStream
+from tplcache import getTemplateKey
+from topograph import TopologyGraph
+from typehier import TypeHierarchyError
+from charmmodel import RunList, Charm, Model
+import instrument
 
 # Returns the NCName for the given QName
 def getNCName(QName):
@@ -22,13 +29,68 @@ def convert(name):
   s1 = re.sub('(.)([A-Z][a-z]+)', r'\1-\2', name)
   return re.sub('([a-z0-9])([A-Z])', r'\1-\2', s1).lower()
 
+# Loads the service template of the given CsarFile: the one named by the
+# manifest of the CSAR, unless relServiceTpl is given. templateCache is an
+# optional TemplateCache shared by several loads, so identical templates of
+# different CSARs (or runs) are only parsed once; the discovered types are
+# printed either way. Raises CsarError and TypeHierarchyError.
+def loadServiceTemplate(csar, relServiceTpl=None, loader='dom', templateCache=None):
+  loadTemplate = loadStream if loader == 'stream' else loadDom
+
+  if relServiceTpl == None:
+    relServiceTpl = csar.getServiceTemplatePath()
+
+  if templateCache == None:
+    serviceTemplate = loadTemplate(csar.open(relServiceTpl))
+  else:
+    data = csar.read(relServiceTpl)
+    templateKey = getTemplateKey(loader, data)
+    serviceTemplate = templateCache.get(templateKey)
+
+    if serviceTemplate == None:
+      serviceTemplate = loadTemplate(StringIO(data))
+      templateCache.store(templateKey, serviceTemplate)
+
+  serviceTemplate.printDiscoveries()
+  return serviceTemplate
+
+# Annotations of the node and relationship templates made while one model is
+# built. They are kept apart from the templates, which are shared by all
+# transformations of a service template.
+class TransformState(object):
+  __slots__ = ('vms', 'processedNodes', 'processedSources', 'model', 'log')
+
+  def __init__(self):
+    self.vms = {} # node template -> id of the VM it is hosted on
+    self.processedNodes = set() # node templates whose install artifacts were processed
+    self.processedSources = set() # relationship templates whose source artifacts were processed
+    self.model = Model()
+    self.log = None # if a list, changes made to charms in the per-VM phase, see replayLog
+
+# Topologies with fewer VMs are transformed serially: starting the worker
+# processes would take longer than the per-VM phase itself
+minParallelVMs = 64
+
+# Transformer used by the worker processes of the pool, set by initTransformWorker
+workerTransformer = None
+
+def initTransformWorker(transformer):
+  global workerTransformer
+  workerTransformer = transformer
+
+  # Forget the counts inherited from the parent process
+  instrument.takeCounters()
+
+# Returns the result of ModelTransformer.transformPartition and the counters;
+# the parent adds up the counters
+def transformPartitionWorker(vmIds):
+  return workerTransformer.transformPartition(vmIds) + (instrument.takeCounters(),)
+
 class ModelTransformer:
-  def __init__(self, csarFile, absCsarDir, relServiceTpl):
-    self.chefArtifactType = 'http://docs.oasis-open.org/tosca/ns/2012/07/ChefArtifact'
-    self.chefNodeName = 'ChefArtifact'
-    self.lifecycleInterfaceName = 'http://docs.oasis-open.org/tosca/ns/2011/12/interfaces/lifecycle'
-    self.installOperationName = 'install'
-  
+  # csar is the CsarFile to transform; see loadServiceTemplate for the other
+  # arguments. Alternatively, an already loaded serviceTemplate is transformed
+  # and csar may be None.
+  def __init__(self, csar, relServiceTpl=None, loader='dom', templateCache=None, serviceTemplate=None):
     self.hostedOnType = 'HostedOnType'
     self.dependsOnType = 'DependsOnType'
     self.connectsToType = 'ConnectsToType'
@@ -37,234 +99,113 @@ class ModelTransformer:
   
     self.charmMaintainer = 'Charm Generator <charmgen@example.com>'
   
-    # Extract CSAR file
-    if os.path.isdir(absCsarDir):
-      shutil.rmtree(absCsarDir)
-  
-    os.makedirs(absCsarDir)
+    # Parse the service template straight from the CSAR
+    if serviceTemplate == None:
+      try:
+        serviceTemplate = loadServiceTemplate(csar, relServiceTpl, loader, templateCache)
+      except CsarError, e:
+        print str(e)
+        sys.exit(1)
+      except TypeHierarchyError, e:
+        print 'Invalid type hierarchy: ' + str(e)
+        sys.exit(1)
   
-    csar = zipfile.ZipFile(csarFile)
-    csar.extractall(absCsarDir)
-    csar.close()
-  
-    # Read service template and parse it
-    file = open(absCsarDir + '/' + relServiceTpl, 'r')
-    doc = parse(file)
-    file.close()
+    self.serviceTemplate = serviceTemplate
   
     # Find topology template
-    if len(doc.getElementsByTagName('TopologyTemplate')) == 0:
+    if not serviceTemplate.hasTopology:
       print 'Cannot find topology template.'
       sys.exit()
   
-    self.topologyTemplate = doc.getElementsByTagName('TopologyTemplate')[0]
+    self.graph = TopologyGraph(serviceTemplate.nodeTemplates, serviceTemplate.relationshipTemplates)
   
     # Build model structure
-    self.nodeTypes = {}
-    self.relationshipTypes = {}
-  
-    self.charms = {}
-    self.topology = {'nodes': {}, 'relations': {}}
-  
-    self.model = {'charms': self.charms, 'topology': self.topology}
-
-    # Discover node types
-    for nodeType in doc.getElementsByTagName('NodeType'):
-      nodeTypeId = nodeType.getAttribute('id')
-      nodeTypeName = nodeType.getAttribute('name')
-      derivedFrom = None
-    
-      if len(nodeType.getElementsByTagName('DerivedFrom')) > 0:
-        derivedFrom = nodeType.getElementsByTagName('DerivedFrom')[0].getAttribute('nodeTypeRef')
-  
-      # Add node type to dict
-      self.nodeTypes[nodeTypeId] = {'id': nodeTypeId, 'name': nodeTypeName, 'derivedFrom': derivedFrom, 'installArtifacts': []}
-      print 'Node type "' + nodeTypeId + '" discovered.'
-    
-      for interface in nodeType.getElementsByTagName('Interface'):
-        if interface.getAttribute('name') != self.lifecycleInterfaceName: continue
+    self.nodeTypes = serviceTemplate.nodeTypes
+    self.relationshipTypes = serviceTemplate.relationshipTypes
   
-        for artifact in interface.getElementsByTagName('ImplementationArtifact'):
-          if artifact.getAttribute('operationName') != self.installOperationName: continue
-          if artifact.getAttribute('type') != self.chefArtifactType: continue
-        
-          for child in artifact.childNodes:
-            if self.chefNodeName in child.nodeName:
-              chefArtifact = child
-            
-              # Add Chef artifact
-              self.nodeTypes[nodeTypeId]['installArtifacts'].append(chefArtifact)
-              print 'Node type "' + nodeTypeId + '": Chef artifact for "install" operation discovered.'
-
-    # Discover relationship types
-    for relType in doc.getElementsByTagName('RelationshipType'):
-      relTypeId = relType.getAttribute('id')
-      relTypeName = relType.getAttribute('name')
-      derivedFrom = None
-    
-      if len(relType.getElementsByTagName('DerivedFrom')) > 0:
-        derivedFrom = relType.getElementsByTagName('DerivedFrom')[0].getAttribute('relationshipTypeRef')
-  
-      # Add relationship type to dict
-      self.relationshipTypes[relTypeId] = {'id': relTypeId, 'name': relTypeName, 'derivedFrom': derivedFrom, 'sourceArtifacts': [], 'targetArtifacts': []}
-      print 'Relationship type "' + relTypeId + '" discovered.'
-    
-      sourceInterfaces = relType.getElementsByTagName('SourceInterfaces')
-      targetInterfaces = relType.getElementsByTagName('TargetInterfaces')
-  
-      if len(sourceInterfaces) > 0:
-        for artifact in sourceInterfaces[0].getElementsByTagName('ImplementationArtifact'):
-          if artifact.getAttribute('type') != self.chefArtifactType: continue
-        
-          for child in artifact.childNodes:
-            if self.chefNodeName in child.nodeName:
-              chefArtifact = child
-            
-              # Add Chef artifact
-              self.relationshipTypes[relTypeId]['sourceArtifacts'].append(chefArtifact)
-              print 'Relationship type "' + relTypeId + '": Chef artifact for "' + artifact.getAttribute('operationName') + '" operation discovered.'
-    
-      if len(targetInterfaces) > 0:
-        for artifact in targetInterfaces[0].getElementsByTagName('ImplementationArtifact'):
-          if artifact.getAttribute('type') != self.chefArtifactType: continue
-        
-          for child in artifact.childNodes:
-            if self.chefNodeName in child.nodeName:
-              chefArtifact = child
-            
-              # Add Chef artifact
-              self.relationshipTypes[relTypeId]['targetArtifacts'].append(chefArtifact)
-              print 'Relationship type "' + relTypeId + '": Chef artifact for "' + artifact.getAttribute('operationName') + '" operation discovered.'
-
-
+    # Properties returned by getNodeProperties (node id -> dict); overrides
+    # fork a new transformer, so they never change
+    self.nodeProperties = {}
   
   # Find all relationships for a given node template
   def findRelationships(self, nodeTemplate):
-    nodeTemplateId = nodeTemplate.getAttribute('id')
-    relationships = []
-  
-    for rel in self.topologyTemplate.childNodes:
-      if rel.nodeName == 'RelationshipTemplate':
-        source = rel.getElementsByTagName('SourceElement')[0]
-        target = rel.getElementsByTagName('TargetElement')[0]
-        
-        if source.getAttribute('id') == nodeTemplateId:
-          relationships.append(rel)
-          
-        if target.getAttribute('id') == nodeTemplateId:
-          relationships.append(rel)
-  
+    relationships = list(self.graph.getAdjacent(nodeTemplate.id))
+    
+    instrument.count('topology.lookups')
+    instrument.count('relationships.visited', len(relationships))
+    
     return relationships
   
   # Find all virtual machine nodes in the topology template
   def findVirtualMachines(self):
     vmNodes = []
     
-    for node in self.topologyTemplate.childNodes:
-      if node.nodeName == 'NodeTemplate' and node.getAttribute('nodeType') == self.vmType:
+    for node in self.graph.getNodes():
+      if node.nodeType == self.vmType:
         vmNodes.append(node)
     
     return vmNodes
   
   # Returns the node template which represents the source of the given relationship
   def getRelationshipSource(self, relationshipTemplate):
-    source = relationshipTemplate.getElementsByTagName('SourceElement')[0]
-    
-    for tpl in self.topologyTemplate.childNodes:
-      if tpl.nodeName == 'NodeTemplate' and tpl.getAttribute('id') == source.getAttribute('id'):
-        return tpl
-  
-    return None
+    instrument.count('topology.lookups')
+    return self.graph.getSource(relationshipTemplate)
   
   # Returns the node template which represents the target of the given relationship
   def getRelationshipTarget(self, relationshipTemplate):
-    target = relationshipTemplate.getElementsByTagName('TargetElement')[0]
-    
-    for tpl in self.topologyTemplate.childNodes:
-      if tpl.nodeName == 'NodeTemplate' and tpl.getAttribute('id') == target.getAttribute('id'):
-        return tpl
-  
-    return None
+    instrument.count('topology.lookups')
+    return self.graph.getTarget(relationshipTemplate)
   
   # Returns true iff the given node template is the source of the relationship
   def isRelationshipSource(self, nodeTemplate, relationshipTemplate):
-    nodeTemplateId = nodeTemplate.getAttribute('id')
-    sourceId = self.getRelationshipSource(relationshipTemplate).getAttribute('id')
-    
-    if sourceId == nodeTemplateId:
-      return True
-    else:
-      return False
+    return relationshipTemplate.sourceId == nodeTemplate.id
   
   # Returns true iff the given node template is the target of the relationship
   def isRelationshipTarget(self, nodeTemplate, relationshipTemplate):
-    nodeTemplateId = nodeTemplate.getAttribute('id')
-    sourceId = self.getRelationshipTarget(relationshipTemplate).getAttribute('id')
-    
-    if sourceId == nodeTemplateId:
-      return True
-    else:
-      return False
+    return relationshipTemplate.targetId == nodeTemplate.id
   
   # Returns true iff the given relationship crosses VM borders
-  def relationshipCrossesVMs(self, relationshipTemplate):
+  def relationshipCrossesVMs(self, state, relationshipTemplate):
     source = self.getRelationshipSource(relationshipTemplate)
     target = self.getRelationshipTarget(relationshipTemplate)
     
-    if source.getAttribute('vm') != target.getAttribute('vm'):
+    if state.vms.get(source) != state.vms.get(target):
       return True
     else:
       return False
   
   # Returns true iff the given relationship is of type "hosted on"
   def isHostedOnRelationship(self, relationshipType):
-    if relationshipType['id'] == self.hostedOnType: return True
-    else:
-      derivedFrom = relationshipType['derivedFrom']
-      
-      if derivedFrom == None: return False
-      else: return self.isHostedOnRelationship(self.relationshipTypes[derivedFrom])
+    return self.hostedOnType in relationshipType.ancestors
   
   # Returns true iff the given relationship is of type "depends on"
   def isDependsOnRelationship(self, relationshipType):
-    if relationshipType['id'] == self.dependsOnType: return True
-    else:
-      derivedFrom = relationshipType['derivedFrom']
-      
-      if derivedFrom == None: return False
-      else: return self.isDependsOnRelationship(self.relationshipTypes[derivedFrom])
+    return self.dependsOnType in relationshipType.ancestors
   
   # Returns true iff the given relationship is of type "connects to"
   def isConnectsToRelationship(self, relationshipType):
-    if relationshipType['id'] == self.connectsToType: return True
-    else:
-      derivedFrom = relationshipType['derivedFrom']
-      
-      if derivedFrom == None: return False
-      else: return self.isConnectsToRelationship(self.relationshipTypes[derivedFrom])
+    return self.connectsToType in relationshipType.ancestors
   
-  # Returns all the node properties as a dictionary
+  # Returns all the node properties as a dictionary: the properties of the
+  # node and of its neighbors. The result is cached, it must not be modified.
   def getNodeProperties(self, nodeTemplate):
-    props = {}
-  
-    def addProperties(propDefs, props):
-      if len(propDefs) > 0 and len(propDefs[0].childNodes) > 0:
-        for propSet in propDefs[0].childNodes:
-          if propSet.nodeType == Node.ELEMENT_NODE:
-            for prop in propSet.childNodes:
-              if prop.nodeType == Node.ELEMENT_NODE: props[prop.nodeName] = prop.firstChild.data
+    props = self.nodeProperties.get(nodeTemplate.id)
     
-    nodePropDefs = nodeTemplate.getElementsByTagName('PropertyDefaults')
-    addProperties(nodePropDefs, props)
+    if props != None:
+      instrument.count('properties.cached')
+      return props
     
-    for rel in self.findRelationships(nodeTemplate):
+    props = dict(nodeTemplate.properties)
+    
+    for rel in self.graph.getAdjacent(nodeTemplate.id):
       if self.isRelationshipTarget(nodeTemplate, rel):
-        propDefs = self.getRelationshipSource(rel).getElementsByTagName('PropertyDefaults')
+        neighbor = self.graph.getSource(rel)
       else:
-        propDefs = self.getRelationshipTarget(rel).getElementsByTagName('PropertyDefaults')
-  
-      if len(propDefs) > 0: addProperties(propDefs, props)
-  
+        neighbor = self.graph.getTarget(rel)
+      
+      props.update(neighbor.properties)
+    
+    self.nodeProperties[nodeTemplate.id] = props
     return props
   
   # Returns the node type of the given node template
@@ -273,7 +214,7 @@ class ModelTransformer:
   
   # Returns the name of the node type of the given node template
   def getNodeTypeName(self, nodeTemplate):
-    return getNCName(nodeTemplate.getAttribute('nodeType'))
+    return getNCName(nodeTemplate.nodeType)
   
   # Returns the relationship type of the given relationship template
   def getRelationshipType(self, relationshipTemplate):
@@ -281,12 +222,39 @@ class ModelTransformer:
   
   # Returns the name of the relationship type of the given relationship template
   def getRelationshipTypeName(self, relationshipTemplate):
-    return getNCName(relationshipTemplate.getAttribute('relationshipType'))
+    return getNCName(relationshipTemplate.relationshipType)
+  
+  # Runs a depth-first traversal from the given node without recursion.
+  # visit(node) returns a generator that processes the node and yields the
+  # nodes to visit next; each of them is traversed completely before the
+  # generator is resumed, just like a recursive call would be. Nodes that are
+  # already on the current path are not entered again, so cycles terminate.
+  def traverse(self, visit, startNode):
+    path = [(startNode, visit(startNode))]
+    onPath = set([startNode])
+    
+    while len(path) > 0:
+      node, visitor = path[-1]
+      
+      try:
+        nextNode = visitor.next()
+      except StopIteration:
+        path.pop()
+        onPath.discard(node)
+        continue
+      
+      if not nextNode in onPath:
+        path.append((nextNode, visit(nextNode)))
+        onPath.add(nextNode)
+  
+  # Annotates the given node and all nodes hosted on it with the given VM
+  def addVMAnnotations(self, state, node, vmId):
+    self.traverse(lambda current: self.visitVMAnnotations(state, current, vmId), node)
   
   # ...
-  def addVMAnnotations(self, node, vmId):
-    node.setAttribute('vm', vmId)
-    print 'Node "' + node.getAttribute('id') + '" is hosted on virtual machine "' + vmId + '".'
+  def visitVMAnnotations(self, state, node, vmId):
+    state.vms[node] = vmId
+    print 'Node "' + node.id + '" is hosted on virtual machine "' + vmId + '".'
   
     relationships = self.findRelationships(node)
     
@@ -295,27 +263,30 @@ class ModelTransformer:
   
       if self.isHostedOnRelationship(relType):
         if self.isRelationshipTarget(node, rel):
-          sourceNode = self.getRelationshipSource(rel)
-          self.addVMAnnotations(sourceNode, vmId)
+          yield self.getRelationshipSource(rel)
   
   # Process relationships for the given node that do not cross VM borders
-  def processNonCrossVMRelationships(self, node, charm):
+  def processNonCrossVMRelationships(self, state, node, charm):
+    self.traverse(lambda current: self.visitNonCrossVMRelationships(state, current, charm), node)
+  
+  # ...
+  def visitNonCrossVMRelationships(self, state, node, charm):
     relationships = self.findRelationships(node)
     
     for rel in relationships:
       relType = self.getRelationshipType(rel)
   
-      if self.isDependsOnRelationship(relType) and not self.relationshipCrossesVMs(rel):
-        if self.isRelationshipSource(node, rel) and not rel.hasAttribute('sourceProcessed'):
-          for artifact in relType['sourceArtifacts']:
-            self.processArtifact(artifact, charm['runLists']['install'], charm['cookbooks'], charm['roles'], charm['mappings'])
-            rel.setAttribute('sourceProcessed', 'true')
+      if self.isDependsOnRelationship(relType) and not self.relationshipCrossesVMs(state, rel):
+        if self.isRelationshipSource(node, rel) and not rel in state.processedSources:
+          for artifact in relType.sourceArtifacts:
+            self.addInstallArtifact(state, charm, artifact)
+            state.processedSources.add(rel)
   
-            print 'Relationship "' + rel.getAttribute('id') + '" between node "' + self.getRelationshipSource(rel).getAttribute('id') + '" and node "' + self.getRelationshipTarget(rel).getAttribute('id') + '" processed.'
+            print 'Relationship "' + rel.id + '" between node "' + self.getRelationshipSource(rel).id + '" and node "' + self.getRelationshipTarget(rel).id + '" processed.'
   
           targetNode = self.getRelationshipTarget(rel)
-          self.processNonCrossVMRelationships(targetNode, charm)
-          targetNode.setAttribute('processed', 'true')
+          yield targetNode
+          state.processedNodes.add(targetNode)
   
         #TODO: Target artifacts for relationships not yet implemented!
   
@@ -324,109 +295,268 @@ class ModelTransformer:
       nodeType = self.getNodeType(node)
   
       if self.isHostedOnRelationship(relType):
-        if self.isRelationshipSource(node, rel) and not rel.hasAttribute('sourceProcessed'):
-          for artifact in relType['sourceArtifacts']:
-            self.processArtifact(artifact, charm['runLists']['install'], charm['cookbooks'], charm['roles'], charm['mappings'])
-            rel.setAttribute('sourceProcessed', 'true')
+        if self.isRelationshipSource(node, rel) and not rel in state.processedSources:
+          for artifact in relType.sourceArtifacts:
+            self.addInstallArtifact(state, charm, artifact)
+            state.processedSources.add(rel)
   
-            print 'Relationship "' + rel.getAttribute('id') + '" between node "' + self.getRelationshipSource(rel).getAttribute('id') + '" and node "' + self.getRelationshipTarget(rel).getAttribute('id') + '" processed.'
+            print 'Relationship "' + rel.id + '" between node "' + self.getRelationshipSource(rel).id + '" and node "' + self.getRelationshipTarget(rel).id + '" processed.'
   
-          if not node.hasAttribute('processed'):
-            for artifact in nodeType['installArtifacts']:
-              self.processArtifact(artifact, charm['runLists']['install'], charm['cookbooks'], charm['roles'], charm['mappings'])
-              charm['properties'].update(self.getNodeProperties(node))
+          if not node in state.processedNodes:
+            for artifact in nodeType.installArtifacts:
+              self.addInstallArtifact(state, charm, artifact)
+              self.addDeployedComponent(state, charm, node)
               
-              charm['deployedComponents'].append({'id': node.getAttribute('id'), 'name': node.getAttribute('name'), 'type': nodeType['id']})
-              charm['name'] = node.getAttribute('id')
-              charm['summary'] = node.getAttribute('name')
-              
-            node.setAttribute('processed', 'true')
+            state.processedNodes.add(node)
   
         #TODO: Target artifacts for relationships not yet implemented!
         elif self.isRelationshipTarget(node, rel):
-          sourceNode = self.getRelationshipSource(rel)
-          self.processNonCrossVMRelationships(sourceNode, charm)
+          yield self.getRelationshipSource(rel)
+  
+  # Adds the given artifact to the install hook of the charm
+  def addInstallArtifact(self, state, charm, artifact):
+    self.processArtifact(artifact, charm.installRunList, charm.cookbooks, charm.roles, charm.mappings)
+    
+    if state.log != None:
+      state.log.append(('artifact', artifact))
+  
+  # Adds the given node template to the components deployed by the charm
+  def addDeployedComponent(self, state, charm, node):
+    charm.properties.update(self.getNodeProperties(node))
+    
+    charm.deployedComponents.append({'id': node.id, 'name': node.name, 'type': self.getNodeType(node).id})
+    charm.name = node.id
+    charm.summary = node.name
+    
+    if state.log != None:
+      state.log.append(('component', node.id))
+  
+  # Applies the changes logged while the per-VM phase built a charm in another
+  # process to the given charm. They are made in the same order again, so the
+  # dicts of the charm come out exactly as in a serial transformation, which
+  # unpickled dicts would not.
+  def replayLog(self, charm, log):
+    state = TransformState()
+    
+    for change, arg in log:
+      if change == 'artifact':
+        self.addInstallArtifact(state, charm, arg)
+      else:
+        self.addDeployedComponent(state, charm, self.graph.getNode(arg))
   
   # ...
   def processArtifact(self, artifact, runList, cookbooks, roles, mappings):
-    for cookbook in artifact.getElementsByTagName('Cookbook'):
-      cookbooks[cookbook.getAttribute('name')] = cookbook.getAttribute('cookbookLocation')
-    for role in artifact.getElementsByTagName('Role'):
-      roles[role.getAttribute('name')] = role.getAttribute('roleDefLocation')
-    for mapping in artifact.getElementsByTagName('PropertyMapping'):
-      mappings[mapping.getAttribute('propertyPath')[1:]] = mapping.getAttribute('cookbookAttribute')
-    for runListEntry in artifact.getElementsByTagName('RunList')[0].getElementsByTagName('Include')[0].getElementsByTagName('RunListEntry'):
-      entry = None
-    
-      if runListEntry.hasAttribute('roleName'):
-        entry = 'role[' + runListEntry.getAttribute('roleName') + ']'
-      elif runListEntry.hasAttribute('cookbookName') and runListEntry.hasAttribute('recipeName'):
-        entry = 'recipe[' + runListEntry.getAttribute('cookbookName') + '::' + runListEntry.getAttribute('recipeName') + ']'
-      elif runListEntry.hasAttribute('cookbookName'):
-        entry = 'recipe[' + runListEntry.getAttribute('cookbookName') + ']'
-  
-      if entry != None and not entry in runList:
-        runList.append(entry)
+    cookbooks.update(artifact.cookbooks)
+    roles.update(artifact.roles)
+    mappings.update(artifact.mappings)
+    runList.extend(artifact.runList)
+  
+  # ...
+  def processCrossVMRelationships(self, state, node, charm):
+    self.traverse(lambda current: self.visitCrossVMRelationships(state, current, charm), node)
   
   # ...
-  def processCrossVMRelationships(self, node, charm):
+  def visitCrossVMRelationships(self, state, node, charm):
     relationships = self.findRelationships(node)
     
-    if charm['vm'] != node.getAttribute('vm'):
+    if charm.vm != state.vms.get(node):
       return
     
+    topology = state.model.topology
+    
     for rel in relationships:
       relType = self.getRelationshipType(rel)
-      relTypeName = convert(relType['id'])
+      relTypeName = convert(relType.id)
       
-      if self.isRelationshipSource(node, rel) and self.relationshipCrossesVMs(rel) and not rel.hasAttribute('sourceProcessed'):
-        for artifact in relType['sourceArtifacts']:
-          runList = []
-          self.processArtifact(artifact, runList, charm['cookbooks'], charm['roles'], charm['mappings'])
+      if self.isRelationshipSource(node, rel) and self.relationshipCrossesVMs(state, rel) and not rel in state.processedSources:
+        for artifact in relType.sourceArtifacts:
+          runList = RunList()
+          self.processArtifact(artifact, runList, charm.cookbooks, charm.roles, charm.mappings)
   
-          charm['requires'][relTypeName] = {'runLists': {'relationJoined': runList}}
-          sourceCharm = self.topology['nodes'][node.getAttribute('vm')]['charm']
-          targetCharm = self.topology['nodes'][self.getRelationshipTarget(rel).getAttribute('vm')]['charm']
-          self.topology['relations'][sourceCharm + ':' + relTypeName] = targetCharm + ':' + relTypeName
-          rel.setAttribute('sourceProcessed', 'true')
+          charm.requires[relTypeName] = runList
+          sourceCharm = topology.nodes[state.vms[node]]
+          targetCharm = topology.nodes[state.vms[self.getRelationshipTarget(rel)]]
+          topology.relations[sourceCharm + ':' + relTypeName] = targetCharm + ':' + relTypeName
+          state.processedSources.add(rel)
   
-          print 'Relationship "' + rel.getAttribute('id') + '" between node "' + self.getRelationshipSource(rel).getAttribute('id') + '" and node "' + self.getRelationshipTarget(rel).getAttribute('id') + '" processed.'
+          print 'Relationship "' + rel.id + '" between node "' + self.getRelationshipSource(rel).id + '" and node "' + self.getRelationshipTarget(rel).id + '" processed.'
   
       elif self.isRelationshipTarget(node, rel):
-        if self.relationshipCrossesVMs(rel):
-          charm['provides'][relTypeName] = {'runLists': {'relationJoined': []}}
+        if self.relationshipCrossesVMs(state, rel):
+          charm.provides[relTypeName] = RunList()
       
-        sourceNode = self.getRelationshipSource(rel)
-        self.processCrossVMRelationships(sourceNode, charm)
+        yield self.getRelationshipSource(rel)
 
 
   
-  def transform(self):
+  # Returns the VMs grouped into partitions for the per-VM phase of the
+  # transformation: VMs whose stacks are connected by "hosted on"
+  # relationships share a partition. That phase never leaves the stack of a
+  # VM, so the partitions can be processed independently. The partitions and
+  # their VM ids keep the order of the given VMs.
+  def getPartitions(self, virtualMachines):
+    parents = {}
+    
+    def find(nodeId):
+      root = nodeId
+      while parents.get(root, root) != root:
+        root = parents[root]
+      
+      while nodeId != root:
+        parent = parents[nodeId]
+        parents[nodeId] = root
+        nodeId = parent
+      
+      return root
+    
+    for rel in self.graph.getRelationships():
+      if self.isHostedOnRelationship(self.getRelationshipType(rel)):
+        sourceRoot = find(rel.sourceId)
+        targetRoot = find(rel.targetId)
+        
+        if sourceRoot != targetRoot:
+          parents[sourceRoot] = targetRoot
+    
+    partitions = []
+    partitionOf = {}
+    
+    for vmNode in virtualMachines:
+      root = find(vmNode.id)
+      
+      if not root in partitionOf:
+        partitionOf[root] = len(partitions)
+        partitions.append([])
+      
+      partitions[partitionOf[root]].append(vmNode.id)
+    
+    return partitions
+  
+  # Runs the per-VM phase for the VMs of one partition, see getPartitions.
+  # Returns a result per VM, (VM id, output, log of the charm changes,
+  # description of the charm), and the annotations of the partition as ids:
+  # (VM id by node id, processed node ids, processed relationship ids).
+  def transformPartition(self, vmIds):
+    state = TransformState()
+    stdout = sys.stdout
+    results = []
+    
+    try:
+      for vmId in vmIds:
+        vmNode = self.graph.getNode(vmId)
+        charm = Charm(vmNode.id, vmNode.id, vmNode.name)
+        
+        state.log = []
+        sys.stdout = StringIO()
+        
+        self.addVMAnnotations(state, vmNode, vmNode.id)
+        self.processNonCrossVMRelationships(state, vmNode, charm)
+        
+        results.append((vmId, sys.stdout.getvalue(), state.log, self.getCharmDescription(charm)))
+    finally:
+      sys.stdout = stdout
+    
+    annotations = (
+      dict((node.id, vmId) for node, vmId in state.vms.items()),
+      [node.id for node in state.processedNodes],
+      [rel.id for rel in state.processedSources]
+    )
+    
+    return (results, annotations)
+  
+  # Runs the per-VM phase for the given partitions in a pool of worker
+  # processes and merges their results into the state, VM by VM in the
+  # original order
+  def transformPartitions(self, state, virtualMachines, partitions, workers):
+    pool = multiprocessing.Pool(workers, initTransformWorker, (self,))
+    try:
+      partitionResults = pool.map(transformPartitionWorker, partitions, 1)
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+    
+    vmResults = {}
+    
+    for results, annotations, counters in partitionResults:
+      instrument.addCounters(counters)
+      
+      for result in results:
+        vmResults[result[0]] = result
+      
+      vms, processedNodes, processedSources = annotations
+      
+      for nodeId, vmId in vms.items():
+        state.vms[self.graph.getNode(nodeId)] = vmId
+      
+      state.processedNodes.update(self.graph.getNode(nodeId) for nodeId in processedNodes)
+      state.processedSources.update(self.graph.getRelationship(relId) for relId in processedSources)
+    
+    for vmNode in virtualMachines:
+      vmId, output, log, description = vmResults[vmNode.id]
+      sys.stdout.write(output)
+      
+      charm = Charm(vmNode.id, vmNode.id, vmNode.name)
+      self.replayLog(charm, log)
+      charm.description = description
+      
+      charmName = convert(charm.name)
+      state.model.topology.nodes[vmNode.id] = charmName
+      state.model.charms[charmName] = charm
+  
+  # Returns the description of the charm, listing its components and properties
+  def getCharmDescription(self, charm):
+    return yaml.safe_dump({'Deployed Components': charm.deployedComponents, 'Properties': charm.properties}, default_flow_style=False)
+  
+  # Builds and returns a new model; the templates are not modified, so the
+  # same transformer can be used any number of times. overrides optionally
+  # changes property defaults of node templates for this model only, see
+  # ServiceTemplate.fork. With more than one worker, the per-VM phase runs
+  # in a pool of worker processes (see getPartitions) for topologies of at
+  # least minParallelVMs VMs; the model is the same as with a single worker,
+  # which runs everything in this process.
+  def transform(self, overrides=None, workers=1):
+    if overrides:
+      variant = ModelTransformer(None, serviceTemplate=self.serviceTemplate.fork(overrides))
+      return variant.transform(workers=workers)
+  
+    state = TransformState()
+    charms = state.model.charms
+    topology = state.model.topology
+  
     # Build the model based on the nodes and relationships in the topology template
     virtualMachines = self.findVirtualMachines()
+    partitions = self.getPartitions(virtualMachines) if workers > 1 and len(virtualMachines) >= minParallelVMs else []
   
-    for vmNode in virtualMachines:
-      charm = {'vm': vmNode.getAttribute('id'), 'name': vmNode.getAttribute('id'), 'summary': vmNode.getAttribute('name'), 'runLists': {'install': []}, 'deployedComponents': [], 'provides': {}, 'requires': {}, 'properties': {}, 'cookbooks': {}, 'roles': {}, 'mappings': {}}
-    
-      self.addVMAnnotations(vmNode, vmNode.getAttribute('id'))
-      self.processNonCrossVMRelationships(vmNode, charm)
+    if min(workers, len(partitions)) > 1:
+      self.transformPartitions(state, virtualMachines, partitions, min(workers, len(partitions)))
+    else:
+      for vmNode in virtualMachines:
+        charm = Charm(vmNode.id, vmNode.id, vmNode.name)
+      
+        self.addVMAnnotations(state, vmNode, vmNode.id)
+        self.processNonCrossVMRelationships(state, vmNode, charm)
 	  
-      charmName = convert(charm['name'])
+        charmName = convert(charm.name)
   
-      self.topology['nodes'][vmNode.getAttribute('id')] = {'charm': charmName}
+        topology.nodes[vmNode.id] = charmName
   
-      self.charms[charmName] = charm
+        charms[charmName] = charm
   
     for vmNode in virtualMachines:
-      charm = self.charms[self.topology['nodes'][vmNode.getAttribute('id')]['charm']]
+      charm = charms[topology.nodes[vmNode.id]]
     
-      self.processCrossVMRelationships(vmNode, charm)
+      self.processCrossVMRelationships(state, vmNode, charm)
   
-    for charm in self.charms.values():
-      del charm['name']
-      del charm['vm']
+    for charm in charms.values():
+      charm.name = None
+      charm.vm = None
     
-      charm['maintainer'] = self.charmMaintainer
-      charm['description'] = yaml.safe_dump({'Deployed Components': charm['deployedComponents'], 'Properties': charm['properties']}, default_flow_style=False)
+      charm.maintainer = self.charmMaintainer
+      
+      # Workers describe the charms they build
+      if charm.description == None:
+        charm.description = self.getCharmDescription(charm)
 
-    return self.model
\ No newline at end of file
+    return state.model
\ No newline at end of file
@@ -0,0 +1,168 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import subprocess, threading, time, yaml
+import instrument
+
+#
+# Watches the state of deployed services by polling "juju status". Threads
+# that wait for services share the polls: at most one "juju status" runs at a
+# time, and not more often than the poll interval.
+#
+
+# Returns the state of a unit in the output of "juju status": 'ready',
+# 'error' or 'pending'. Knows the format of Juju 1.x ("agent-state") and of
+# Juju 2.x ("juju-status" and "workload-status").
+def getUnitState(unit):
+  if 'agent-state' in unit:
+    agentState = unit['agent-state']
+
+    if agentState == 'started': return 'ready'
+    if agentState == 'error': return 'error'
+    return 'pending'
+
+  agentState = (unit.get('juju-status') or {}).get('current')
+  workloadState = (unit.get('workload-status') or {}).get('current')
+
+  if agentState == 'error' or workloadState in ('error', 'blocked'): return 'error'
+  if agentState == 'idle' and workloadState in ('active', 'unknown', None): return 'ready'
+  return 'pending'
+
+# Parses the output of "juju status --format yaml" (or json) and returns the
+# unit states (see getUnitState) of every service by service name
+def parseStatus(output):
+  status = yaml.safe_load(output) or {}
+  services = status.get('services') or status.get('applications') or {}
+
+  unitStates = {}
+  for name, service in services.items():
+    units = (service or {}).get('units') or {}
+    unitStates[name] = [getUnitState(unit or {}) for unit in units.values()]
+
+  return unitStates
+
+# Returns the state of a service from the states of its units: 'error' if any
+# unit failed, 'ready' once all units are ready, otherwise 'pending'
+def getServiceState(unitStates):
+  if unitStates == None or len(unitStates) == 0:
+    return 'pending'
+
+  if 'error' in unitStates:
+    return 'error'
+
+  if len([state for state in unitStates if state != 'ready']) == 0:
+    return 'ready'
+
+  return 'pending'
+
+class DeploymentMonitor:
+  # statusCommand is the command that prints the status, parser turns its
+  # output into the unit states by service name (see parseStatus); both can
+  # be replaced, e.g. to watch a fake juju in tests
+  def __init__(self, statusCommand, parser=parseStatus, pollInterval=5.0, timeout=900.0):
+    self.statusCommand = statusCommand
+    self.parser = parser
+    self.pollInterval = pollInterval
+    self.timeout = timeout
+
+    self.condition = threading.Condition()
+    self.unitStates = {}
+    self.statesTime = 0.0 # start of the poll that returned unitStates
+    self.polling = False
+    self.nextPoll = 0.0
+
+  # Runs the status command once and returns the parsed status, or None if
+  # the command failed
+  def poll(self):
+    instrument.count('status.polls')
+
+    try:
+      process = subprocess.Popen(self.statusCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      output = process.communicate()[0]
+    except OSError:
+      instrument.count('status.failed')
+      return None
+
+    if process.returncode != 0:
+      instrument.count('status.failed')
+      return None
+
+    try:
+      return self.parser(output)
+    except Exception:
+      instrument.count('status.failed')
+      return None
+
+  # Waits until all units of the given service are ready, or one of them
+  # failed, or the timeout expired. Returns 'ready', 'error' or 'timeout'.
+  def waitForService(self, service):
+    def check(unitStates):
+      state = getServiceState(unitStates.get(service))
+      if state != 'pending':
+        return state
+
+    return self.waitFor(check)
+
+  # Waits until the given service has left the status, e.g. once it is
+  # destroyed, or the timeout expired. Returns 'removed' or 'timeout'.
+  def waitForRemoval(self, service):
+    def check(unitStates):
+      if not service in unitStates:
+        return 'removed'
+
+    return self.waitFor(check)
+
+  # Waits until check returns a result other than None for the unit states
+  # by service name, or the timeout expired, and returns that result or
+  # 'timeout'. Only polls started after the call count, so states from
+  # before a (re)deployment or removal are never taken for the new one.
+  def waitFor(self, check):
+    waitStart = time.time()
+    deadline = waitStart + self.timeout
+
+    self.condition.acquire()
+    try:
+      while True:
+        if self.statesTime >= waitStart:
+          result = check(self.unitStates)
+          if result != None:
+            return result
+
+        now = time.time()
+        if now >= deadline:
+          return 'timeout'
+
+        if self.polling or now < self.nextPoll:
+          # Another thread polls, or the next poll is not due yet
+          self.condition.wait(min(deadline, self.nextPoll) - now if not self.polling else deadline - now)
+          continue
+
+        self.polling = True
+        self.condition.release()
+        pollStart = time.time()
+        unitStates = None
+
+        try:
+          unitStates = self.poll()
+        finally:
+          self.condition.acquire()
+          self.polling = False
+          self.nextPoll = time.time() + self.pollInterval
+
+          if unitStates != None:
+            self.unitStates = unitStates
+            self.statesTime = pollStart
+
+          self.condition.notifyAll()
+    finally:
+      self.condition.release()
@@ -0,0 +1,86 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, sys, shutil, tempfile, zipfile
+from cStringIO import StringIO
+
+#
+# Shared by the tests, which run from the tosca-juju directory:
+#
+#   python -m unittest discover -s tests
+#
+
+toolsDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sampleDir = os.path.join(os.path.dirname(toolsDir), 'samples', 'SugarCRM_ChefManaged_csd03')
+fakeJujuPath = os.path.join(toolsDir, 'fake-juju.py')
+
+if not toolsDir in sys.path:
+  sys.path.insert(0, toolsDir)
+
+from csarfile import CsarFile
+from modeltrans import ModelTransformer
+
+# Zips the SugarCRM sample into a CSAR at the given path
+def makeSampleCsar(path):
+  archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+  for root, dirs, files in os.walk(sampleDir):
+    dirs.sort()
+    for name in sorted(files):
+      filePath = os.path.join(root, name)
+      archive.write(filePath, os.path.relpath(filePath, sampleDir))
+
+  archive.close()
+
+# Returns the model of the SugarCRM sample; the progress messages of the
+# transformation are dropped
+def loadSampleModel(overrides=None):
+  workDir = tempfile.mkdtemp()
+  stdout = sys.stdout
+
+  try:
+    makeSampleCsar(workDir + '/sample.zip')
+    csar = CsarFile(workDir + '/sample.zip')
+
+    try:
+      sys.stdout = StringIO()
+      return ModelTransformer(csar).transform(overrides)
+    finally:
+      sys.stdout = stdout
+      csar.close()
+  finally:
+    shutil.rmtree(workDir)
+
+# Puts a "juju" that runs fake-juju.py on PATH and keeps its state in a
+# temporary directory. The FAKE_JUJU_* settings are passed to it through the
+# environment; restore() undoes everything.
+class FakeJuju:
+  def __init__(self, **settings):
+    self.dir = tempfile.mkdtemp()
+    self.environ = dict(os.environ)
+
+    script = open(self.dir + '/juju', 'w')
+    script.write('#!/bin/sh\nexec "' + sys.executable + '" "' + fakeJujuPath + '" "$@"\n')
+    script.close()
+    os.chmod(self.dir + '/juju', 0755)
+
+    os.environ['PATH'] = self.dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['FAKE_JUJU_STATE'] = self.dir + '/fake-juju.json'
+
+    for name, value in settings.items():
+      os.environ['FAKE_JUJU_' + name.upper()] = str(value)
+
+  def restore(self):
+    os.environ.clear()
+    os.environ.update(self.environ)
+    shutil.rmtree(self.dir)
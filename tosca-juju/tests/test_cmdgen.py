@@ -0,0 +1,94 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import copy, unittest, yaml
+import support
+
+from cmdgen import CommandGenerator, compareBundle
+
+# The bundle written for the SugarCRM sample must describe the same
+# deployment as the plan, and a bundle that does not must be rejected
+class CompareBundleTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.model = support.loadSampleModel()
+
+  def setUp(self):
+    self.cmdGen = CommandGenerator(self.model, 'charms', 'precise', 'test')
+
+  # Returns the bundle after writing and reading it, like create-instance.py
+  def roundTrip(self, bundle):
+    return yaml.safe_load(yaml.safe_dump(bundle, default_flow_style=False))
+
+  def testSampleBundleMatchesPlan(self):
+    for skipRedundant in [False, True]:
+      bundle = self.roundTrip(self.cmdGen.generateBundle('sugarcrm', skipRedundant))
+      commands = self.cmdGen.generatePlan().getCommands(skipRedundant)
+
+      self.assertEqual(sorted(bundle['sugarcrm']['services'].keys()), ['sugar-crm-app', 'sugar-crm-db'])
+      self.assertEqual(compareBundle(bundle, commands), [])
+
+  def testSampleBundleMatchesCommands(self):
+    bundle = self.roundTrip(self.cmdGen.generateBundle('sugarcrm'))
+    self.assertEqual(compareBundle(bundle, self.cmdGen.generate()), [])
+
+  def testMismatchedBundleIsRejected(self):
+    bundle = self.roundTrip(self.cmdGen.generateBundle('sugarcrm'))
+    commands = self.cmdGen.generatePlan().getCommands()
+
+    # Every kind of difference is reported on its own
+    changed = copy.deepcopy(bundle)
+    changed['sugarcrm']['services']['sugar-crm-app']['num_units'] = 2
+    self.assertEqual(len(compareBundle(changed, commands)), 1)
+
+    changed = copy.deepcopy(bundle)
+    changed['sugarcrm']['services']['sugar-crm-db']['charm'] = 'local:precise/mysql'
+    self.assertEqual(len(compareBundle(changed, commands)), 1)
+
+    changed = copy.deepcopy(bundle)
+    changed['sugarcrm']['relations'] = []
+    differences = compareBundle(changed, commands)
+    self.assertEqual(len(differences), 1)
+    self.assertIn('only in the commands', differences[0])
+
+    changed = copy.deepcopy(bundle)
+    del changed['sugarcrm']['services']['sugar-crm-app']['expose']
+    differences = compareBundle(changed, commands)
+    self.assertEqual(differences, ['Service "sugar-crm-app" only exposed in the commands.'])
+
+    changed = copy.deepcopy(bundle)
+    changed['sugarcrm']['services']['sugar-crm-web'] = changed['sugarcrm']['services'].pop('sugar-crm-app')
+    self.assertNotEqual(compareBundle(changed, commands), [])
+
+  def testPlanOfOtherModelIsRejected(self):
+    bundle = self.roundTrip(self.cmdGen.generateBundle('sugarcrm'))
+
+    other = copy.deepcopy(self.model)
+    other.topology.relations.clear()
+    commands = CommandGenerator(other, 'charms', 'precise', 'test').generatePlan().getCommands()
+
+    differences = compareBundle(bundle, commands)
+    self.assertEqual(len(differences), len(self.model.topology.relations))
+    self.assertIn('only in the bundle', differences[0])
+
+    # Mapping another VM to a charm adds a unit to its service
+    other = copy.deepcopy(self.model)
+    other.topology.nodes['VmApache2'] = 'sugar-crm-app'
+    commands = CommandGenerator(other, 'charms', 'precise', 'test').generatePlan().getCommands()
+
+    differences = compareBundle(bundle, commands)
+    self.assertEqual(len(differences), 1)
+    self.assertIn('sugar-crm-app', differences[0])
+
+if __name__ == '__main__':
+  unittest.main()
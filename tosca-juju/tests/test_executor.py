@@ -0,0 +1,174 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json, os, subprocess, threading, unittest
+import support
+
+from cmdgen import CommandGenerator
+from executor import CommandExecutor, buildDependencies
+from monitor import DeploymentMonitor
+
+# Runs commands against fake-juju.py, which is on PATH as "juju"
+class CommandExecutorTest(unittest.TestCase):
+  def setUp(self):
+    self.fakeJuju = support.FakeJuju(delay=0.2)
+    self.started = []
+    self.lock = threading.Lock()
+
+  def tearDown(self):
+    self.fakeJuju.restore()
+
+  # Returns an executor that records the commands it starts and does not
+  # wait long between attempts
+  def getExecutor(self, **options):
+    executor = CommandExecutor(initialDelay=0.01, maxDelay=0.05, **options)
+    executor.onStart = self.recordStart
+    return executor
+
+  def recordStart(self, cmd):
+    self.lock.acquire()
+    try:
+      self.started.append(cmd)
+    finally:
+      self.lock.release()
+
+  def getState(self):
+    return json.load(open(os.environ['FAKE_JUJU_STATE'], 'r'))
+
+  def testDependencies(self):
+    commands = [
+      ['juju', 'deploy', 'local:precise/db', '-e', 'test'],
+      ['juju', 'deploy', 'local:precise/app', '-e', 'test'],
+      ['juju', 'add-relation', 'app:db', 'db:db', '-e', 'test'],
+      ['juju', 'expose', 'app', '-e', 'test'],
+      ['juju', 'status', '-e', 'test'],
+      ['juju', 'set', 'db', 'name=crm', '-e', 'test']
+    ]
+
+    # Unknown commands are barriers; everything else follows its deployment
+    self.assertEqual(buildDependencies(commands), [set(), set(), set([0, 1]), set([1]), set([0, 1, 2, 3]), set([0, 4])])
+
+    # With a single attempt, any command run before its deployment fails
+    results = self.getExecutor(concurrency=4, maxAttempts=1).run(commands)
+
+    self.assertEqual([result.status for result in results], ['ok'] * len(commands))
+    for i, deps in enumerate(buildDependencies(commands)):
+      for dep in deps:
+        self.assertTrue(results[dep].start + results[dep].duration <= results[i].start)
+
+    # The deployments do not wait for each other
+    self.assertTrue(max(results[0].start, results[1].start) < min(results[0].start + results[0].duration, results[1].start + results[1].duration))
+
+    state = self.getState()
+    self.assertEqual(state['relations'], [['app:db', 'db:db']])
+    self.assertTrue(state['services']['app']['exposed'])
+    self.assertEqual(state['services']['db']['config'], {'name': 'crm'})
+
+  def testPlanOfSample(self):
+    plan = CommandGenerator(support.loadSampleModel(), 'charms', 'precise', 'test').generatePlan()
+    results = self.getExecutor(concurrency=4, maxAttempts=1).runPlan(plan)
+
+    self.assertEqual([result.status for result in results], ['ok'] * len(plan.steps))
+    self.assertEqual(sorted(self.getState()['services'].keys()), ['sugar-crm-app', 'sugar-crm-db'])
+
+    # Relations and exposing only start once the services are deployed
+    deployed = len([step for step in plan.steps if step.kind == 'deploy'])
+    self.assertEqual(sorted(cmd[1] for cmd in self.started[:deployed]), ['deploy'] * deployed)
+
+  def testConcurrency(self):
+    commands = [['juju', 'deploy', 'local:precise/service' + str(i), '-e', 'test'] for i in range(6)]
+    results = self.getExecutor(concurrency=2).run(commands)
+
+    self.assertEqual([result.status for result in results], ['ok'] * len(commands))
+
+    # No more than two commands run at any time
+    for result in results:
+      running = [other for other in results if other.start <= result.start < other.start + other.duration]
+      self.assertTrue(len(running) <= 2)
+
+  def testRetryUntilMaxAttempts(self):
+    commands = [
+      ['juju', 'expose', 'missing', '-e', 'test'],
+      ['juju', 'set', 'missing', 'name=crm', '-e', 'test'],
+      ['juju', 'deploy', 'local:precise/db', '-e', 'test']
+    ]
+
+    results = self.getExecutor(maxAttempts=3).execute(commands, [set(), set([0]), set()])
+
+    self.assertEqual(results[0].status, 'failed')
+    self.assertEqual(results[0].attempts, 3)
+    self.assertEqual(results[0].returnCode, 1)
+    self.assertEqual(self.started.count(commands[0]), 3)
+
+    # Commands that depend on a failed one are skipped, others still run
+    self.assertEqual(results[1].status, 'skipped')
+    self.assertEqual(results[1].attempts, 0)
+    self.assertEqual(results[2].status, 'ok')
+
+  def testRetryUntilSuccess(self):
+    marker = self.fakeJuju.dir + '/marker'
+    command = ['sh', '-c', 'test -f ' + marker + ' || { touch ' + marker + '; exit 1; }']
+
+    results = self.getExecutor(maxAttempts=3).run([command])
+
+    self.assertEqual(results[0].status, 'ok')
+    self.assertEqual(results[0].attempts, 2)
+
+  def testCommandTimeout(self):
+    results = self.getExecutor(maxAttempts=2, commandTimeout=0.2).run([['sleep', '5']])
+
+    self.assertEqual(results[0].status, 'failed')
+    self.assertEqual(results[0].returnCode, -1)
+    self.assertEqual(results[0].attempts, 2)
+
+  def testUnknownCommand(self):
+    results = self.getExecutor(maxAttempts=2).run([['no-such-command-' + str(id(self))]])
+
+    self.assertEqual(results[0].status, 'failed')
+    self.assertEqual(results[0].returnCode, -1)
+    self.assertEqual(results[0].attempts, 2)
+
+  def testWaitForUnits(self):
+    os.environ['FAKE_JUJU_FAIL'] = 'broken'
+    monitor = DeploymentMonitor(['juju', 'status', '--format', 'yaml', '-e', 'test'], pollInterval=0.05, timeout=10.0)
+
+    commands = [
+      ['juju', 'deploy', 'local:precise/db', '-e', 'test'],
+      ['juju', 'deploy', 'local:precise/broken', '-e', 'test'],
+      ['juju', 'expose', 'broken', '-e', 'test']
+    ]
+    results = self.getExecutor(monitor=monitor).run(commands)
+
+    self.assertEqual(results[0].status, 'ok')
+    self.assertTrue(results[0].readyAfter >= 0.2)
+    self.assertEqual(results[1].status, 'error')
+    self.assertEqual(results[2].status, 'skipped')
+
+  def testRedeployWaitsForRemoval(self):
+    os.environ['FAKE_JUJU_REMOVE_DELAY'] = '0.5'
+    subprocess.check_call(['juju', 'deploy', 'local:precise/db', '-e', 'test'])
+
+    monitor = DeploymentMonitor(['juju', 'status', '--format', 'yaml', '-e', 'test'], pollInterval=0.05, timeout=10.0)
+    commands = [
+      ['juju', 'destroy-service', 'db', '-e', 'test'],
+      ['juju', 'deploy', '-n', '2', 'local:precise/db', '-e', 'test']
+    ]
+    results = self.getExecutor(maxAttempts=1, monitor=monitor, waitForReady=False).execute(commands, [set(), set([0])])
+
+    # The deployment fails as long as the destroyed service is still there
+    self.assertEqual([result.status for result in results], ['ok', 'ok'])
+    self.assertEqual(results[1].readyAfter, None)
+    self.assertEqual(self.getState()['services']['db']['units'], 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,209 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json, os, subprocess, threading, time, unittest
+import support
+
+from monitor import DeploymentMonitor, getServiceState, parseStatus
+
+juju1Status = """
+environment: test
+machines:
+  '0': {agent-state: started}
+services:
+  db:
+    charm: local:precise/db
+    units:
+      db/0: {agent-state: started, machine: '1'}
+      db/1: {agent-state: pending, machine: '2'}
+  app:
+    charm: local:precise/app
+    units:
+      app/0: {agent-state: error, machine: '3'}
+  idle:
+    charm: local:precise/idle
+"""
+
+juju2Status = {
+  'model': {'name': 'test'},
+  'applications': {
+    'db': {'units': {
+      'db/0': {'juju-status': {'current': 'idle'}, 'workload-status': {'current': 'active'}},
+      'db/1': {'juju-status': {'current': 'idle'}, 'workload-status': {'current': 'unknown'}}
+    }},
+    'app': {'units': {
+      'app/0': {'juju-status': {'current': 'executing'}, 'workload-status': {'current': 'maintenance'}}
+    }},
+    'web': {'units': {
+      'web/0': {'juju-status': {'current': 'idle'}, 'workload-status': {'current': 'blocked'}}
+    }},
+    'cache': {'units': {
+      'cache/0': {'juju-status': {'current': 'error'}, 'workload-status': {'current': 'active'}}
+    }}
+  }
+}
+
+class ParseStatusTest(unittest.TestCase):
+  def testJuju1(self):
+    unitStates = parseStatus(juju1Status)
+
+    self.assertEqual(sorted(unitStates['db']), ['pending', 'ready'])
+    self.assertEqual(unitStates['app'], ['error'])
+    self.assertEqual(unitStates['idle'], [])
+
+    self.assertEqual(getServiceState(unitStates['db']), 'pending')
+    self.assertEqual(getServiceState(unitStates['app']), 'error')
+    self.assertEqual(getServiceState(unitStates['idle']), 'pending')
+    self.assertEqual(getServiceState(unitStates.get('missing')), 'pending')
+
+  def testJuju2(self):
+    for output in [json.dumps(juju2Status), json.dumps(juju2Status, indent=2)]:
+      unitStates = parseStatus(output)
+
+      self.assertEqual(unitStates['db'], ['ready', 'ready'])
+      self.assertEqual(unitStates['app'], ['pending'])
+      self.assertEqual(unitStates['web'], ['error'])
+      self.assertEqual(unitStates['cache'], ['error'])
+      self.assertEqual(getServiceState(unitStates['db']), 'ready')
+
+  def testEmpty(self):
+    self.assertEqual(parseStatus(''), {})
+    self.assertEqual(parseStatus('environment: test\nservices: {}\n'), {})
+
+  def testFakeJuju(self):
+    fakeJuju = support.FakeJuju(delay=0)
+
+    try:
+      subprocess.check_call(['juju', 'deploy', '-n', '2', 'local:precise/db', '-e', 'test'])
+
+      for outputFormat in ['yaml', 'json']:
+        output = subprocess.Popen(['juju', 'status', '--format', outputFormat], stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual(parseStatus(output), {'db': ['ready', 'ready']})
+    finally:
+      fakeJuju.restore()
+
+# Replaces "juju status" by a function of the number of the poll; records
+# how many polls ran at the same time
+class ScriptedMonitor(DeploymentMonitor):
+  def __init__(self, script, pollTime, **options):
+    DeploymentMonitor.__init__(self, None, **options)
+    self.script = script
+    self.pollTime = pollTime
+    self.polls = 0
+    self.inFlight = 0
+    self.maxInFlight = 0
+    self.lock = threading.Lock()
+
+  def poll(self):
+    self.lock.acquire()
+    try:
+      self.polls += 1
+      number = self.polls
+      self.inFlight += 1
+      self.maxInFlight = max(self.maxInFlight, self.inFlight)
+    finally:
+      self.lock.release()
+
+    time.sleep(self.pollTime)
+
+    self.lock.acquire()
+    try:
+      self.inFlight -= 1
+    finally:
+      self.lock.release()
+
+    return self.script(number)
+
+class DeploymentMonitorTest(unittest.TestCase):
+  # Waits for the given services in threads of their own and returns the
+  # results by service
+  def waitConcurrently(self, monitor, services, wait=None):
+    results = {}
+    lock = threading.Lock()
+
+    def waiter(service):
+      result = (wait or monitor.waitForService)(service)
+      lock.acquire()
+      try:
+        results[service] = result
+      finally:
+        lock.release()
+
+    threads = [threading.Thread(target=waiter, args=(service,)) for service in services]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    return results
+
+  def testConcurrentWaitersSharePolls(self):
+    services = ['service' + str(i) for i in range(8)]
+
+    # Ready from the third poll on, one service fails
+    def script(number):
+      state = 'ready' if number >= 3 else 'pending'
+      unitStates = dict((service, [state]) for service in services)
+      unitStates['service7'] = ['error'] if number >= 3 else ['pending']
+      return unitStates
+
+    monitor = ScriptedMonitor(script, 0.05, pollInterval=0.1, timeout=10.0)
+    results = self.waitConcurrently(monitor, services)
+
+    self.assertEqual(results, dict((service, 'ready' if service != 'service7' else 'error') for service in services))
+    self.assertEqual(monitor.maxInFlight, 1)
+
+    # Waiters that came late for the first poll take the next one
+    self.assertTrue(3 <= monitor.polls <= 4)
+
+  def testFailedPollsAreRetried(self):
+    monitor = ScriptedMonitor(lambda number: {'db': ['ready']} if number >= 3 else None, 0.0, pollInterval=0.01, timeout=10.0)
+
+    self.assertEqual(monitor.waitForService('db'), 'ready')
+    self.assertEqual(monitor.polls, 3)
+
+  def testOnlyLaterPollsCount(self):
+    monitor = ScriptedMonitor(lambda number: {'db': ['ready' if number == 1 else 'pending']}, 0.0, pollInterval=0.01, timeout=0.2)
+
+    self.assertEqual(monitor.waitForService('db'), 'ready')
+
+    # The poll that found the earlier deployment ready does not count again
+    self.assertEqual(monitor.waitForService('db'), 'timeout')
+
+  def testRemoval(self):
+    monitor = ScriptedMonitor(lambda number: {'db': ['ready']} if number < 3 else {}, 0.05, pollInterval=0.05, timeout=10.0)
+    results = self.waitConcurrently(monitor, ['db', 'app'], monitor.waitForRemoval)
+
+    self.assertEqual(results, {'db': 'removed', 'app': 'removed'})
+    self.assertEqual(monitor.maxInFlight, 1)
+
+  def testFakeJuju(self):
+    fakeJuju = support.FakeJuju(delay=0.3, fail='broken', remove_delay=0.3)
+
+    try:
+      for service in ['db', 'app', 'broken']:
+        subprocess.check_call(['juju', 'deploy', 'local:precise/' + service, '-e', 'test'])
+
+      monitor = DeploymentMonitor(['juju', 'status', '--format', 'yaml', '-e', 'test'], pollInterval=0.05, timeout=10.0)
+      self.assertEqual(self.waitConcurrently(monitor, ['db', 'app', 'broken']), {'db': 'ready', 'app': 'ready', 'broken': 'error'})
+
+      subprocess.check_call(['juju', 'destroy-service', 'app', '-e', 'test'])
+      self.assertEqual(monitor.waitForRemoval('app'), 'removed')
+      self.assertEqual(self.waitConcurrently(monitor, ['db']), {'db': 'ready'})
+
+      # A service that never shows up
+      monitor.timeout = 0.3
+      self.assertEqual(monitor.waitForService('missing'), 'timeout')
+    finally:
+      fakeJuju.restore()
+
+if __name__ == '__main__':
+  unittest.main()
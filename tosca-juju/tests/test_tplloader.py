@@ -0,0 +1,109 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, sys, shutil, tempfile, unittest
+import support
+
+from cStringIO import StringIO
+from xml.etree import ElementTree
+
+from csarfile import CsarFile
+from modeltrans import loadServiceTemplate
+from tplcache import TemplateCache
+from tplloader import loadDom, loadStream
+
+# Returns the given service template as nested tuples that compare equal for
+# equal models
+def describeTemplate(tpl):
+  def describeArtifacts(artifacts):
+    return [(a.cookbooks, a.roles, a.mappings, a.runList) for a in artifacts]
+
+  nodeTypes = dict((t.id, (t.name, t.derivedFrom, describeArtifacts(t.installArtifacts), t.ancestors)) for t in tpl.nodeTypes.values())
+  relTypes = dict((t.id, (t.name, t.derivedFrom, describeArtifacts(t.sourceArtifacts), describeArtifacts(t.targetArtifacts), t.ancestors)) for t in tpl.relationshipTypes.values())
+  nodes = [(n.id, n.name, n.nodeType, n.properties) for n in tpl.nodeTemplates]
+  rels = [(r.id, r.name, r.relationshipType, r.sourceId, r.targetId) for r in tpl.relationshipTemplates]
+
+  return (nodeTypes, relTypes, nodes, rels, tpl.hasTopology, tpl.discoveries)
+
+# Both loaders must build the same model from the SugarCRM service template,
+# whether its elements and properties use a default namespace or prefixes
+class LoaderTest(unittest.TestCase):
+  def setUp(self):
+    self.source = open(os.path.join(support.sampleDir, 'service-template', 'SugarCRM-ServiceTemplate.xml'), 'rb').read()
+
+    # ElementTree writes every namespaced element with a prefix
+    self.prefixed = ElementTree.tostring(ElementTree.fromstring(self.source))
+
+  def load(self, loader, source):
+    stdout = sys.stdout
+
+    try:
+      sys.stdout = StringIO()
+      return describeTemplate(loader(StringIO(source)))
+    finally:
+      sys.stdout = stdout
+
+  def testPrefixedTemplate(self):
+    self.assertIn('<ns0:NodeTemplate ', self.prefixed)
+    self.assertNotIn('<NumCpus>', self.prefixed)
+
+    expected = self.load(loadDom, self.source)
+
+    self.assertEqual(self.load(loadStream, self.source), expected)
+    self.assertEqual(self.load(loadDom, self.prefixed), expected)
+    self.assertEqual(self.load(loadStream, self.prefixed), expected)
+
+  def testLocalPropertyNames(self):
+    nodes = dict((node[0], node[3]) for node in self.load(loadDom, self.prefixed)[2])
+
+    self.assertTrue(len(nodes) > 0)
+    self.assertTrue(len([properties for properties in nodes.values() if len(properties) > 0]) > 0)
+
+    for properties in nodes.values():
+      for name, value in properties:
+        self.assertFalse(':' in name)
+
+# A template from the cache must report the same as a freshly parsed one
+class CachedTemplateTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    support.makeSampleCsar(self.dir + '/sample.zip')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  # Returns the output of loading the sample's template with the given cache
+  def load(self, templateCache):
+    csar = CsarFile(self.dir + '/sample.zip')
+    stdout = sys.stdout
+
+    try:
+      sys.stdout = StringIO()
+      loadServiceTemplate(csar, None, 'stream', templateCache)
+      return sys.stdout.getvalue()
+    finally:
+      sys.stdout = stdout
+      csar.close()
+
+  def testSameOutput(self):
+    output = self.load(None)
+    self.assertIn('Node type "VirtualMachineType" discovered.', output)
+
+    # Parsed, then from memory, then unpickled by another cache
+    templateCache = TemplateCache(self.dir + '/templates')
+    self.assertEqual(self.load(templateCache), output)
+    self.assertEqual(self.load(templateCache), output)
+    self.assertEqual(self.load(TemplateCache(self.dir + '/templates')), output)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,130 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json, os, shutil, tempfile, threading, unittest
+import support
+
+from tplcache import TemplateCache
+from transformsvc import TransformService, TransformServer, TransformServiceError, requestTransform
+
+class TransformServiceTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    os.makedirs(self.dir + '/csars')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testResultsBoundedBySize(self):
+    service = TransformService(self.dir + '/work', resultSize=3000)
+    result = {'log': 'x' * 1000}
+    size = len(json.dumps(result))
+
+    for key in ['a', 'b', 'c']:
+      service.storeResult(key, result)
+
+    # The least recently used result goes first
+    self.assertEqual(service.results.keys(), ['b', 'c'])
+    self.assertEqual(service.resultBytes, 2 * size)
+
+    # Replacing a result does not count it twice; too large ones are dropped
+    service.storeResult('c', result)
+    service.storeResult('d', {'log': 'x' * 3000})
+    self.assertEqual(service.results.keys(), ['b', 'c'])
+    self.assertEqual(service.getStatus()['resultBytes'], 2 * size)
+
+    service.storeResult('a', result)
+    self.assertEqual(service.results.keys(), ['c', 'a'])
+
+  def testEvictedArchiveIsMiss(self):
+    service = TransformService(self.dir + '/work')
+    open(self.dir + '/charms.zip', 'wb').write('charms')
+    service.archives.store('a', self.dir + '/charms.zip')
+
+    service.storeResult('a', {'log': ''})
+    self.assertEqual(service.getResult('a'), {'log': ''})
+
+    # A result whose archive is gone is dropped and has to be computed again
+    os.remove(service.archives.getPath('a'))
+    self.assertEqual(service.getResult('a'), None)
+    self.assertEqual(service.results.keys(), [])
+    self.assertEqual(service.resultBytes, 0)
+
+  def testTemplatesBoundedBySize(self):
+    template = {'properties': 'x' * 1000}
+    templateCache = TemplateCache(maxSize=2500)
+
+    for key in ['a', 'b', 'c']:
+      templateCache.store(key, template)
+
+    # The least recently used template goes first, too large ones are not kept
+    self.assertEqual(templateCache.templates.keys(), ['b', 'c'])
+    self.assertTrue(2000 < templateCache.getSize() <= 2500)
+
+    templateCache.store('d', {'properties': 'x' * 3000})
+    self.assertEqual(templateCache.get('d'), None)
+    self.assertEqual(templateCache.get('b'), template)
+    self.assertEqual(len(templateCache), 2)
+
+  def testCsarPathBelowRoot(self):
+    os.symlink('/etc/passwd', self.dir + '/csars/link.zip')
+    open(self.dir + '/outside.zip', 'w').close()
+
+    service = TransformService(self.dir + '/work', csarRoot=self.dir + '/csars')
+    self.assertEqual(service.getCsarPath('sample.zip'), os.path.realpath(self.dir + '/csars/sample.zip'))
+    self.assertEqual(service.getCsarPath(self.dir + '/csars/sample.zip'), os.path.realpath(self.dir + '/csars/sample.zip'))
+
+    for path in ['/etc/passwd', '../outside.zip', self.dir + '/csars/../outside.zip', 'link.zip', '.', '']:
+      try:
+        service.getCsarPath(path)
+        self.fail('"' + path + '" is outside the CSAR root')
+      except TransformServiceError, e:
+        self.assertEqual(e.status, 403)
+
+    # Without a root, no path is read
+    service = TransformService(self.dir + '/work')
+    self.assertRaises(TransformServiceError, service.getCsarPath, self.dir + '/csars/sample.zip')
+
+  def testServer(self):
+    support.makeSampleCsar(self.dir + '/csars/sample.zip')
+    open(self.dir + '/big.zip', 'wb').write('x' * 4096)
+
+    service = TransformService(self.dir + '/work', csarRoot=self.dir + '/csars', maxUploadSize=1024 * 1024)
+    server = TransformServer(('127.0.0.1', 0), service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+      url = 'http://127.0.0.1:' + str(server.server_address[1])
+
+      status, result = requestTransform(url, self.dir + '/csars/sample.zip', [('env', 'test')])
+      self.assertEqual(status, 200)
+      self.assertFalse(result['cached'])
+
+      status, result = requestTransform(url, self.dir + '/csars/sample.zip', [('env', 'test')], False)
+      self.assertEqual(status, 200)
+      self.assertTrue(result['cached'])
+
+      status, result = requestTransform(url, self.dir + '/big.zip', [], False)
+      self.assertEqual(status, 403)
+
+      service.maxUploadSize = 1024
+      status, result = requestTransform(url, self.dir + '/big.zip', [])
+      self.assertEqual(status, 413)
+    finally:
+      server.shutdown()
+      server.server_close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,288 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, json, random, zipfile
+from cStringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
+
+#
+# Generator for synthetic service templates and CSARs of configurable size,
+# shaped like the SugarCRM sample. Every VM carries a stack of nodes:
+#
+#   Vm<i> <- Vm<i>Os <- Vm<i>Layer1 <- ... <- Vm<i>Layer<depth>
+#
+# where "<-" is "hosted on". <dependsOn> modules are hosted on the first layer
+# of every VM, and the top layer depends on all of them. The top layer of
+# every VM connects to the top layers of the next <connectsTo> VMs. All
+# Chef artifacts refer to the generated cookbooks in round-robin order.
+#
+
+toscaNamespace = 'http://docs.oasis-open.org/tosca/ns/2011/12'
+chefNamespace = 'http://docs.oasis-open.org/tosca/ns/2012/07/ChefImplementationArtifacts'
+chefArtifactType = 'http://docs.oasis-open.org/tosca/ns/2012/07/ChefArtifact'
+lifecycleInterfaceName = 'http://docs.oasis-open.org/tosca/ns/2011/12/interfaces/lifecycle'
+
+serviceTemplatePath = 'service-template/Synthetic-ServiceTemplate.xml'
+roleName = 'synthetic-role'
+rolePath = 'files/chef/roles/' + roleName + '.json'
+
+# Shape of a synthetic topology
+class TopologyOptions(object):
+  __slots__ = ('vms', 'depth', 'dependsOn', 'connectsTo', 'cookbooks', 'cookbookSize', 'unusedSize', 'seed')
+
+  def __init__(self, vms=10, depth=3, dependsOn=2, connectsTo=1, cookbooks=10, cookbookSize=64 * 1024, unusedSize=0, seed=0):
+    self.vms = vms
+    self.depth = max(1, depth) # number of layers above the operating system
+    self.dependsOn = dependsOn # modules per VM the top layer depends on
+    self.connectsTo = min(connectsTo, max(0, vms - 1)) # VMs the top layer of each VM connects to
+    self.cookbooks = max(1, cookbooks)
+    self.cookbookSize = cookbookSize # approximate uncompressed size of every cookbook in bytes
+    self.unusedSize = unusedSize # size of an artifact no node refers to, in bytes
+    self.seed = seed
+
+  def toDict(self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+def getCookbookName(index):
+  return 'cookbook%d' % index
+
+def getCookbookPath(index):
+  return 'files/chef/cookbooks/' + getCookbookName(index) + '.zip'
+
+# Returns the XML of a Chef artifact with the given cookbook indices,
+# optionally with the synthetic role and property mappings
+def buildChefArtifact(cookbookIndices, recipe, withRole=False, mappings=[]):
+  lines = ['<ns8:ChefArtifact xmlns:ns8="' + chefNamespace + '" xmlns="' + chefNamespace + '">', '<Cookbooks>']
+
+  for index in cookbookIndices:
+    lines.append('<Cookbook cookbookLocation=' + quoteattr(getCookbookPath(index)) + ' name=' + quoteattr(getCookbookName(index)) + '/>')
+
+  lines.append('</Cookbooks>')
+
+  if withRole:
+    lines.append('<Roles><Role name="' + roleName + '" roleDefLocation="' + rolePath + '"/></Roles>')
+
+  if len(mappings) > 0:
+    lines.append('<Mappings>')
+
+    for propertyName, cookbookAttribute in mappings:
+      lines.append('<PropertyMapping cookbookAttribute=' + quoteattr(cookbookAttribute) + ' mode="input" propertyPath=' + quoteattr('/' + propertyName) + '/>')
+
+    lines.append('</Mappings>')
+
+  lines.append('<RunList><Include>')
+
+  if withRole:
+    lines.append('<RunListEntry roleName="' + roleName + '"/>')
+
+  for index in cookbookIndices:
+    lines.append('<RunListEntry cookbookName=' + quoteattr(getCookbookName(index)) + ' recipeName=' + quoteattr(recipe) + '/>')
+
+  lines.append('</Include></RunList>')
+  lines.append('</ns8:ChefArtifact>')
+
+  return '\n'.join(lines)
+
+def buildImplementationArtifact(operationName, chefArtifact):
+  return '<ImplementationArtifact operationName="' + operationName + '" type="' + chefArtifactType + '">\n' + chefArtifact + '\n</ImplementationArtifact>'
+
+def buildNodeType(typeId, installArtifact):
+  lines = ['<NodeType id=' + quoteattr(typeId) + ' name=' + quoteattr(typeId) + '>']
+
+  if installArtifact != None:
+    lines.append('<Interfaces><Interface name="' + lifecycleInterfaceName + '">')
+    lines.append('<Operation name="install"><ScriptOperation/></Operation>')
+    lines.append('<ImplementationArtifacts>')
+    lines.append(buildImplementationArtifact('install', installArtifact))
+    lines.append('</ImplementationArtifacts>')
+    lines.append('</Interface></Interfaces>')
+
+  lines.append('</NodeType>')
+  return '\n'.join(lines)
+
+def buildRelationshipType(typeId, derivedFrom, operationName, sourceArtifact):
+  lines = ['<RelationshipType id=' + quoteattr(typeId) + ' name=' + quoteattr(typeId) + '>']
+
+  if derivedFrom != None:
+    lines.append('<DerivedFrom relationshipTypeRef=' + quoteattr(derivedFrom) + '/>')
+
+  if sourceArtifact != None:
+    lines.append('<SourceInterfaces><Interface name=' + quoteattr(toscaNamespace + '/' + derivedFrom) + '>')
+    lines.append('<Operation name="' + operationName + '"><ScriptOperation/></Operation>')
+    lines.append('<ImplementationArtifacts>')
+    lines.append(buildImplementationArtifact(operationName, sourceArtifact))
+    lines.append('</ImplementationArtifacts>')
+    lines.append('</Interface></SourceInterfaces>')
+
+  lines.append('</RelationshipType>')
+  return '\n'.join(lines)
+
+def buildNodeTemplate(nodeId, name, nodeType, properties):
+  if len(properties) == 0:
+    return '<NodeTemplate id=' + quoteattr(nodeId) + ' name=' + quoteattr(name) + ' nodeType=' + quoteattr(nodeType) + '/>'
+
+  lines = ['<NodeTemplate id=' + quoteattr(nodeId) + ' name=' + quoteattr(name) + ' nodeType=' + quoteattr(nodeType) + '>']
+  lines.append('<PropertyDefaults><Properties xmlns="http://www.example.com/synthetic/properties">')
+
+  for propertyName, value in properties:
+    lines.append('<' + propertyName + '>' + escape(value) + '</' + propertyName + '>')
+
+  lines.append('</Properties></PropertyDefaults>')
+  lines.append('</NodeTemplate>')
+  return '\n'.join(lines)
+
+def buildRelationshipTemplate(relId, name, relType, sourceId, targetId):
+  return '<RelationshipTemplate id=' + quoteattr(relId) + ' name=' + quoteattr(name) + ' relationshipType=' + quoteattr(relType) + '>\n<SourceElement id=' + quoteattr(sourceId) + '/>\n<TargetElement id=' + quoteattr(targetId) + '/>\n</RelationshipTemplate>'
+
+# Returns the XML of a synthetic service template with the given options
+def buildServiceTemplate(options):
+  cookbookCounter = [0]
+
+  # Returns the next cookbook indices in round-robin order
+  def nextCookbooks(count):
+    indices = []
+
+    for i in range(count):
+      indices.append(cookbookCounter[0] % options.cookbooks)
+      cookbookCounter[0] += 1
+
+    return sorted(set(indices))
+
+  nodeTypes = [buildNodeType('VirtualMachineType', None), buildNodeType('OperatingSystemType', None)]
+
+  for layer in range(1, options.depth + 1):
+    mappings = [('Layer%dPort' % layer, 'layer%d/port' % layer)]
+    nodeTypes.append(buildNodeType('Layer%dType' % layer, buildChefArtifact(nextCookbooks(2), 'default', layer == 1, mappings)))
+
+  nodeTypes.append(buildNodeType('ModuleType', buildChefArtifact(nextCookbooks(1), 'module')))
+
+  relTypes = [
+    buildRelationshipType('HostedOnType', None, None, None),
+    buildRelationshipType('DependsOnType', None, None, None),
+    buildRelationshipType('ConnectsToType', None, None, None),
+    buildRelationshipType('StackHostedOnType', 'HostedOnType', None, None),
+    buildRelationshipType('ModuleHostedOnType', 'HostedOnType', 'hostOn', buildChefArtifact(nextCookbooks(1), 'host_module')),
+    buildRelationshipType('ModuleDependencyType', 'DependsOnType', 'dependOn', buildChefArtifact(nextCookbooks(1), 'use_module'))
+  ]
+
+  # One connects-to type per fan-out position, as the model keeps one relation per charm and type
+  for j in range(1, options.connectsTo + 1):
+    mappings = [('Layer%dPort' % options.depth, 'connection%d/port' % j)]
+    relTypes.append(buildRelationshipType('Connection%dType' % j, 'ConnectsToType', 'connectTo', buildChefArtifact(nextCookbooks(1), 'connect', False, mappings)))
+
+  topology = []
+
+  for i in range(options.vms):
+    vmId = 'Vm%d' % i
+    osId = vmId + 'Os'
+
+    topology.append(buildNodeTemplate(vmId, 'VM %d' % i, 'VirtualMachineType', [('NumCpus', '1')]))
+    topology.append(buildNodeTemplate(osId, 'OS %d' % i, 'OperatingSystemType', []))
+    topology.append(buildRelationshipTemplate(osId + '_HostedOn_' + vmId, 'hosted on', 'StackHostedOnType', osId, vmId))
+
+    below = osId
+
+    for layer in range(1, options.depth + 1):
+      layerId = vmId + 'Layer%d' % layer
+      properties = [('Layer%dPort' % layer, str(8000 + layer)), ('Layer%dName' % layer, layerId)]
+
+      topology.append(buildNodeTemplate(layerId, 'Layer %d of VM %d' % (layer, i), 'Layer%dType' % layer, properties))
+      topology.append(buildRelationshipTemplate(layerId + '_HostedOn_' + below, 'hosted on', 'StackHostedOnType', layerId, below))
+
+      below = layerId
+
+    for j in range(options.dependsOn):
+      moduleId = vmId + 'Module%d' % j
+      firstLayerId = vmId + 'Layer1'
+      topLayerId = vmId + 'Layer%d' % options.depth
+
+      topology.append(buildNodeTemplate(moduleId, 'Module %d of VM %d' % (j, i), 'ModuleType', [('Module%dEnabled' % j, 'true')]))
+      topology.append(buildRelationshipTemplate(moduleId + '_HostedOn_' + firstLayerId, 'hosted on', 'ModuleHostedOnType', moduleId, firstLayerId))
+      topology.append(buildRelationshipTemplate(topLayerId + '_DependsOn_' + moduleId, 'depends on', 'ModuleDependencyType', topLayerId, moduleId))
+
+  for i in range(options.vms):
+    for j in range(1, options.connectsTo + 1):
+      sourceId = 'Vm%dLayer%d' % (i, options.depth)
+      targetId = 'Vm%dLayer%d' % ((i + j) % options.vms, options.depth)
+      topology.append(buildRelationshipTemplate(sourceId + '_ConnectsTo_' + targetId, 'connects to', 'Connection%dType' % j, sourceId, targetId))
+
+  return '\n'.join([
+    '<?xml version="1.0" encoding="UTF-8"?>',
+    '<ServiceTemplate id="Synthetic" name="Synthetic Service Template" targetNamespace="http://www.example.com/servicetemplates/Synthetic" xmlns="' + toscaNamespace + '">',
+    '<TopologyTemplate id="SyntheticTopologyTemplate" name="Synthetic Topology Template">',
+    '\n'.join(topology),
+    '</TopologyTemplate>',
+    '<NodeTypes>',
+    '\n'.join(nodeTypes),
+    '</NodeTypes>',
+    '<RelationshipTypes>',
+    '\n'.join(relTypes),
+    '</RelationshipTypes>',
+    '</ServiceTemplate>',
+    ''
+  ])
+
+# Returns pseudo-random Ruby-like text of about the given size
+def buildFiller(rand, size):
+  words = ['package', 'service', 'template', 'action', 'notifies', 'variables', 'source', 'owner', 'group', 'mode', 'node', 'default', 'end', 'do']
+  lines = []
+  length = 0
+
+  while length < size:
+    line = ' '.join(rand.choice(words) for i in range(rand.randint(3, 10))) + ' "' + '%08x' % rand.getrandbits(32) + '"'
+    lines.append(line)
+    length += len(line) + 1
+
+  return '\n'.join(lines) + '\n'
+
+# Returns the content of a zipped cookbook of about the given size
+def buildCookbook(index, size, rand):
+  name = getCookbookName(index)
+  buffer = StringIO()
+  cookbook = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
+
+  cookbook.writestr(name + '/metadata.rb', 'name "' + name + '"\nversion "1.0.0"\n')
+
+  for recipe in ('default', 'module', 'host_module', 'use_module', 'connect'):
+    cookbook.writestr(name + '/recipes/' + recipe + '.rb', '# ' + recipe + ' recipe of ' + name + '\n')
+
+  # Spread the filler over several files
+  files = max(1, size / (16 * 1024))
+  for i in range(files):
+    cookbook.writestr(name + '/files/default/file%d.rb' % i, buildFiller(rand, size / files))
+
+  cookbook.close()
+  return buffer.getvalue()
+
+# Writes a synthetic CSAR with the given options to the given path
+def writeCsar(path, options):
+  rand = random.Random(options.seed)
+  csar = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+  try:
+    csar.writestr('META-INF/MANIFEST.MF', 'Manifest-Version: 1.0\nCSAR-Version: 1.0\nService-Template: ' + serviceTemplatePath + '\n')
+    csar.writestr(serviceTemplatePath, buildServiceTemplate(options))
+    csar.writestr(rolePath, json.dumps({'name': roleName, 'run_list': []}))
+
+    for index in range(options.cookbooks):
+      # Zipped cookbooks are stored as they are, like in the sample CSAR
+      info = zipfile.ZipInfo(getCookbookPath(index), (2013, 8, 5, 8, 50, 0))
+      info.compress_type = zipfile.ZIP_STORED
+      csar.writestr(info, buildCookbook(index, options.cookbookSize, rand))
+
+    if options.unusedSize > 0:
+      info = zipfile.ZipInfo('files/binaries/unused.bin', (2013, 8, 5, 8, 50, 0))
+      info.compress_type = zipfile.ZIP_STORED
+      csar.writestr(info, os.urandom(options.unusedSize))
+  finally:
+    csar.close()
@@ -0,0 +1,87 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Immutable index over the node and relationship templates of a topology
+# template. It is built once in a single pass over the topology template, so
+# all lookups done during the transformation are O(1) (or linear in the degree
+# of a node) instead of rescanning the whole topology every time.
+class TopologyGraph:
+  def __init__(self, nodeTemplates, relationshipTemplates):
+    self._nodes = tuple(nodeTemplates)
+    self._relationships = tuple(relationshipTemplates)
+
+    # Node templates by id; the first one wins for duplicate ids
+    self._nodesById = {}
+    for node in self._nodes:
+      self._nodesById.setdefault(node.id, node)
+
+    self._relationshipsById = {}
+    for rel in self._relationships:
+      self._relationshipsById.setdefault(rel.id, rel)
+
+    outgoing = {}
+    incoming = {}
+    adjacent = {}
+
+    for rel in self._relationships:
+      sourceId = rel.sourceId
+      targetId = rel.targetId
+
+      outgoing.setdefault(sourceId, []).append(rel)
+      incoming.setdefault(targetId, []).append(rel)
+
+      # Keep document order; a self-referencing relationship is listed twice,
+      # once as outgoing and once as incoming relationship
+      adjacent.setdefault(sourceId, []).append(rel)
+      adjacent.setdefault(targetId, []).append(rel)
+
+    self._outgoing = dict((key, tuple(value)) for key, value in outgoing.items())
+    self._incoming = dict((key, tuple(value)) for key, value in incoming.items())
+    self._adjacent = dict((key, tuple(value)) for key, value in adjacent.items())
+
+  # Returns all node templates in document order
+  def getNodes(self):
+    return self._nodes
+
+  # Returns all relationship templates in document order
+  def getRelationships(self):
+    return self._relationships
+
+  # Returns the node template with the given id or None
+  def getNode(self, nodeId):
+    return self._nodesById.get(nodeId)
+
+  # Returns the relationship template with the given id or None
+  def getRelationship(self, relId):
+    return self._relationshipsById.get(relId)
+
+  # Returns the source node template of the given relationship or None
+  def getSource(self, relationshipTemplate):
+    return self._nodesById.get(relationshipTemplate.sourceId)
+
+  # Returns the target node template of the given relationship or None
+  def getTarget(self, relationshipTemplate):
+    return self._nodesById.get(relationshipTemplate.targetId)
+
+  # Returns the relationships that have the given node as source
+  def getOutgoing(self, nodeId):
+    return self._outgoing.get(nodeId, ())
+
+  # Returns the relationships that have the given node as target
+  def getIncoming(self, nodeId):
+    return self._incoming.get(nodeId, ())
+
+  # Returns all relationships of the given node in document order
+  def getAdjacent(self, nodeId):
+    return self._adjacent.get(nodeId, ())
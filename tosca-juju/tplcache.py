@@ -0,0 +1,145 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, errno, hashlib, tempfile, threading, cPickle
+from collections import OrderedDict
+
+import instrument
+
+# Version of the loaded template records; bump it whenever tplloader builds
+# them differently, so that cached templates of an older version are ignored
+templateFormat = '2'
+
+# Returns the cache key of the service template with the given content,
+# loaded by the given loader ("dom", "stream")
+def getTemplateKey(loader, data):
+  digest = hashlib.sha1()
+  digest.update(templateFormat + '\0' + loader + '\0')
+  digest.update(data)
+
+  return digest.hexdigest()
+
+# Loaded service templates by content. Templates are kept in memory and, if a
+# cache directory is given, pickled to it, so that other processes and later
+# runs skip parsing as well. Loaded templates are never modified by the model
+# transformer, so a cached template is handed out as is. If maxSize is given,
+# the templates kept in memory are bounded by their size pickled, in bytes;
+# the least recently used ones are dropped first and larger ones are not kept
+# in memory at all. The cache can be shared by threads.
+class TemplateCache:
+  def __init__(self, cacheDir=None, maxSize=None):
+    self.cacheDir = cacheDir
+    self.maxSize = maxSize
+    self.templates = OrderedDict() # key -> (template, size), the least recently used first
+    self.size = 0
+    self.lock = threading.Lock()
+
+    if self.cacheDir != None and not os.path.isdir(self.cacheDir):
+      try:
+        os.makedirs(self.cacheDir)
+      except OSError, e:
+        if e.errno != errno.EEXIST: raise
+
+  # Returns the path of the cache entry for the given key
+  def getPath(self, key):
+    return self.cacheDir + '/' + key + '.pickle'
+
+  # Returns the number of templates kept in memory
+  def __len__(self):
+    return len(self.templates)
+
+  # Returns the size of the templates kept in memory in bytes, pickled; only
+  # counted with a maximum size
+  def getSize(self):
+    return self.size
+
+  # Keeps the template of the given size in memory as the most recently used one
+  def remember(self, key, template, size):
+    self.lock.acquire()
+    try:
+      entry = self.templates.pop(key, None)
+      if entry != None:
+        self.size -= entry[1]
+
+      if self.maxSize != None and size > self.maxSize:
+        return
+
+      self.templates[key] = (template, size)
+      self.size += size
+
+      while self.maxSize != None and self.size > self.maxSize:
+        self.size -= self.templates.popitem(False)[1][1]
+    finally:
+      self.lock.release()
+
+  # Returns the template with the given key or None
+  def get(self, key):
+    self.lock.acquire()
+    try:
+      entry = self.templates.pop(key, None)
+      if entry != None: self.templates[key] = entry
+    finally:
+      self.lock.release()
+
+    if entry != None:
+      instrument.count('templates.cached')
+      return entry[0]
+
+    if self.cacheDir == None:
+      return None
+
+    try:
+      templateFile = open(self.getPath(key), 'rb')
+    except IOError:
+      return None
+
+    try:
+      try:
+        data = templateFile.read()
+        template = cPickle.loads(data)
+      finally:
+        templateFile.close()
+    except Exception:
+      # Unreadable entries are replaced by the next store
+      return None
+
+    instrument.count('templates.unpickled')
+    self.remember(key, template, len(data))
+    return template
+
+  # Adds the template with the given key
+  def store(self, key, template):
+    data = None
+    if self.cacheDir != None or self.maxSize != None:
+      data = cPickle.dumps(template, cPickle.HIGHEST_PROTOCOL)
+
+    self.remember(key, template, len(data) if data != None else 0)
+
+    if self.cacheDir == None:
+      return
+
+    # Write to a temporary file first, so concurrent readers never see partial entries
+    fd, tmpPath = tempfile.mkstemp('.tmp', key, self.cacheDir)
+
+    try:
+      templateFile = os.fdopen(fd, 'wb')
+
+      try:
+        templateFile.write(data)
+      finally:
+        templateFile.close()
+
+      os.rename(tmpPath, self.getPath(key))
+    except:
+      if os.path.exists(tmpPath): os.remove(tmpPath)
+      raise
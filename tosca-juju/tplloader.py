@@ -0,0 +1,456 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+from xml.dom.minidom import parse, Node
+
+try:
+  from xml.etree.cElementTree import iterparse
+except ImportError:
+  from xml.etree.ElementTree import iterparse
+
+from typehier import computeAncestors
+import instrument
+
+chefArtifactType = 'http://docs.oasis-open.org/tosca/ns/2012/07/ChefArtifact'
+chefNodeName = 'ChefArtifact'
+lifecycleInterfaceName = 'http://docs.oasis-open.org/tosca/ns/2011/12/interfaces/lifecycle'
+installOperationName = 'install'
+
+# Returns the local name of an ElementTree tag ("{namespace}name"). Both
+# loaders match elements and name properties by their local names, so
+# namespace prefixes make no difference.
+def getLocalName(tag):
+  return tag.rsplit('}', 1)[-1]
+
+# Chef artifact with the cookbooks, roles, property mappings and run list
+# entries already extracted from the XML. It is built once per type while the
+# service template is loaded and shared by all nodes and relationships of
+# that type, so it must not be modified.
+class ChefArtifact(object):
+  __slots__ = ('cookbooks', 'roles', 'mappings', 'runList')
+
+  def __init__(self, cookbooks, roles, mappings, runList):
+    self.cookbooks = tuple(cookbooks) # (name, cookbookLocation) pairs
+    self.roles = tuple(roles) # (name, roleDefLocation) pairs
+    # (propertyName, cookbookAttribute) pairs; the property path is "/name"
+    self.mappings = tuple((propertyPath[1:], cookbookAttribute) for propertyPath, cookbookAttribute in mappings)
+    self.runList = tuple(runList) # run list entries, e.g. "recipe[php::package]"
+
+# Node type with its Chef artifacts for the "install" operation
+class NodeType(object):
+  __slots__ = ('id', 'name', 'derivedFrom', 'installArtifacts', 'ancestors')
+
+  def __init__(self, id, name, derivedFrom):
+    self.id = id
+    self.name = name
+    self.derivedFrom = derivedFrom
+    self.installArtifacts = [] # list of ChefArtifact
+    self.ancestors = None # frozenset of type ids, see ServiceTemplate.resolveTypeHierarchies
+
+# Relationship type with the Chef artifacts of its source and target interfaces
+class RelationshipType(object):
+  __slots__ = ('id', 'name', 'derivedFrom', 'sourceArtifacts', 'targetArtifacts', 'ancestors')
+
+  def __init__(self, id, name, derivedFrom):
+    self.id = id
+    self.name = name
+    self.derivedFrom = derivedFrom
+    self.sourceArtifacts = [] # list of ChefArtifact
+    self.targetArtifacts = [] # list of ChefArtifact
+    self.ancestors = None # frozenset of type ids, see ServiceTemplate.resolveTypeHierarchies
+
+# Node template of the topology template
+class NodeTemplate(object):
+  __slots__ = ('id', 'name', 'nodeType', 'properties')
+
+  def __init__(self, id, name, nodeType, properties):
+    self.id = id
+    self.name = name
+    self.nodeType = nodeType
+    self.properties = properties # list of (name, value) from the property defaults
+
+# Relationship template of the topology template
+class RelationshipTemplate(object):
+  __slots__ = ('id', 'name', 'relationshipType', 'sourceId', 'targetId')
+
+  def __init__(self, id, name, relationshipType, sourceId, targetId):
+    self.id = id
+    self.name = name
+    self.relationshipType = relationshipType
+    self.sourceId = sourceId
+    self.targetId = targetId
+
+# Raised for property overrides of node templates that do not exist
+class TemplateOverrideError(Exception):
+  pass
+
+# Everything the model transformer needs from a service template
+class ServiceTemplate(object):
+  __slots__ = ('nodeTypes', 'relationshipTypes', 'nodeTemplates', 'relationshipTemplates', 'hasTopology', 'discoveries')
+
+  def __init__(self):
+    self.nodeTypes = {}
+    self.relationshipTypes = {}
+    self.nodeTemplates = []
+    self.relationshipTemplates = []
+    self.hasTopology = False
+    self.discoveries = [] # progress messages of the loader, see printDiscoveries
+
+  # Returns a service template that differs from this one only in the
+  # property defaults given by overrides, a dict that maps node template ids
+  # to dicts of property values. Everything else, including the node
+  # templates without overrides, is shared.
+  def fork(self, overrides):
+    nodeIds = set(node.id for node in self.nodeTemplates)
+
+    for nodeId in sorted(overrides.keys()):
+      if not nodeId in nodeIds:
+        raise TemplateOverrideError('Cannot override properties of unknown node template "' + nodeId + '".')
+
+    serviceTemplate = ServiceTemplate()
+    serviceTemplate.nodeTypes = self.nodeTypes
+    serviceTemplate.relationshipTypes = self.relationshipTypes
+    serviceTemplate.relationshipTemplates = self.relationshipTemplates
+    serviceTemplate.hasTopology = self.hasTopology
+    serviceTemplate.discoveries = self.discoveries
+
+    for node in self.nodeTemplates:
+      if node.id in overrides:
+        values = overrides[node.id]
+        names = set(name for name, value in node.properties)
+
+        # Overridden properties keep their position, new ones are appended
+        properties = [(name, values.get(name, value)) for name, value in node.properties]
+        properties.extend((name, values[name]) for name in sorted(values.keys()) if not name in names)
+
+        node = NodeTemplate(node.id, node.name, node.nodeType, properties)
+
+      serviceTemplate.nodeTemplates.append(node)
+
+    return serviceTemplate
+
+  # Prints the types and Chef artifacts discovered while loading the template.
+  # The messages are kept with the template, so a cached template reports the
+  # same as a freshly parsed one.
+  def printDiscoveries(self):
+    for message in self.discoveries:
+      print message
+
+  # Precomputes the ancestors of all node and relationship types (see typehier)
+  def resolveTypeHierarchies(self):
+    for typeId, ancestors in computeAncestors(self.nodeTypes, 'Node type').items():
+      self.nodeTypes[typeId].ancestors = ancestors
+
+    for typeId, ancestors in computeAncestors(self.relationshipTypes, 'Relationship type').items():
+      self.relationshipTypes[typeId].ancestors = ancestors
+
+  # Adds a node type and its Chef artifacts for the "install" operation
+  def addNodeType(self, nodeTypeId, nodeTypeName, derivedFrom, installArtifacts):
+    self.nodeTypes[nodeTypeId] = NodeType(nodeTypeId, nodeTypeName, derivedFrom)
+    self.discoveries.append('Node type "' + nodeTypeId + '" discovered.')
+
+    for artifact in installArtifacts:
+      self.nodeTypes[nodeTypeId].installArtifacts.append(artifact)
+      self.discoveries.append('Node type "' + nodeTypeId + '": Chef artifact for "install" operation discovered.')
+
+  # Adds a relationship type and its Chef artifacts; the artifacts are lists of (operationName, artifact)
+  def addRelationshipType(self, relTypeId, relTypeName, derivedFrom, sourceArtifacts, targetArtifacts):
+    self.relationshipTypes[relTypeId] = RelationshipType(relTypeId, relTypeName, derivedFrom)
+    self.discoveries.append('Relationship type "' + relTypeId + '" discovered.')
+
+    for operationName, artifact in sourceArtifacts:
+      self.relationshipTypes[relTypeId].sourceArtifacts.append(artifact)
+      self.discoveries.append('Relationship type "' + relTypeId + '": Chef artifact for "' + operationName + '" operation discovered.')
+
+    for operationName, artifact in targetArtifacts:
+      self.relationshipTypes[relTypeId].targetArtifacts.append(artifact)
+      self.discoveries.append('Relationship type "' + relTypeId + '": Chef artifact for "' + operationName + '" operation discovered.')
+
+# Returns the run list entry for the given attributes of a "RunListEntry" element
+def getRunListEntry(attrs):
+  if 'roleName' in attrs:
+    return 'role[' + attrs['roleName'] + ']'
+  elif 'cookbookName' in attrs and 'recipeName' in attrs:
+    return 'recipe[' + attrs['cookbookName'] + '::' + attrs['recipeName'] + ']'
+  elif 'cookbookName' in attrs:
+    return 'recipe[' + attrs['cookbookName'] + ']'
+
+  return None
+
+#
+# Loader based on xml.dom.minidom; the DOM is only used while loading
+#
+
+# Loads the service template from the given path or file object
+def loadDom(source):
+  doc = parse(source)
+
+  tpl = ServiceTemplate()
+
+  def findElements(element, name):
+    instrument.count('dom.lookups')
+    return element.getElementsByTagNameNS('*', name)
+
+  def getAttributes(element):
+    return dict(element.attributes.items())
+
+  def buildArtifact(chefArtifact):
+    cookbooks = [(e.getAttribute('name'), e.getAttribute('cookbookLocation')) for e in findElements(chefArtifact, 'Cookbook')]
+    roles = [(e.getAttribute('name'), e.getAttribute('roleDefLocation')) for e in findElements(chefArtifact, 'Role')]
+    mappings = [(e.getAttribute('propertyPath'), e.getAttribute('cookbookAttribute')) for e in findElements(chefArtifact, 'PropertyMapping')]
+    runList = []
+
+    runLists = findElements(chefArtifact, 'RunList')
+    includes = findElements(runLists[0], 'Include') if len(runLists) > 0 else []
+
+    if len(includes) > 0:
+      for runListEntry in findElements(includes[0], 'RunListEntry'):
+        entry = getRunListEntry(getAttributes(runListEntry))
+        if entry != None: runList.append(entry)
+
+    return ChefArtifact(cookbooks, roles, mappings, runList)
+
+  def findArtifacts(implArtifact):
+    artifacts = []
+
+    for child in implArtifact.childNodes:
+      if child.nodeType == Node.ELEMENT_NODE and chefNodeName in child.localName:
+        artifacts.append(buildArtifact(child))
+
+    return artifacts
+
+  # Discover node types
+  for nodeType in findElements(doc, 'NodeType'):
+    derivedFrom = None
+    installArtifacts = []
+
+    if len(findElements(nodeType, 'DerivedFrom')) > 0:
+      derivedFrom = findElements(nodeType, 'DerivedFrom')[0].getAttribute('nodeTypeRef')
+
+    for interface in findElements(nodeType, 'Interface'):
+      if interface.getAttribute('name') != lifecycleInterfaceName: continue
+
+      for artifact in findElements(interface, 'ImplementationArtifact'):
+        if artifact.getAttribute('operationName') != installOperationName: continue
+        if artifact.getAttribute('type') != chefArtifactType: continue
+
+        installArtifacts.extend(findArtifacts(artifact))
+
+    tpl.addNodeType(nodeType.getAttribute('id'), nodeType.getAttribute('name'), derivedFrom, installArtifacts)
+
+  # Discover relationship types
+  for relType in findElements(doc, 'RelationshipType'):
+    derivedFrom = None
+    interfaceArtifacts = {'SourceInterfaces': [], 'TargetInterfaces': []}
+
+    if len(findElements(relType, 'DerivedFrom')) > 0:
+      derivedFrom = findElements(relType, 'DerivedFrom')[0].getAttribute('relationshipTypeRef')
+
+    for interfacesName in ('SourceInterfaces', 'TargetInterfaces'):
+      interfaces = findElements(relType, interfacesName)
+      if len(interfaces) == 0: continue
+
+      for artifact in findElements(interfaces[0], 'ImplementationArtifact'):
+        if artifact.getAttribute('type') != chefArtifactType: continue
+
+        for chefArtifact in findArtifacts(artifact):
+          interfaceArtifacts[interfacesName].append((artifact.getAttribute('operationName'), chefArtifact))
+
+    tpl.addRelationshipType(relType.getAttribute('id'), relType.getAttribute('name'), derivedFrom, interfaceArtifacts['SourceInterfaces'], interfaceArtifacts['TargetInterfaces'])
+
+  # Discover node and relationship templates
+  topologyTemplates = findElements(doc, 'TopologyTemplate')
+
+  if len(topologyTemplates) > 0:
+    tpl.hasTopology = True
+
+    for child in topologyTemplates[0].childNodes:
+      if child.localName == 'NodeTemplate':
+        properties = []
+        propDefs = findElements(child, 'PropertyDefaults')
+
+        if len(propDefs) > 0:
+          for propSet in propDefs[0].childNodes:
+            if propSet.nodeType == Node.ELEMENT_NODE:
+              for prop in propSet.childNodes:
+                if prop.nodeType == Node.ELEMENT_NODE:
+                  value = ''
+                  if prop.firstChild != None and prop.firstChild.nodeType in (Node.TEXT_NODE, Node.CDATA_SECTION_NODE):
+                    value = prop.firstChild.data
+                  properties.append((prop.localName, value))
+
+        tpl.nodeTemplates.append(NodeTemplate(child.getAttribute('id'), child.getAttribute('name'), child.getAttribute('nodeType'), properties))
+
+      elif child.localName == 'RelationshipTemplate':
+        sourceId = findElements(child, 'SourceElement')[0].getAttribute('id')
+        targetId = findElements(child, 'TargetElement')[0].getAttribute('id')
+
+        tpl.relationshipTemplates.append(RelationshipTemplate(child.getAttribute('id'), child.getAttribute('name'), child.getAttribute('relationshipType'), sourceId, targetId))
+
+  doc.unlink()
+
+  tpl.resolveTypeHierarchies()
+
+  return tpl
+
+#
+# Streaming loader based on iterparse; elements are discarded as soon as the
+# corresponding records are built, so memory use does not grow with the size
+# of the parts of the service template that are not needed
+#
+
+# Loads the service template from the given path or file object
+def loadStream(source):
+  tpl = ServiceTemplate()
+
+  def findAll(element, name):
+    instrument.count('dom.lookups')
+    return [e for e in element.iter() if e is not element and getLocalName(e.tag) == name]
+
+  def findFirst(element, name):
+    instrument.count('dom.lookups')
+    for e in element.iter():
+      if e is not element and getLocalName(e.tag) == name: return e
+
+    return None
+
+  def buildArtifact(chefArtifact):
+    cookbooks = [(e.get('name', ''), e.get('cookbookLocation', '')) for e in findAll(chefArtifact, 'Cookbook')]
+    roles = [(e.get('name', ''), e.get('roleDefLocation', '')) for e in findAll(chefArtifact, 'Role')]
+    mappings = [(e.get('propertyPath', ''), e.get('cookbookAttribute', '')) for e in findAll(chefArtifact, 'PropertyMapping')]
+    runList = []
+
+    runListElement = findFirst(chefArtifact, 'RunList')
+    include = findFirst(runListElement, 'Include') if runListElement is not None else None
+
+    if include is not None:
+      for runListEntry in findAll(include, 'RunListEntry'):
+        entry = getRunListEntry(runListEntry.attrib)
+        if entry != None: runList.append(entry)
+
+    return ChefArtifact(cookbooks, roles, mappings, runList)
+
+  def findArtifacts(implArtifact):
+    artifacts = []
+
+    for child in implArtifact:
+      if chefNodeName in getLocalName(child.tag):
+        artifacts.append(buildArtifact(child))
+
+    return artifacts
+
+  def addNodeType(nodeType):
+    derivedFrom = None
+    installArtifacts = []
+
+    derivedFromElement = findFirst(nodeType, 'DerivedFrom')
+    if derivedFromElement is not None:
+      derivedFrom = derivedFromElement.get('nodeTypeRef', '')
+
+    for interface in findAll(nodeType, 'Interface'):
+      if interface.get('name') != lifecycleInterfaceName: continue
+
+      for artifact in findAll(interface, 'ImplementationArtifact'):
+        if artifact.get('operationName') != installOperationName: continue
+        if artifact.get('type') != chefArtifactType: continue
+
+        installArtifacts.extend(findArtifacts(artifact))
+
+    tpl.addNodeType(nodeType.get('id', ''), nodeType.get('name', ''), derivedFrom, installArtifacts)
+
+  def addRelationshipType(relType):
+    derivedFrom = None
+    interfaceArtifacts = {'SourceInterfaces': [], 'TargetInterfaces': []}
+
+    derivedFromElement = findFirst(relType, 'DerivedFrom')
+    if derivedFromElement is not None:
+      derivedFrom = derivedFromElement.get('relationshipTypeRef', '')
+
+    for interfacesName in ('SourceInterfaces', 'TargetInterfaces'):
+      interfaces = findFirst(relType, interfacesName)
+      if interfaces is None: continue
+
+      for artifact in findAll(interfaces, 'ImplementationArtifact'):
+        if artifact.get('type') != chefArtifactType: continue
+
+        for chefArtifact in findArtifacts(artifact):
+          interfaceArtifacts[interfacesName].append((artifact.get('operationName', ''), chefArtifact))
+
+    tpl.addRelationshipType(relType.get('id', ''), relType.get('name', ''), derivedFrom, interfaceArtifacts['SourceInterfaces'], interfaceArtifacts['TargetInterfaces'])
+
+  def addNodeTemplate(node):
+    properties = []
+    propDefs = findFirst(node, 'PropertyDefaults')
+
+    if propDefs is not None:
+      for propSet in propDefs:
+        for prop in propSet:
+          properties.append((getLocalName(prop.tag), prop.text or ''))
+
+    tpl.nodeTemplates.append(NodeTemplate(node.get('id', ''), node.get('name', ''), node.get('nodeType', ''), properties))
+
+  def addRelationshipTemplate(rel):
+    sourceId = findFirst(rel, 'SourceElement').get('id', '')
+    targetId = findFirst(rel, 'TargetElement').get('id', '')
+
+    tpl.relationshipTemplates.append(RelationshipTemplate(rel.get('id', ''), rel.get('name', ''), rel.get('relationshipType', ''), sourceId, targetId))
+
+  # Stack of open elements and their local names
+  elements = []
+  names = []
+
+  # Depth of the first topology template, if currently inside of it
+  topologyDepth = None
+
+  for event, element in iterparse(source, events=('start', 'end')):
+    if event == 'start':
+      elements.append(element)
+      names.append(getLocalName(element.tag))
+
+      if names[-1] == 'TopologyTemplate' and not tpl.hasTopology:
+        tpl.hasTopology = True
+        topologyDepth = len(names)
+
+      continue
+
+    name = names.pop()
+    elements.pop()
+    done = False
+
+    if topologyDepth != None and len(names) == topologyDepth:
+      if name == 'NodeTemplate':
+        addNodeTemplate(element)
+      elif name == 'RelationshipTemplate':
+        addRelationshipTemplate(element)
+      done = True
+    elif name == 'TopologyTemplate' and len(names) + 1 == topologyDepth:
+      topologyDepth = None
+      done = True
+    elif name == 'NodeType':
+      addNodeType(element)
+      done = True
+    elif name == 'RelationshipType':
+      addRelationshipType(element)
+      done = True
+    elif len(names) <= 1:
+      # Top-level elements of the service template (imports, plans, ...)
+      done = True
+
+    # Drop the processed subtree from the partially built tree
+    if done:
+      element.clear()
+      if len(elements) > 0: elements[-1].remove(element)
+
+  tpl.resolveTypeHierarchies()
+
+  return tpl
@@ -0,0 +1,87 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, sys, json, yaml, urllib2, zipfile, argparse
+
+from transformsvc import requestTransform, fetchCharms, charmSeries
+
+#
+# transform-client.py SugarCRM_ChefManaged.zip
+# transform-client.py --model model.yaml --plan plan.json --charms charms SugarCRM_ChefManaged.zip hpcloud
+#
+# Has a running transform-server.py transform a CSAR. Prints the model, or
+# writes the model, the deployment plan and the charms to the given files.
+#
+
+parser = argparse.ArgumentParser(description='Transform a TOSCA CSAR with a running transform-server.py.')
+parser.add_argument('csarFile', help='TOSCA Cloud Service Archive (CSAR)')
+parser.add_argument('jujuEnv', nargs='?', default='default', help='Juju environment the deployment plan is for (default: default)')
+parser.add_argument('--server', default='http://127.0.0.1:8642', help='URL of the server (default: http://127.0.0.1:8642)')
+parser.add_argument('--no-upload', action='store_true', help='let the server read the CSAR from its path instead of sending it; the CSAR has to be below the --csar-root of the server')
+parser.add_argument('-t', '--service-template', help='path of the service template inside the CSAR (default: as named by its manifest)')
+parser.add_argument('--loader', choices=['dom', 'stream'], default='dom', help='service template loader (default: dom)')
+parser.add_argument('--set', action='append', default=[], metavar='NODE:PROPERTY=VALUE', help='override the default of a node template property; can be given more than once')
+parser.add_argument('--dedupe', action='store_true', help='deploy VMs that host the same stack as units of one charm instead of generating a charm per VM')
+parser.add_argument('--model', metavar='FILE', help='write the model as YAML to FILE instead of printing it')
+parser.add_argument('--plan', metavar='FILE', help='write the deployment plan as JSON to FILE')
+parser.add_argument('--charms', metavar='DIR', help='unpack the charms into DIR/SERIES, the layout the deployment plan expects')
+parser.add_argument('--log', action='store_true', help='print the output of the transformation')
+args = parser.parse_args()
+
+params = [('loader', args.loader), ('env', args.jujuEnv), ('dedupe', '1' if args.dedupe else '0')]
+params.extend(('set', setting) for setting in args.set)
+
+if args.service_template != None:
+  params.append(('template', args.service_template))
+
+try:
+  status, result = requestTransform(args.server, args.csarFile, params, not args.no_upload)
+except (urllib2.URLError, IOError), e:
+  print 'Cannot reach ' + args.server + ': ' + str(e)
+  sys.exit(1)
+
+if args.log and result.get('log'):
+  print result['log']
+
+if status != 200:
+  print result['error']
+  sys.exit(1)
+
+if args.model != None:
+  modelFile = open(args.model, 'w')
+  modelFile.write(yaml.safe_dump(result['model'], default_flow_style=False))
+  modelFile.close()
+else:
+  print yaml.safe_dump(result['model'], default_flow_style=False)
+
+if args.plan != None:
+  planFile = open(args.plan, 'w')
+  planFile.write(json.dumps(result['plan'], indent=2, sort_keys=True))
+  planFile.close()
+
+if args.charms != None:
+  archivePath = args.charms + '.zip'
+  fetchCharms(args.server, result, archivePath)
+
+  # Keep the permissions of the hook scripts, which extractall drops
+  archive = zipfile.ZipFile(archivePath)
+  try:
+    for info in archive.infolist():
+      path = archive.extract(info, args.charms + '/' + charmSeries)
+      if info.external_attr >> 16: os.chmod(path, info.external_attr >> 16 & 0777)
+  finally:
+    archive.close()
+
+  os.remove(archivePath)
+
+print >>sys.stderr, ('Cached result' if result['cached'] else 'Transformed') + ' in ' + '%.2f' % result['duration'] + ' s.'
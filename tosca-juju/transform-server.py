@@ -0,0 +1,59 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import sys, socket, argparse, multiprocessing
+
+from transformsvc import TransformService, TransformServer
+
+#
+# transform-server.py
+# transform-server.py --port 8642 --work-dir /var/tmp/tosca-juju --concurrency 8
+# transform-server.py --csar-root /srv/csars
+#
+# Serves transformations over HTTP, see transformsvc for the requests, and
+# keeps the parsed templates, bundles and results between requests. Use
+# transform-client.py to send requests.
+#
+
+parser = argparse.ArgumentParser(description='Serve TOSCA CSAR transformations over HTTP, keeping caches warm between requests.')
+parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+parser.add_argument('--port', type=int, default=8642, help='port to listen on (default: 8642)')
+parser.add_argument('--work-dir', default='transform-server', help='directory for the caches and temporary files (default: transform-server)')
+parser.add_argument('--concurrency', type=int, default=None, help='maximum number of transformations run at the same time (default: number of CPUs)')
+parser.add_argument('--cache-size', type=int, default=512, help='maximum size of the bundle cache in MB (default: 512)')
+parser.add_argument('--archive-size', type=int, default=512, help='maximum size of the kept charm archives in MB (default: 512)')
+parser.add_argument('--template-memory', type=int, default=64, help='maximum size of the parsed service templates kept in memory in MB, measured pickled (default: 64)')
+parser.add_argument('--result-memory', type=int, default=64, help='maximum size of the transformation results kept in memory in MB (default: 64)')
+parser.add_argument('--max-upload', type=int, default=64, help='maximum size of a CSAR sent with a request in MB (default: 64)')
+parser.add_argument('--csar-root', metavar='DIR', help='let clients name CSARs below DIR on the server instead of sending them')
+parser.add_argument('--template-cache', metavar='DIR', help='also keep parsed service templates in DIR, for later runs of the server')
+parser.add_argument('--verbose', action='store_true', help='log every request')
+args = parser.parse_args()
+
+service = TransformService(args.work_dir, args.concurrency or multiprocessing.cpu_count(), args.cache_size * 1024 * 1024, args.archive_size * 1024 * 1024, args.template_memory * 1024 * 1024, args.result_memory * 1024 * 1024, args.template_cache, args.csar_root, args.max_upload * 1024 * 1024)
+
+try:
+  server = TransformServer((args.host, args.port), service, args.verbose)
+except socket.error, e:
+  print 'Cannot listen on ' + args.host + ':' + str(args.port) + ': ' + str(e)
+  sys.exit(1)
+
+print 'Serving transformations on http://' + args.host + ':' + str(args.port) + '/'
+sys.stdout.flush()
+
+try:
+  server.serve_forever()
+except KeyboardInterrupt:
+  pass
+finally:
+  server.server_close()
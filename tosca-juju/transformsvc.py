@@ -0,0 +1,528 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os, sys, json, time, shutil, hashlib, tempfile, threading, traceback, zipfile, urllib, urllib2, urlparse
+import BaseHTTPServer, SocketServer
+from collections import OrderedDict
+from cStringIO import StringIO
+
+from csarfile import CsarFile, CsarError
+from modeltrans import ModelTransformer
+from tplcache import TemplateCache, templateFormat
+from tplloader import TemplateOverrideError
+from bundlecache import BundleCache
+from charmgen import CharmGenerator, CharmGenerationError, charmFormat
+from cmdgen import CommandGenerator
+
+#
+# Transformation service: transforms CSARs on request and keeps everything
+# that can be reused between requests, so that a request costs neither the
+# start of the interpreter nor parsing the same service template again.
+#
+#   POST /transform        transforms the CSAR sent as request body, or the
+#                          one at the server side path given as "path"
+#                          parameter, which has to be below the CSAR root
+#                          of the service; further parameters: "template",
+#                          "loader", "env", "set" (NODE:PROPERTY=VALUE, any
+#                          number of times) and "dedupe" (0, the default, or
+#                          1). Returns the model, the deployment plan, the
+#                          transformation output and the path of the charm
+#                          archive as JSON.
+#   GET /charms/KEY.zip    returns the charm archive of a transformation
+#   GET /status            returns the request counts and cache sizes
+#
+# Kept between requests, each with bounded size: parsed service templates (in
+# memory), cookbook and role bundles and charm archives (on disk) and the
+# results of recent transformations (in memory). Request bodies above the
+# maximum upload size are refused.
+#
+
+charmsDir = 'charms' # charms directory the deployment plans refer to, on the client side
+charmSeries = 'precise' # for now this has to be a valid name for a Ubuntu series
+
+# Raised for requests that cannot be served; status is the HTTP status
+class TransformServiceError(Exception):
+  def __init__(self, status, message, log=None):
+    Exception.__init__(self, message)
+    self.status = status
+    self.log = log
+
+# Stand-in for sys.stdout that collects the output of every thread that
+# captures it in a buffer of its own, so concurrent transformations do not mix
+# their output; the output of all other threads goes to the original stream
+class ThreadOutput(object):
+  def __init__(self, stream):
+    self.stream = stream
+    self.local = threading.local()
+
+  def capture(self):
+    self.local.buffer = StringIO()
+
+  # Stops capturing and returns the captured output
+  def release(self):
+    output = self.local.buffer.getvalue()
+    self.local.buffer = None
+    return output
+
+  def write(self, data):
+    buffer = getattr(self.local, 'buffer', None)
+    (buffer if buffer != None else self.stream).write(data)
+
+  def flush(self):
+    self.stream.flush()
+
+# Returns the cache key of a transformation of the CSAR with the given digest
+def getResultKey(csarDigest, options):
+  digest = hashlib.sha1()
+  digest.update(templateFormat + '\0' + charmFormat + '\0' + csarDigest + '\0')
+  digest.update(json.dumps(options, sort_keys=True))
+
+  return digest.hexdigest()
+
+# Returns the SHA-1 digest of the file at the given path
+def getDigest(path):
+  digest = hashlib.sha1()
+  file = open(path, 'rb')
+
+  try:
+    for block in iter(lambda: file.read(1 << 16), ''):
+      digest.update(block)
+  finally:
+    file.close()
+
+  return digest.hexdigest()
+
+# Writes a zip archive at destPath with all files below the given directory,
+# keeping their permissions, e.g. those of the hook scripts
+def archiveDirectory(destPath, srcDir):
+  archive = zipfile.ZipFile(destPath, 'w', zipfile.ZIP_DEFLATED)
+
+  try:
+    for dirPath, dirNames, fileNames in os.walk(srcDir):
+      dirNames.sort()
+
+      for fileName in sorted(fileNames):
+        path = dirPath + '/' + fileName
+        info = zipfile.ZipInfo(os.path.relpath(path, srcDir), time.localtime(os.path.getmtime(path))[:6])
+        info.external_attr = (os.stat(path).st_mode & 0xFFFF) << 16
+        info.compress_type = zipfile.ZIP_DEFLATED
+
+        file = open(path, 'rb')
+        try:
+          archive.writestr(info, file.read())
+        finally:
+          file.close()
+  finally:
+    archive.close()
+
+class TransformService:
+  # workDir holds the caches and the temporary files of the requests.
+  # maxConcurrent limits the transformations that run at the same time, the
+  # other requests wait. cacheSize and archiveSize are the maximum sizes of
+  # the bundle cache and of the charm archives in bytes, templateSize and
+  # resultSize those of the parsed templates (pickled) and of the results (as
+  # JSON) kept in memory in bytes. CSARs are only read from server side paths
+  # below csarRoot, and not at all without it; uploads are limited to
+  # maxUploadSize bytes.
+  def __init__(self, workDir, maxConcurrent=4, cacheSize=512 * 1024 * 1024, archiveSize=512 * 1024 * 1024, templateSize=64 * 1024 * 1024, resultSize=64 * 1024 * 1024, templateCacheDir=None, csarRoot=None, maxUploadSize=64 * 1024 * 1024):
+    self.workDir = os.path.abspath(workDir)
+    self.tmpDir = self.workDir + '/tmp'
+    self.cacheDir = self.workDir + '/cache'
+    self.cacheSize = cacheSize
+
+    if os.path.isdir(self.tmpDir):
+      shutil.rmtree(self.tmpDir)
+    os.makedirs(self.tmpDir)
+
+    self.templateCache = TemplateCache(templateCacheDir, templateSize)
+    self.archives = BundleCache(self.workDir + '/archives', archiveSize)
+
+    self.csarRoot = os.path.realpath(csarRoot) if csarRoot != None else None
+    self.maxUploadSize = maxUploadSize
+
+    self.resultSize = resultSize
+    self.results = OrderedDict() # result key -> (result, size), the least recently used first
+    self.resultBytes = 0
+
+    self.slots = threading.Semaphore(max(1, maxConcurrent))
+    self.lock = threading.Lock()
+    self.counts = {'requests': 0, 'cached': 0, 'failed': 0, 'active': 0}
+
+    # Transformations print their progress; keep it apart per request
+    if not isinstance(sys.stdout, ThreadOutput):
+      sys.stdout = ThreadOutput(sys.stdout)
+
+  def count(self, name, amount=1):
+    self.lock.acquire()
+    try:
+      self.counts[name] += amount
+    finally:
+      self.lock.release()
+
+  # Returns the request counts and cache sizes
+  def getStatus(self):
+    self.lock.acquire()
+    try:
+      status = dict(self.counts)
+      status['results'] = len(self.results)
+      status['resultBytes'] = self.resultBytes
+    finally:
+      self.lock.release()
+
+    status['templates'] = len(self.templateCache)
+    status['templateBytes'] = self.templateCache.getSize()
+    return status
+
+  # Returns the cached result with the given key, if its charm archive is
+  # still there; the archive is marked as used, so it is evicted last
+  def getResult(self, key):
+    self.lock.acquire()
+    try:
+      entry = self.results.pop(key, None)
+      if entry == None:
+        return None
+
+      try:
+        os.utime(self.archives.getPath(key), None)
+      except OSError:
+        # Evicted, the result is of no use without it
+        self.resultBytes -= entry[1]
+        return None
+
+      self.results[key] = entry
+      return entry[0]
+    finally:
+      self.lock.release()
+
+  # Keeps the result, dropping the least recently used ones beyond the
+  # maximum size; results larger than that are not kept at all
+  def storeResult(self, key, result):
+    size = len(json.dumps(result))
+
+    self.lock.acquire()
+    try:
+      entry = self.results.pop(key, None)
+      if entry != None:
+        self.resultBytes -= entry[1]
+
+      if size > self.resultSize:
+        return
+
+      self.results[key] = (result, size)
+      self.resultBytes += size
+
+      while self.resultBytes > self.resultSize:
+        self.resultBytes -= self.results.popitem(False)[1][1]
+    finally:
+      self.lock.release()
+
+  # Returns the real path of the CSAR at the given server side path, which
+  # may be relative to the CSAR root; raises TransformServiceError unless it
+  # is below the CSAR root
+  def getCsarPath(self, path):
+    if self.csarRoot == None:
+      raise TransformServiceError(403, 'Reading CSARs on the server is disabled, send the CSAR instead.')
+
+    csarPath = os.path.realpath(os.path.join(self.csarRoot, path))
+
+    if not csarPath.startswith(self.csarRoot.rstrip('/') + '/'):
+      raise TransformServiceError(403, 'CSAR "' + path + '" is not below the CSAR root of the server.')
+
+    return csarPath
+
+  # Returns the path of the charm archive with the given key, or None
+  def getArchivePath(self, key):
+    path = self.archives.getPath(key)
+
+    try:
+      os.utime(path, None)
+    except OSError:
+      return None
+
+    return path
+
+  # Transforms the CSAR at the given path and returns the result: a dict with
+  # the result key, the model, the deployment plan, the output of the
+  # transformation and whether the result was cached. options holds
+  # "template", "loader", "env", "overrides" and "dedupe". Raises
+  # TransformServiceError.
+  def transform(self, csarPath, options):
+    self.count('requests')
+    start = time.time()
+
+    try:
+      key = getResultKey(getDigest(csarPath), options)
+    except (IOError, OSError), e:
+      self.count('failed')
+      raise TransformServiceError(400, 'Cannot read CSAR "' + csarPath + '": ' + str(e))
+
+    result = self.getResult(key)
+    cached = result != None
+
+    if not cached:
+      self.slots.acquire()
+      self.count('active')
+
+      try:
+        # The same request may have been served while this one waited
+        result = self.getResult(key)
+        cached = result != None
+
+        if not cached:
+          result = self.runTransformation(key, csarPath, options)
+      except TransformServiceError:
+        self.count('failed')
+        raise
+      finally:
+        self.count('active', -1)
+        self.slots.release()
+
+    if cached:
+      self.count('cached')
+
+    result = dict(result)
+    result['cached'] = cached
+    result['duration'] = time.time() - start
+
+    return result
+
+  # Runs the transformation, charm generation and command generation for a
+  # request that is not cached
+  def runTransformation(self, key, csarPath, options):
+    workCharmsDir = tempfile.mkdtemp('', 'charms-', self.tmpDir)
+
+    try:
+      model, plan, log = self.generate(csarPath, options, workCharmsDir)
+
+      archivePath = workCharmsDir + '.zip'
+      archiveDirectory(archivePath, workCharmsDir + '/' + charmSeries)
+      self.archives.store(key, archivePath)
+      os.remove(archivePath)
+    finally:
+      shutil.rmtree(workCharmsDir, True)
+
+    result = {'key': key, 'model': model.toDict(), 'plan': json.loads(plan.toJson()), 'log': log}
+    self.storeResult(key, result)
+
+    return result
+
+  # Transforms the CSAR and generates its charms in the given directory.
+  # Returns the model, the deployment plan and the output.
+  def generate(self, csarPath, options, workCharmsDir):
+    sys.stdout.capture()
+    log = None
+
+    try:
+      try:
+        csar = CsarFile(csarPath)
+
+        try:
+          transformer = ModelTransformer(csar, options['template'], options['loader'], self.templateCache)
+          model = transformer.transform(options['overrides'])
+
+          if options['dedupe']:
+            model.deduplicate()
+
+          CharmGenerator(csar, model, workCharmsDir, charmSeries, 1, self.cacheDir, self.cacheSize).generate()
+        finally:
+          csar.close()
+
+        plan = CommandGenerator(model, charmsDir, charmSeries, options['env']).generatePlan()
+      finally:
+        log = sys.stdout.release()
+    except (CsarError, TemplateOverrideError), e:
+      raise TransformServiceError(400, str(e), log)
+    except SystemExit:
+      # The transformer exits on invalid input after printing the reason
+      raise TransformServiceError(400, log.strip().split('\n')[-1], log)
+    except CharmGenerationError, e:
+      raise TransformServiceError(500, str(e), log)
+    except Exception:
+      raise TransformServiceError(500, traceback.format_exc(), log)
+
+    return model, plan, log
+
+  # Transforms a CSAR sent by the client, see transform
+  def transformUpload(self, data, options):
+    fd, csarPath = tempfile.mkstemp('.zip', 'csar-', self.tmpDir)
+
+    try:
+      csarFile = os.fdopen(fd, 'wb')
+      try:
+        csarFile.write(data)
+      finally:
+        csarFile.close()
+
+      return self.transform(csarPath, options)
+    finally:
+      os.remove(csarPath)
+
+# Returns the transformation options of the given query parameters
+def parseOptions(params):
+  def get(name, default=None):
+    return params.get(name, [default])[-1]
+
+  overrides = {}
+  for setting in params.get('set', []):
+    target, separator, value = setting.partition('=')
+    nodeId, colon, name = target.partition(':')
+
+    if separator == '' or colon == '' or nodeId == '' or name == '':
+      raise TransformServiceError(400, 'Invalid property override "' + setting + '", expected "node:property=value".')
+
+    overrides.setdefault(nodeId, {})[name] = value
+
+  loader = get('loader', 'dom')
+  if not loader in ('dom', 'stream'):
+    raise TransformServiceError(400, 'Unknown loader "' + loader + '".')
+
+  return {'template': get('template'), 'loader': loader, 'env': get('env', 'default'), 'overrides': overrides, 'dedupe': get('dedupe', '0') != '0'}
+
+class TransformRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def sendData(self, status, contentType, data):
+    self.send_response(status)
+    self.send_header('Content-Type', contentType)
+    self.send_header('Content-Length', str(len(data)))
+    if self.close_connection:
+      self.send_header('Connection', 'close')
+    self.end_headers()
+    self.wfile.write(data)
+
+  def sendJson(self, status, value):
+    self.sendData(status, 'application/json', json.dumps(value, indent=2, sort_keys=True))
+
+  def sendError(self, e):
+    self.sendJson(e.status, {'error': str(e), 'log': e.log})
+
+  def do_GET(self):
+    path = urlparse.urlparse(self.path).path
+    service = self.server.service
+
+    if path == '/status':
+      self.sendJson(200, service.getStatus())
+    elif path.startswith('/charms/') and path.endswith('.zip'):
+      archivePath = service.getArchivePath(path[len('/charms/'):-len('.zip')].replace('/', ''))
+
+      if archivePath == None:
+        self.sendError(TransformServiceError(404, 'No such charm archive.'))
+        return
+
+      archive = open(archivePath, 'rb')
+      try:
+        self.sendData(200, 'application/zip', archive.read())
+      finally:
+        archive.close()
+    else:
+      self.sendError(TransformServiceError(404, 'Not found.'))
+
+  def do_POST(self):
+    url = urlparse.urlparse(self.path)
+    service = self.server.service
+
+    try:
+      try:
+        length = int(self.headers.get('Content-Length', '0'))
+      except ValueError:
+        length = -1
+
+      if length < 0 or length > service.maxUploadSize:
+        # The body is not read, so the connection cannot be used any further
+        self.close_connection = 1
+
+        if length < 0:
+          raise TransformServiceError(400, 'Invalid Content-Length.')
+        raise TransformServiceError(413, 'The CSAR exceeds the maximum size of ' + str(service.maxUploadSize) + ' bytes.')
+
+      data = self.rfile.read(length)
+
+      if url.path != '/transform':
+        raise TransformServiceError(404, 'Not found.')
+
+      params = urlparse.parse_qs(url.query)
+      options = parseOptions(params)
+
+      if 'path' in params:
+        result = service.transform(service.getCsarPath(params['path'][-1]), options)
+      elif len(data) > 0:
+        result = service.transformUpload(data, options)
+      else:
+        raise TransformServiceError(400, 'No CSAR given.')
+
+      result['charms'] = '/charms/' + result['key'] + '.zip'
+      self.sendJson(200, result)
+    except TransformServiceError, e:
+      self.sendError(e)
+    except Exception:
+      self.sendError(TransformServiceError(500, traceback.format_exc()))
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# HTTP server that handles every request in a thread of its own
+class TransformServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 64
+
+  def __init__(self, address, service, verbose=False):
+    BaseHTTPServer.HTTPServer.__init__(self, address, TransformRequestHandler)
+    self.service = service
+    self.verbose = verbose
+
+# Sends a transformation request to the server at the given URL. With upload,
+# the CSAR is sent along, otherwise the server reads it from csarPath. params
+# is a list of (name, value) query parameters, see parseOptions. Returns the
+# HTTP status and the decoded JSON response. Without upload, the path has to
+# be below the CSAR root of the server.
+def requestTransform(serverUrl, csarPath, params, upload=True):
+  params = list(params)
+
+  if upload:
+    csarFile = open(csarPath, 'rb')
+    try:
+      data = csarFile.read()
+    finally:
+      csarFile.close()
+  else:
+    params.append(('path', os.path.abspath(csarPath)))
+    data = ''
+
+  request = urllib2.Request(serverUrl.rstrip('/') + '/transform?' + urllib.urlencode(params), data, {'Content-Type': 'application/zip'})
+
+  try:
+    response = urllib2.urlopen(request)
+    status = response.getcode()
+  except urllib2.HTTPError, e:
+    response = e
+    status = e.code
+
+  try:
+    return status, json.loads(response.read())
+  finally:
+    response.close()
+
+# Downloads the charm archive of a transformation result to destPath
+def fetchCharms(serverUrl, result, destPath):
+  response = urllib2.urlopen(serverUrl.rstrip('/') + result['charms'])
+
+  try:
+    destFile = open(destPath, 'wb')
+    try:
+      shutil.copyfileobj(response, destFile)
+    finally:
+      destFile.close()
+  finally:
+    response.close()
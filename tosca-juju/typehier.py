@@ -0,0 +1,54 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Raised for inheritance cycles and references to unknown types
+class TypeHierarchyError(Exception):
+  pass
+
+# Computes the transitive closure of the "derivedFrom" relation for the given
+# dict of types (id -> type). Returns a dict that maps each type id to the
+# frozenset of its ancestors, including the type itself. The kind ("Node type",
+# "Relationship type") is only used for error messages.
+def computeAncestors(types, kind):
+  ancestors = {}
+
+  for typeId in types.keys():
+    # Walk up the chain until a type with known ancestors (or the root) is reached
+    chain = []
+    onChain = set()
+    current = typeId
+    inherited = frozenset()
+
+    while current != None:
+      if current in ancestors:
+        inherited = ancestors[current]
+        break
+
+      if current in onChain:
+        cycle = chain[chain.index(current):] + [current]
+        raise TypeHierarchyError(kind + ' "' + current + '" has a cyclic type hierarchy: ' + ' -> '.join(cycle) + '.')
+
+      if not current in types:
+        raise TypeHierarchyError(kind + ' "' + chain[-1] + '" is derived from unknown type "' + current + '".')
+
+      chain.append(current)
+      onChain.add(current)
+      current = types[current].derivedFrom
+
+    # Assign the ancestors from the top of the chain downwards
+    for chainTypeId in reversed(chain):
+      inherited = inherited | frozenset([chainTypeId])
+      ancestors[chainTypeId] = inherited
+
+  return ancestors